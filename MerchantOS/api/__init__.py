@@ -4,7 +4,7 @@ import base64
 import logging
 
 from MerchantOS.api.lib.connection import Connection
-from resources import ResourceAccessor
+from resources import ResourceAccessor, ResourceRegistry, registry
 
 log = logging.getLogger("MerchantOS.api")
 
@@ -12,19 +12,69 @@ log = logging.getLogger("MerchantOS.api")
 class ApiClient(object):
     BASE_URL = '/API'
     
-    def __init__(self, host, token, user_id):
+    def __init__(self, host, token, user_id, pool_size=10, cache=None, resources={}, 
+                 account_cache=None, hooks=[], secure=True, transport=None, codec=None,
+                 rate_limiter=None, single_flight=None, compress=True, compress_requests=None):
+        """
+        @param resources: ResourceObject classes by resource name, for this client only
+        @type resources: dict
+        @param account_cache: On-disk cache of the account ID, to skip the Account lookup
+        @type account_cache: AccountCache
+        @param hooks: Callables receiving a RequestRecord after every request
+        @type hooks: list
+        @param secure: Connect over HTTPS (False for a local test server)
+        @type secure: bool
+        @param transport: What the requests are sent through (see the transport module)
+        @type transport: Transport
+        @param codec: Encodes and decodes the JSON bodies (see the codec module)
+        @type codec: JsonCodec
+        @param rate_limiter: Limiter pacing the requests, defaults to the one
+                             shared by all clients of the account
+        @type rate_limiter: RateLimiter
+        @param single_flight: Coalesces identical concurrent GETs (see the
+                              singleflight module), False to send every GET
+        @type single_flight: SingleFlight
+        @param compress: Ask for gzip or deflate encoded responses
+        @type compress: bool
+        @param compress_requests: Gzip PUT and POST bodies of at least this
+                                  many bytes, None to never - only for
+                                  servers accepting compressed bodies
+        @type compress_requests: int
+        """
         auth = base64.b64encode("%s:%s" % (user_id, token))
-        self._connection = Connection(host, self.BASE_URL, auth)
+        self._connection = Connection(host, self.BASE_URL, auth, pool_size=pool_size, cache=cache,
+                                      account_cache=account_cache, hooks=hooks,
+                                      secure=secure, transport=transport,
+                                      codec=codec, rate_limiter=rate_limiter,
+                                      single_flight=single_flight, compress=compress,
+                                      compress_requests=compress_requests)
+        self._registry = ResourceRegistry(parent=registry)
+        for name, klass in resources.iteritems():
+            self._registry.register(name, klass)
         
         
     def connection(self):
         pass
     
         
+    def register(self, name, klass):
+        """
+        Declare the ResourceObject class of a resource for this client
+        """
+        self._registry.register(name, klass)
+        self.__dict__.pop(name, None)
+    
+        
     def __getattr__(self, attrname):
-        try:
-            return ResourceAccessor(attrname, self._connection)
-        except:
-            raise AttributeError
-        raise AttributeError
+        """
+        Build the accessor of a resource on first access and keep it as an
+        instance attribute, so later accesses are plain attribute lookups
+        """
+        if attrname.startswith("_"):
+            raise AttributeError(attrname)
+        accessor = ResourceAccessor(attrname, self._connection, 
+                                    klass=self._registry.resolve(attrname),
+                                    registry=self._registry)
+        self.__dict__[attrname] = accessor
+        return accessor
             
\ No newline at end of file
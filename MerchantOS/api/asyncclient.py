@@ -0,0 +1,284 @@
+"""
+Async Client Module
+
+Non-blocking counterpart of ApiClient.  Every call is dispatched to a
+WorkerPool and returns a Future straight away, so the caller (an event
+loop, a request handler, ...) never blocks on the network or on the
+rate limit back-off.  Results are collected with Future.result() or
+delivered through Future.add_done_callback().
+
+    api = AsyncApiClient(host, token, user_id)
+    future = api.Item.get(1234)
+    future.add_done_callback(lambda f: handle(f.result()))
+
+Several clients may share one WorkerPool to drive many accounts from
+a fixed number of threads.
+"""
+import sys
+import base64
+import logging
+import threading
+
+from MerchantOS.api.lib.connection import Connection
+from MerchantOS.api.lib.workers import WorkerPool, Future
+from MerchantOS.api.resources import ResourceAccessor
+
+log = logging.getLogger("MerchantOS.async")
+
+
+class AsyncConnection(object):
+    """
+    Wraps a Connection so that its requests run on a WorkerPool.  The
+    Connection itself is created on the pool as well, so constructing an
+    AsyncConnection makes no blocking call.
+    """
+
+    def __init__(self, host, base_url, auth, pool=None, workers=10, **kwargs):
+        """
+        Constructor
+
+        @param pool: WorkerPool to run requests on, a private pool of
+                     'workers' threads is created when not given
+        @type pool: WorkerPool
+        """
+        self.host = host
+        self._own_pool = pool is None
+        self._pool = pool or WorkerPool(workers, name="MerchantOS-async")
+        self._ready = self._pool.submit(Connection, host, base_url, auth, **kwargs)
+
+
+    @property
+    def connection(self):
+        """
+        The underlying Connection (blocks until it is established)
+        """
+        return self._ready.result()
+
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run fn(connection, *args, **kwargs) on the pool
+        """
+        def call():
+            return fn(self.connection, *args, **kwargs)
+        return self._pool.submit(call)
+
+
+    def get(self, url="", query={}, name=None):
+        return self.submit(lambda con: con.get(url, query, name=name))
+
+
+    def update(self, url, updates):
+        return self.submit(lambda con: con.update(url, updates))
+
+
+    def create(self, url, properties, name=""):
+        return self.submit(lambda con: con.create(url, properties, name=name))
+
+
+    def delete(self, url, name=None):
+        return self.submit(lambda con: con.delete(url, name=name))
+
+
+    def close(self):
+        if self._ready.done() and not self._ready.exception():
+            self._ready.result().close()
+        if self._own_pool:
+            self._pool.shutdown(wait=False)
+
+
+    def __repr__(self):
+        return "AsyncConnection %s" % (self.host)
+
+
+
+class AsyncResourceObject(object):
+    """
+    Wraps a realized ResourceObject.  Fields are read and set as on the
+    wrapped object; save, delete and sub-resource loading return Futures.
+    """
+
+    def __init__(self, obj, connection):
+        object.__setattr__(self, "_obj", obj)
+        object.__setattr__(self, "_async_connection", connection)
+
+
+    def __getattr__(self, attrname):
+        return getattr(self._obj, attrname)
+
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)
+
+
+    def fetch(self, attrname):
+        """
+        Inflate a sub-resource (or read any field) on the pool
+        """
+        return self._async_connection.submit(lambda con: getattr(self._obj, attrname))
+
+
+    def save(self):
+        return self._async_connection.submit(lambda con: self._obj.save())
+
+
+    def delete(self):
+        return self._async_connection.submit(lambda con: self._obj.delete())
+
+
+    def get_url(self):
+        return self._obj.get_url()
+
+
+    def to_dict(self):
+        return self._obj.to_dict()
+
+
+    def __repr__(self):
+        return repr(self._obj)
+
+
+
+class AsyncEnumeration(object):
+    """
+    A running enumeration.  Objects are pulled off the enumeration in
+    batches on the pool; next_batch() returns a Future of the next list
+    of objects, which is empty once the enumeration is exhausted.
+    """
+
+    def __init__(self, accessor, batch_size=100, **kwargs):
+        self._accessor = accessor
+        self._batch_size = batch_size
+        self._kwargs = kwargs
+        self._iterator = None
+        self._lock = threading.Lock()
+
+
+    def __pull(self, connection):
+        with self._lock:
+            if self._iterator is None:
+                self._iterator = self._accessor._sync(connection).enumerate(**self._kwargs)
+            batch = []
+            for obj in self._iterator:
+                batch.append(self._accessor._wrap(obj))
+                if len(batch) >= self._batch_size:
+                    break
+            return batch
+
+
+    def next_batch(self):
+        return self._accessor._connection.submit(self.__pull)
+
+
+    def each(self, callback):
+        """
+        Call callback(obj) for every object, batch after batch, without
+        blocking the caller.  The returned Future resolves to the number of
+        objects handled once the enumeration is done.
+        """
+        done = Future()
+        done.start()
+        count = [0]
+
+        def handle(future):
+            try:
+                batch = future.result()
+                for obj in batch:
+                    callback(obj)
+            except:
+                done.set_exception(sys.exc_info())
+                return
+            if not batch:
+                done.set_result(count[0])
+                return
+            count[0] += len(batch)
+            self.next_batch().add_done_callback(handle)
+
+        self.next_batch().add_done_callback(handle)
+        return done
+
+
+    def __iter__(self):
+        """
+        Blocking iteration, for use from a worker thread
+        """
+        while True:
+            batch = self.next_batch().result()
+            if not batch:
+                return
+            for obj in batch:
+                yield obj
+
+
+
+class AsyncResourceAccessor(object):
+    """
+    Same surface as ResourceAccessor, returning Futures
+    """
+
+    def __init__(self, resource_name, connection):
+        self._resource_name = resource_name
+        self._connection = connection
+        self._accessor = None
+
+
+    def _sync(self, connection):
+        if self._accessor is None:
+            self._accessor = ResourceAccessor(self._resource_name, connection)
+        return self._accessor
+
+
+    def _wrap(self, obj):
+        return AsyncResourceObject(obj, self._connection) if obj is not None else None
+
+
+    def get(self, id, query={}):
+        return self._connection.submit(
+            lambda con: self._wrap(self._sync(con).get(id, query=query)))
+
+
+    def create(self, properties, opts={}):
+        return self._connection.submit(
+            lambda con: self._wrap(self._sync(con).create(properties, opts)))
+
+
+    def get_count(self, query={}):
+        return self._connection.submit(lambda con: self._sync(con).get_count(query))
+
+
+    def enumerate(self, start=0, limit=0, query={}, max_per_call=100, **kwargs):
+        """
+        Start an enumeration, see ResourceAccessor.enumerate for the arguments
+        """
+        return AsyncEnumeration(self, batch_size=max_per_call, start=start, limit=limit,
+                                query=query, max_per_call=max_per_call, **kwargs)
+
+
+    def get_name(self):
+        return self._resource_name
+
+    name = property(fget=get_name)
+
+
+
+class AsyncApiClient(object):
+    BASE_URL = '/API'
+
+    def __init__(self, host, token, user_id, pool=None, workers=10, pool_size=10, cache=None,
+                 account_cache=None, **kwargs):
+        auth = base64.b64encode("%s:%s" % (user_id, token))
+        self._connection = AsyncConnection(host, self.BASE_URL, auth, pool=pool,
+                                           workers=workers, pool_size=pool_size, cache=cache,
+                                           account_cache=account_cache, **kwargs)
+
+
+    def close(self):
+        self._connection.close()
+
+
+    def __getattr__(self, attrname):
+        if attrname.startswith("_"):
+            raise AttributeError(attrname)
+        accessor = AsyncResourceAccessor(attrname, self._connection)
+        self.__dict__[attrname] = accessor
+        return accessor
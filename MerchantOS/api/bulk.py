@@ -0,0 +1,239 @@
+"""
+Bulk Module
+
+Runs many creates, updates and deletes concurrently.  Requests go
+through the client's Connection, so they share its keep-alive pool and
+are paced by the account's rate limiter; the number of workers only
+bounds how many are in flight.
+
+    writer = BulkWriter(api, workers=8)
+    for item in items:
+        item.qoh = counts[item.itemID]
+        writer.update(item)
+    writer.create("Vendor", {"name": "ACME"})
+    writer.delete("Item/1234")
+
+    result = writer.run()
+    for op in result.failed:
+        log.error("%s %s failed: %s" % (op.kind, op.url, op.error))
+
+Updates and deletes are idempotent and are retried after connection
+errors and server errors; a create is only sent once, since a failed
+create may still have been processed.  Operations the server kept
+rejecting for exceeding the rate limit are reported as throttled.  An
+operation failing in any other way is reported as failed with its
+error; it never stops the run.
+"""
+import time
+import socket
+import logging
+from httplib import HTTPException
+
+from MerchantOS.api.lib.connection import ResponseError
+from MerchantOS.api.lib.workers import WorkerPool
+
+log = logging.getLogger("MerchantOS.bulk")
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+THROTTLED = "throttled"
+
+
+class BulkOperation(object):
+    """
+    One pending write and, once run, its outcome
+    """
+
+    def __init__(self, kind, url, data=None, target=None, tag=None):
+        self.kind = kind        # "create", "update" or "delete"
+        self.url = url          # resource name for creates, object url otherwise
+        self.data = data
+        self.target = target    # the ResourceObject being written, if any
+        self.tag = tag          # caller's reference
+        self.status = None
+        self.result = None
+        self.error = None
+        self.attempts = 0
+
+
+    def __repr__(self):
+        return "BulkOperation %s %s (%s)" % (self.kind, self.url, self.status or "pending")
+
+
+
+class BulkResult(object):
+    """
+    The operations of a run, by outcome
+    """
+
+    def __init__(self, operations):
+        self.operations = operations
+        self.succeeded = [op for op in operations if op.status == SUCCEEDED]
+        self.failed = [op for op in operations if op.status == FAILED]
+        self.throttled = [op for op in operations if op.status == THROTTLED]
+
+
+    def ok(self):
+        return not self.failed and not self.throttled
+
+
+    def __len__(self):
+        return len(self.operations)
+
+
+    def __repr__(self):
+        return "BulkResult %d succeeded, %d failed, %d throttled" % (
+            len(self.succeeded), len(self.failed), len(self.throttled))
+
+
+
+class BulkWriter(object):
+    """
+    Collects writes and runs them concurrently
+    """
+
+    def __init__(self, api, workers=4, retries=3, backoff=1.0):
+        """
+        Constructor
+
+        @param api: The client (or its Connection) to write through
+        @type api: ApiClient
+        @param workers: Number of writes in flight at once
+        @type workers: int
+        @param retries: Attempts for updates and deletes
+        @type retries: int
+        @param backoff: Seconds before the first retry, doubled after each
+        @type backoff: float
+        """
+        self._connection = getattr(api, "_connection", api)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.__pending = []
+
+
+    def create(self, resource, properties, tag=None):
+        """
+        Queue the creation of a resource (ie, "Item")
+        """
+        op = BulkOperation("create", resource, properties, tag=tag)
+        self.__pending.append(op)
+        return op
+
+
+    def update(self, target, updates=None, tag=None):
+        """
+        Queue an update of a ResourceObject (its pending field changes by
+        default) or of an object url (ie, "Item/12")
+        """
+        url, obj = self.__target(target)
+        if updates is None:
+            updates = dict(obj._updates or {}) if obj is not None else {}
+        op = BulkOperation("update", url, updates, target=obj, tag=tag)
+        self.__pending.append(op)
+        return op
+
+
+    def delete(self, target, tag=None):
+        """
+        Queue the deletion of a ResourceObject or object url
+        """
+        url, obj = self.__target(target)
+        op = BulkOperation("delete", url, target=obj, tag=tag)
+        self.__pending.append(op)
+        return op
+
+
+    def __target(self, target):
+        if isinstance(target, basestring):
+            return target, None
+        return target.get_url(), target
+
+
+    def __send(self, op):
+        if op.kind == "create":
+            return self._connection.create(op.url, op.data)
+        if op.kind == "update":
+            return self._connection.update(op.url, op.data)
+        return self._connection.delete(op.url)
+
+
+    def __apply(self, op):
+        """
+        Update the written object like ResourceObject.save does
+        """
+        if op.kind != "update" or op.target is None:
+            return
+        obj = op.target
+        if obj._updates:
+            for name in op.data:
+                obj._updates.pop(name, None)
+        name = op.url.split("/")[0]
+        if isinstance(op.result, dict) and isinstance(op.result.get(name), dict):
+            obj._fields = op.result[name]
+
+
+    def __execute(self, op):
+        attempts = self.retries if op.kind in ("update", "delete") else 1
+        wait = self.backoff
+        for attempt in range(1, attempts + 1):
+            op.attempts = attempt
+            try:
+                op.result = self.__send(op)
+            except ResponseError, e:
+                op.error = e
+                # The connection already waited out the rate limit
+                if e.status == 503:
+                    op.status = THROTTLED
+                    return op
+                if e.status < 500:
+                    break
+            except (socket.error, HTTPException), e:
+                op.error = e
+            except Exception, e:
+                # An unexpected response or a bug - not worth a retry, but
+                # the other operations of the run go on
+                log.exception("%s %s failed" % (op.kind, op.url))
+                op.error = e
+                break
+            else:
+                op.status = SUCCEEDED
+                op.error = None
+                self.__apply(op)
+                return op
+
+            if attempt < attempts:
+                log.debug("Retrying %s %s in %.1fs: %s" % (op.kind, op.url, wait, op.error))
+                time.sleep(wait)
+                wait *= 2
+
+        op.status = FAILED
+        return op
+
+
+    def run(self):
+        """
+        Run the queued operations
+
+        @rtype: BulkResult
+        """
+        operations, self.__pending = self.__pending, []
+        if not operations:
+            return BulkResult([])
+
+        log.info("Running %d bulk operations on %d workers" % (len(operations), self.workers))
+        pool = WorkerPool(min(self.workers, len(operations)), name="MerchantOS-bulk")
+        try:
+            futures = [pool.submit(self.__execute, op) for op in operations]
+            for future in futures:
+                future.result()
+        finally:
+            pool.shutdown()
+
+        result = BulkResult(operations)
+        log.info(repr(result))
+        return result
+
+
+    def __len__(self):
+        return len(self.__pending)
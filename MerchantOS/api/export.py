@@ -0,0 +1,382 @@
+"""
+Export Module
+
+Streams a resource to a file: pages are decoded record by record as
+they arrive (see Connection.stream) and written out in chunks, so
+memory stays flat however large the catalog is.
+
+    exporter = Exporter(api, "Item", query={"load_relations": '["ItemShops"]'},
+                        columns=["itemID", "description", "ItemShops.ItemShop.shopID",
+                                 "ItemShops.ItemShop.qoh"],
+                        explode="ItemShops.ItemShop")
+    exporter.export("/tmp/inventory.csv.gz")
+
+Formats, by file extension:
+    .ndjson / .jsonl    one JSON record per line
+    .csv                a header row, then one row per record
+    .parquet            compressed columnar file (needs pyarrow)
+NDJSON and CSV files ending in .gz are gzip compressed.
+
+Columns are dotted paths into the records ("Prices.ItemPrice.0.amount").
+Without columns, NDJSON records are written as received and CSV and
+Parquet records are flattened to dotted paths, the columns being those
+of the first chunk written; a later record with a path not among them
+raises a ValueError rather than losing it (and no file is left behind),
+and the columns should then be given.  With explode, a nested list (ie,
+the ItemShops.ItemShop of every Item) yields one row per element, the
+record's other columns being repeated on each.
+
+From the command line:
+
+    python -m MerchantOS.api.export --host api.merchantos.com --token ... \\
+        --user ... Item items.ndjson.gz --query archived=false
+"""
+import os
+import csv
+import sys
+import gzip
+import logging
+import optparse
+
+from MerchantOS.api.lib.projection import get_path
+
+log = logging.getLogger("MerchantOS.export")
+
+FORMATS = {".ndjson": "ndjson", ".jsonl": "ndjson", ".csv": "csv", ".parquet": "parquet"}
+
+
+def flatten(value, prefix="", into=None):
+    """
+    Flatten nested objects and lists into {dotted path: value}
+    """
+    if into is None:
+        into = {}
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            flatten(item, "%s%s." % (prefix, key), into)
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            flatten(item, "%s%d." % (prefix, i), into)
+    else:
+        into[prefix[:-1]] = value
+    return into
+
+
+def flatten_row(row):
+    # Rows of an explode without columns are already flat
+    if any(isinstance(value, (dict, list)) for value in row.itervalues()):
+        return flatten(row)
+    return row
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    for extension, format in FORMATS.iteritems():
+        if name.endswith(extension):
+            return format
+    raise ValueError("Unknown export format for %s" % path)
+
+
+
+class RowProjection(object):
+    """
+    Turns a record into the rows written: selected columns, with one row
+    per element of the exploded list (see get_path in the projection module)
+    """
+
+    def __init__(self, columns=None, explode=None):
+        self.columns = list(columns) if columns else None
+        self.explode = explode
+        if explode and self.columns:
+            prefix = explode + "."
+            self.__paths = [(c, c[len(prefix):] if c.startswith(prefix) else None)
+                            for c in self.columns]
+
+
+    def __elements(self, record):
+        elements = get_path(record, self.explode)
+        if elements is None:
+            return [None]       # keep the record, with empty element columns
+        if not isinstance(elements, list):
+            return [elements]
+        return elements or [None]
+
+
+    def rows(self, record):
+        if not self.explode:
+            if self.columns is None:
+                yield record
+            else:
+                yield dict((c, get_path(record, c)) for c in self.columns)
+            return
+
+        if self.columns is None:
+            base = flatten(record)
+            prefix = self.explode + "."
+            base = dict((k, v) for (k, v) in base.iteritems() if not k.startswith(prefix))
+            for element in self.__elements(record):
+                row = dict(base)
+                flatten(element, prefix, row)
+                yield row
+            return
+
+        for element in self.__elements(record):
+            yield dict((column, get_path(element, path) if path is not None else get_path(record, column))
+                       for (column, path) in self.__paths)
+
+
+
+class NdjsonWriter(object):
+
+    def __init__(self, fp, codec):
+        self.fp = fp
+        self.codec = codec
+
+
+    def write(self, rows):
+        dumps = self.codec.dumps
+        self.fp.write("".join(dumps(row) + "\n" for row in rows))
+
+
+    def close(self):
+        self.fp.close()
+
+
+
+class CsvWriter(object):
+
+    def __init__(self, fp, columns, codec):
+        self.fp = fp
+        self.columns = columns
+        self.codec = codec
+        self.__writer = csv.writer(fp)
+        self.__writer.writerow([c.encode("utf-8") if isinstance(c, unicode) else c for c in columns])
+
+
+    def __cell(self, value):
+        if value is None:
+            return ""
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        if isinstance(value, (dict, list)):
+            return self.codec.dumps(value)
+        return value
+
+
+    def write(self, rows):
+        cell = self.__cell
+        columns = self.columns
+        self.__writer.writerows([[cell(row.get(c)) for c in columns] for row in rows])
+
+
+    def close(self):
+        self.fp.close()
+
+
+
+class ParquetWriter(object):
+    """
+    Parquet file with one row group per chunk.  Values are stored as
+    strings, as the API sends them.
+    """
+
+    def __init__(self, path, columns, codec, compression="snappy"):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Exporting to Parquet needs pyarrow (pip install pyarrow)")
+        self.__pa = pyarrow
+        self.columns = columns
+        self.codec = codec
+        self.__schema = pyarrow.schema([pyarrow.field(c, pyarrow.string()) for c in columns])
+        self.__writer = pyarrow.parquet.ParquetWriter(path, self.__schema, compression=compression)
+
+
+    def __cell(self, value):
+        if value is None or isinstance(value, basestring):
+            return value
+        if isinstance(value, (dict, list)):
+            return self.codec.dumps(value)
+        return unicode(value)
+
+
+    def write(self, rows):
+        pa, cell = self.__pa, self.__cell
+        arrays = [pa.array([cell(row.get(c)) for row in rows], type=pa.string()) for c in self.columns]
+        self.__writer.write_table(pa.Table.from_arrays(arrays, schema=self.__schema))
+
+
+    def close(self):
+        self.__writer.close()
+
+
+
+class Exporter(object):
+    """
+    Streams the records of a resource through a RowProjection to a file
+    """
+
+    def __init__(self, api, resource, query=None, columns=None, explode=None,
+                 chunk_size=1000, keyset=True):
+        """
+        Constructor
+
+        @param api: The client to export from
+        @type api: ApiClient
+        @param resource: The resource exported (ie, "Item")
+        @type resource: String
+        @param query: Filters, and load_relations for the relations exported
+        @type query: dict
+        @param columns: Dotted paths of the columns written, all by default
+        @type columns: list
+        @param explode: Dotted path of a nested list written as one row per
+                        element (ie, "ItemShops.ItemShop")
+        @type explode: String
+        @param chunk_size: Rows buffered between writes
+        @type chunk_size: int
+        @param keyset: Page by ID rather than offset (see ResourceAccessor.enumerate)
+        @type keyset: bool
+        """
+        self.api = api
+        self.resource = resource
+        self.query = dict(query or {})
+        self.projection = RowProjection(columns, explode)
+        self.chunk_size = chunk_size
+        self.keyset = keyset
+
+
+    def rows(self):
+        """
+        Yield the projected rows of every record
+        """
+        accessor = getattr(self.api, self.resource)
+        for record in accessor.enumerate(query=self.query, raw=True, stream=True, keyset=self.keyset):
+            for row in self.projection.rows(record):
+                yield row
+
+
+    def chunks(self):
+        chunk = []
+        for row in self.rows():
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+    def __writer(self, path, tmp, format, columns, compression):
+        codec = self.api._connection.codec
+        if format == "parquet":
+            return ParquetWriter(tmp, columns, codec, compression=compression or "snappy")
+        fp = gzip.open(tmp, "wb") if path.endswith(".gz") else open(tmp, "wb")
+        if format == "csv":
+            return CsvWriter(fp, columns, codec)
+        return NdjsonWriter(fp, codec)
+
+
+    def export(self, path, format=None, compression=None):
+        """
+        Write the export file.  It is written under a temporary name and
+        only renamed into place once complete, so an export that fails
+        (ie, on a row with columns not in the header) leaves no
+        truncated file behind.
+
+        @param path: The file written
+        @type path: String
+        @param format: "ndjson", "csv" or "parquet", by default from the extension
+        @type format: String
+        @param compression: Parquet compression codec ("snappy", "gzip", ...)
+        @type compression: String
+        @return: Number of rows written
+        @rtype: int
+        """
+        format = format or detect_format(path)
+        tmp = "%s.tmp" % path
+        columns = self.projection.columns
+        inferred = None
+        writer = None
+        count = 0
+        chunks = self.chunks()
+        completed = False
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    if columns is None and format != "ndjson":
+                        # Columns of the flattened records, as seen in the first chunk
+                        columns = sorted(set(key for row in chunk for key in flatten_row(row)))
+                        inferred = set(columns)
+                    writer = self.__writer(path, tmp, format, columns, compression)
+                if columns is not None and self.projection.columns is None:
+                    chunk = [flatten_row(row) for row in chunk]
+                if inferred is not None:
+                    unknown = set(key for row in chunk for key in row) - inferred
+                    if unknown:
+                        raise ValueError("%s rows after the first %d have columns %s not in the "
+                                         "header - pass the columns to export"
+                                         % (self.resource, count, ", ".join(sorted(unknown))))
+                writer.write(chunk)
+                count += len(chunk)
+                log.debug("Exported %d %s rows" % (count, self.resource))
+            if writer is None:
+                writer = self.__writer(path, tmp, format, columns or [], compression)
+            completed = True
+        finally:
+            chunks.close()
+            try:
+                if writer is not None:
+                    writer.close()
+            except:
+                completed = False
+                raise
+            finally:
+                if completed:
+                    if os.name == "nt" and os.path.exists(path):
+                        os.remove(path)
+                    os.rename(tmp, path)
+                elif os.path.exists(tmp):
+                    os.remove(tmp)
+        log.info("Exported %d %s rows to %s" % (count, self.resource, path))
+        return count
+
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] RESOURCE FILE")
+    parser.add_option("--host", default="api.merchantos.com")
+    parser.add_option("--token", help="API key")
+    parser.add_option("--user", help="User ID")
+    parser.add_option("--query", action="append", default=[], metavar="FIELD=VALUE",
+                      help="Filter, in the API syntax (ie, timeStamp='>=,2013-08-27T00:00:00+00:00')")
+    parser.add_option("--load-relations", help='"all" or a JSON list of relations')
+    parser.add_option("--columns", help="Comma separated dotted paths")
+    parser.add_option("--explode", help="Dotted path of a nested list to write a row per element of")
+    parser.add_option("--format", choices=["ndjson", "csv", "parquet"])
+    parser.add_option("--compression", help="Parquet compression codec")
+    parser.add_option("--chunk-size", type="int", default=1000)
+    parser.add_option("--insecure", action="store_true", help="Plain HTTP, for local test servers")
+    parser.add_option("-v", "--verbose", action="store_true")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or not options.token or not options.user:
+        parser.error("RESOURCE, FILE, --token and --user are required")
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)-8s[%(name)s] %(message)s')
+
+    from MerchantOS.api import ApiClient
+    api = ApiClient(options.host, options.token, options.user, secure=not options.insecure)
+    query = dict(q.split("=", 1) for q in options.query)
+    if options.load_relations:
+        query["load_relations"] = options.load_relations
+    columns = options.columns.split(",") if options.columns else None
+
+    exporter = Exporter(api, args[0], query=query, columns=columns, explode=options.explode,
+                        chunk_size=options.chunk_size)
+    exporter.export(args[1], format=options.format, compression=options.compression)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
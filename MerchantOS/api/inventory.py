@@ -0,0 +1,310 @@
+"""
+Inventory Module
+
+Stock levels of every Item at every Shop, collected from the ItemShops
+into columns (item_id, shop_id, qoh, reorder_point, reorder_level) and
+rolled up with array operations:
+
+    inventory = InventoryTable.load(api, query={"archived": "false"})
+    item_ids, qoh = inventory.item_totals()
+    shop_ids, qoh = inventory.shop_totals()
+    low = inventory.low_stock()             # rows at or below their reorder point
+
+    changes = inventory.diff(yesterday)     # qoh deltas per item and shop
+    for item_id, shop_id, delta in zip(changes.item_id, changes.shop_id, changes.delta):
+        ...
+
+The columns are NumPy arrays when NumPy is installed, and the rollups
+are then vectorized; without it they are computed in Python, with the
+columns held in compact arrays and the results returned as lists.
+
+Only the four ItemShop fields are read (see the projection module), and
+the records are decoded as they arrive and reduced to five integers, so
+collecting the inventory of a large catalog takes little memory.
+ItemShop rows of shop 0 hold an item's total over all its shops; they
+are left out unless include_total is set, as the totals are computed
+from the shops' rows.
+"""
+import array
+import logging
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger("MerchantOS.inventory")
+
+COLUMNS = ["item_id", "shop_id", "qoh", "reorder_point", "reorder_level"]
+
+ITEM_SHOP_FIELDS = ["itemID", "shopID", "qoh", "reorderPoint", "reorderLevel"]
+
+# Shop IDs below this combine with the item ID into one key (see diff)
+SHOP_SPAN = 1 << 24
+
+
+def _int(value):
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def _item_shops(record):
+    """
+    The ItemShop records of an Item, which the API sends as a single object
+    when there is only one
+    """
+    if not isinstance(record, dict):
+        record = record.to_dict()
+    shops = record.get("ItemShops")
+    if not isinstance(shops, dict):
+        return []
+    shops = shops.get("ItemShop") or []
+    return [shops] if isinstance(shops, dict) else shops
+
+
+def _sum_by(keys, values):
+    """
+    The distinct keys, in order, and the sum of the values of each
+    """
+    if numpy is not None and isinstance(keys, numpy.ndarray):
+        ids, inverse = numpy.unique(keys, return_inverse=True)
+        totals = numpy.bincount(inverse, weights=values, minlength=len(ids))
+        return ids, totals.round().astype(numpy.int64)
+    totals = {}
+    for key, value in izip(keys, values):
+        totals[key] = totals.get(key, 0) + value
+    ids = sorted(totals)
+    return ids, [totals[key] for key in ids]
+
+
+
+class InventoryDelta(object):
+    """
+    The rows whose qoh changed between two snapshots
+    """
+
+    def __init__(self, item_id, shop_id, before, after):
+        self.item_id = item_id
+        self.shop_id = shop_id
+        self.before = before
+        self.after = after
+        if isinstance(after, list):
+            self.delta = [b - a for (a, b) in izip(before, after)]
+        else:
+            self.delta = after - before
+
+
+    def __len__(self):
+        return len(self.item_id)
+
+
+    def __repr__(self):
+        return "InventoryDelta (%d changes)" % len(self)
+
+
+
+class InventoryTable(object):
+    """
+    ItemShop rows held as columns
+    """
+
+    def __init__(self, item_id, shop_id, qoh, reorder_point, reorder_level):
+        self.item_id = item_id
+        self.shop_id = shop_id
+        self.qoh = qoh
+        self.reorder_point = reorder_point
+        self.reorder_level = reorder_level
+
+
+    @classmethod
+    def from_rows(cls, rows, vectorized=None):
+        """
+        Build a table from (item_id, shop_id, qoh, reorder_point,
+        reorder_level) tuples
+
+        @param vectorized: Hold the columns in NumPy arrays, by default
+                           when NumPy is installed
+        @type vectorized: bool
+        """
+        if vectorized is None:
+            vectorized = numpy is not None
+        elif vectorized and numpy is None:
+            raise ImportError("Vectorized inventories need NumPy (pip install numpy)")
+
+        columns = [array.array("l") for name in COLUMNS]
+        appends = [column.append for column in columns]
+        for row in rows:
+            for append, value in izip(appends, row):
+                append(value)
+        if vectorized:
+            dtype = numpy.dtype("i%d" % columns[0].itemsize)
+            columns = [numpy.frombuffer(column, dtype=dtype).astype(numpy.int64)
+                       for column in columns]
+        return cls(*columns)
+
+
+    @classmethod
+    def from_item_shops(cls, records, include_total=False, vectorized=None):
+        """
+        Build a table from ItemShop records (dicts or objects)
+        """
+        def rows():
+            for record in records:
+                if not isinstance(record, dict):
+                    record = record.to_dict()
+                shop_id = _int(record.get("shopID"))
+                if shop_id or include_total:
+                    yield (_int(record.get("itemID")), shop_id, _int(record.get("qoh")),
+                           _int(record.get("reorderPoint")), _int(record.get("reorderLevel")))
+        return cls.from_rows(rows(), vectorized)
+
+
+    @classmethod
+    def from_items(cls, items, include_total=False, vectorized=None):
+        """
+        Build a table from Items loaded with their ItemShops relation
+        """
+        def records():
+            for item in items:
+                for record in _item_shops(item):
+                    yield record
+        return cls.from_item_shops(records(), include_total, vectorized)
+
+
+    @classmethod
+    def load(cls, api, query=None, via="Item", include_total=False, vectorized=None):
+        """
+        Read the inventory from the API
+
+        @param api: The client to read from
+        @type api: ApiClient
+        @param query: Filters on the resource read
+        @type query: dict
+        @param via: "Item" to read the Items with their ItemShops (the
+                    query filters Items), or "ItemShop" to read the
+                    ItemShop resource directly
+        @type via: String
+        @rtype: InventoryTable
+        """
+        if via == "Item":
+            fields = ["itemID"] + ["ItemShops.ItemShop.%s" % f for f in ITEM_SHOP_FIELDS]
+            records = api.Item.enumerate(query=query, raw=True, stream=True, keyset=True,
+                                         fields=fields, relations=["ItemShops"])
+            table = cls.from_items(records, include_total, vectorized)
+        elif via == "ItemShop":
+            records = api.ItemShop.enumerate(query=query, raw=True, stream=True, keyset=True,
+                                             fields=ITEM_SHOP_FIELDS)
+            table = cls.from_item_shops(records, include_total, vectorized)
+        else:
+            raise ValueError("Inventory is read via Item or ItemShop, not %s" % via)
+        log.debug("Loaded %r" % table)
+        return table
+
+
+    @property
+    def vectorized(self):
+        return numpy is not None and isinstance(self.qoh, numpy.ndarray)
+
+
+    def __len__(self):
+        return len(self.item_id)
+
+
+    def __take(self, indexes):
+        """
+        The rows at indexes (a boolean mask when vectorized)
+        """
+        if self.vectorized:
+            return InventoryTable(*[getattr(self, name)[indexes] for name in COLUMNS])
+        return InventoryTable(*[[getattr(self, name)[i] for i in indexes] for name in COLUMNS])
+
+
+    def item_totals(self):
+        """
+        The qoh of each item over all its shops
+
+        @return: The item IDs, in order, and their qoh
+        @rtype: tuple
+        """
+        return _sum_by(self.item_id, self.qoh)
+
+
+    def shop_totals(self):
+        """
+        The qoh of each shop over all its items
+
+        @return: The shop IDs, in order, and their qoh
+        @rtype: tuple
+        """
+        return _sum_by(self.shop_id, self.qoh)
+
+
+    def low_stock(self, level="reorder_point"):
+        """
+        The rows whose qoh is at or below their reorder point (or
+        "reorder_level"), leaving out the rows that have none set
+        """
+        if level not in ("reorder_point", "reorder_level"):
+            raise ValueError("Unknown stock level %s" % level)
+        threshold = getattr(self, level)
+        if self.vectorized:
+            return self.__take((threshold > 0) & (self.qoh <= threshold))
+        return self.__take([i for (i, (qoh, limit)) in enumerate(izip(self.qoh, threshold))
+                            if limit > 0 and qoh <= limit])
+
+
+    def shop(self, shop_id):
+        """
+        The rows of one shop
+        """
+        if self.vectorized:
+            return self.__take(self.shop_id == int(shop_id))
+        shop_id = int(shop_id)
+        return self.__take([i for (i, shop) in enumerate(self.shop_id) if shop == shop_id])
+
+
+    def __keys(self):
+        if len(self) and max(self.shop_id) >= SHOP_SPAN:
+            raise ValueError("Shop IDs must be below %d" % SHOP_SPAN)
+        if self.vectorized:
+            return self.item_id * SHOP_SPAN + self.shop_id
+        return [item * SHOP_SPAN + shop for (item, shop) in izip(self.item_id, self.shop_id)]
+
+
+    def diff(self, previous):
+        """
+        The qoh changes since a previous snapshot, per item and shop.  A row
+        missing from either snapshot counts as a qoh of 0 there.
+
+        @param previous: The earlier snapshot
+        @type previous: InventoryTable
+        @rtype: InventoryDelta
+        """
+        old, new = previous.__keys(), self.__keys()
+        if self.vectorized and previous.vectorized:
+            keys = numpy.union1d(old, new)
+            before = numpy.zeros(len(keys), dtype=numpy.int64)
+            after = numpy.zeros(len(keys), dtype=numpy.int64)
+            before[numpy.searchsorted(keys, old)] = previous.qoh
+            after[numpy.searchsorted(keys, new)] = self.qoh
+            changed = before != after
+            keys = keys[changed]
+            return InventoryDelta(keys // SHOP_SPAN, keys % SHOP_SPAN, before[changed], after[changed])
+
+        before = dict(izip(old, previous.qoh))
+        after = dict(izip(new, self.qoh))
+        keys = [key for key in sorted(set(before) | set(after))
+                if before.get(key, 0) != after.get(key, 0)]
+        return InventoryDelta([key // SHOP_SPAN for key in keys],
+                              [key % SHOP_SPAN for key in keys],
+                              [before.get(key, 0) for key in keys],
+                              [after.get(key, 0) for key in keys])
+
+
+    def __repr__(self):
+        return "InventoryTable (%d rows%s)" % (len(self), ", vectorized" if self.vectorized else "")
@@ -0,0 +1,229 @@
+"""
+Cache Module
+
+Response cache for GET requests, and an on-disk cache of account metadata.
+
+Response cache entries are keyed on the full request URL (including
+the query) and the credentials, hold the raw response body, and expire
+after a per-resource TTL.  The least recently used entries are evicted
+once the cache is full.  An expired entry that came with an ETag or
+Last-Modified header is revalidated with a conditional request instead
+of being fetched again.
+
+Any object with the same lookup/store/refresh/invalidate methods can be
+handed to a Connection in place of ResponseCache.
+
+The account cache keeps the account ID a set of credentials resolves to,
+along with the resource URL mappings, in a JSON file, so new clients
+can skip the Account lookup altogether.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+import simplejson
+from collections import OrderedDict
+
+log = logging.getLogger("MerchantOS.cache")
+
+# Reference resources that rarely change, in seconds
+DEFAULT_TTLS = {"Account": 3600,
+                "Shop": 600,
+                "Category": 600,
+                "Vendor": 600}
+
+
+class CacheEntry(object):
+    """
+    A cached response body
+    """
+    __slots__ = ("resource", "data", "expires", "etag", "last_modified")
+
+    def __init__(self, resource, data, expires, etag=None, last_modified=None):
+        self.resource = resource
+        self.data = data
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+    def fresh(self):
+        return time.time() < self.expires
+
+
+    def conditions(self):
+        """
+        Headers turning a request for this entry into a conditional one
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+
+class ResponseCache(object):
+    """
+    Thread-safe TTL / LRU cache of response bodies
+    """
+
+    def __init__(self, maxsize=1000, ttl=0, ttls=DEFAULT_TTLS):
+        """
+        Constructor
+
+        @param maxsize: Maximum number of responses kept
+        @type maxsize: int
+        @param ttl: Seconds to keep responses of resources not listed in ttls,
+                    0 to only keep them when they can be revalidated
+        @type ttl: int
+        @param ttls: Seconds to keep responses, by resource name
+        @type ttls: dict
+        """
+        self.maxsize = maxsize
+        self.default_ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def ttl(self, resource):
+        return self.ttls.get(resource, self.default_ttl)
+
+
+    def lookup(self, key):
+        """
+        Return the entry for key (fresh or not), or None
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries[key] = entry
+            if entry.fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+
+    def store(self, key, resource, data, etag=None, last_modified=None):
+        """
+        Cache a response body.  Responses of resources without a TTL are only
+        kept if they can be revalidated.
+        """
+        ttl = self.ttl(resource)
+        if ttl <= 0 and not (etag or last_modified):
+            return None
+
+        entry = CacheEntry(resource, data, time.time() + ttl, etag, last_modified)
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = entry
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+        return entry
+
+
+    def refresh(self, entry):
+        """
+        The server confirmed the entry is still current (304)
+        """
+        entry.expires = time.time() + self.ttl(entry.resource)
+
+
+    def invalidate(self, resource=None):
+        """
+        Drop every entry of resource, or everything
+        """
+        with self.__lock:
+            if resource is None:
+                self.__entries.clear()
+                return
+            for key in [k for (k, e) in self.__entries.iteritems() if e.resource == resource]:
+                del self.__entries[key]
+        log.debug("Invalidated cached %s responses" % resource)
+
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+    def __repr__(self):
+        return "ResponseCache %d/%d (%d hits, %d misses)" % (len(self), self.maxsize, self.hits, self.misses)
+
+
+
+class AccountCache(object):
+    """
+    Account ID and resource metadata by credentials, persisted to a JSON
+    file.  Credentials are only stored as a hash.
+    """
+
+    def __init__(self, path, ttl=86400):
+        """
+        Constructor
+
+        @param path: The JSON file, shared by every process using the cache
+        @type path: String
+        @param ttl: Seconds an account entry is trusted
+        @type ttl: int
+        """
+        self.path = path
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+
+
+    @staticmethod
+    def key(host, auth):
+        return hashlib.sha1("%s:%s" % (host, auth)).hexdigest()
+
+
+    def __read(self):
+        try:
+            with open(self.path) as fp:
+                return simplejson.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+
+    def load(self, key):
+        """
+        Return the entry ({"account_id": ..., "resource_meta": {...}}) stored
+        for key, or None if there is none or it expired
+        """
+        with self.__lock:
+            entry = self.__read().get(key)
+        if entry is None or time.time() - entry.get("stored", 0) > self.ttl:
+            return None
+        return entry
+
+
+    def store(self, key, account_id, resource_meta):
+        """
+        Store (or replace) the entry for key.  The file is replaced
+        atomically, so readers in other processes never see it half written.
+        """
+        with self.__lock:
+            entries = self.__read()
+            entries[key] = {"account_id": account_id,
+                            "resource_meta": resource_meta,
+                            "stored": time.time()}
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w") as fp:
+                simplejson.dump(entries, fp)
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+
+
+    def __repr__(self):
+        return "AccountCache %s" % self.path
@@ -0,0 +1,159 @@
+"""
+Codec Module
+
+JSON encoding and decoding of request and response bodies.  JsonCodec
+uses the fastest backend installed unless one is named.  On Python 2,
+simplejson with its C extension decodes API pages faster than ujson
+(which builds a unicode object for every string), so ujson is only
+picked when simplejson runs as pure Python:
+
+    api = ApiClient(host, token, user_id, codec=JsonCodec("ujson"))
+
+The API sends every value as a string ("qoh": "12").  With
+numeric_fields, strings that look like numbers are converted once, at
+parse time, either for the named fields or for every field (True):
+
+    codec = JsonCodec(numeric_fields=["qoh", "reorderPoint", "amount", "count"])
+
+Only plain integers and decimals are converted; numbers with leading
+zeros (ie, UPCs like "012345") are left as strings.  The conversion runs
+in Python for every object decoded, so naming the fields costs far less
+than converting every field.
+
+Incremental decoding (see the stream module) needs a decoder that can
+resume mid-buffer, which only simplejson offers, so streamed pages are
+always decoded by simplejson - with the same numeric conversion.
+"""
+import re
+import logging
+import simplejson
+
+log = logging.getLogger("MerchantOS.codec")
+
+BACKENDS = ["simplejson", "ujson"]
+
+NUMBER = re.compile(r"^-?(0|[1-9][0-9]*)(\.[0-9]+)?$")
+
+
+def to_number(value):
+    """
+    Convert a string that looks like a number, or return it unchanged
+    """
+    match = NUMBER.match(value)
+    if match is None:
+        return value
+    return float(value) if match.group(2) else int(value)
+
+
+def default_backend():
+    try:
+        from simplejson import _speedups
+        return "simplejson"
+    except ImportError:
+        pass
+    return "ujson" if "ujson" in available_backends() else "simplejson"
+
+
+def available_backends():
+    backends = []
+    for name in BACKENDS:
+        try:
+            __import__(name)
+            backends.append(name)
+        except ImportError:
+            pass
+    return backends
+
+
+
+class JsonCodec(object):
+    """
+    Encodes and decodes JSON bodies with a pluggable backend
+    """
+
+    def __init__(self, backend=None, numeric_fields=None):
+        """
+        Constructor
+
+        @param backend: "simplejson" or "ujson", defaults to the fastest of
+                        them that is installed
+        @type backend: String
+        @param numeric_fields: Names of the fields whose numeric strings are
+                               converted to numbers, True for every field
+        @type numeric_fields: list
+        """
+        if backend is None:
+            backend = default_backend()
+        if backend not in BACKENDS:
+            raise ValueError("Unknown JSON backend '%s'" % backend)
+        self.backend = backend
+        self.numeric_fields = numeric_fields
+        if numeric_fields not in (None, True):
+            self.numeric_fields = frozenset(numeric_fields)
+
+        module = __import__(backend)
+        hook = self.__convert if self.numeric_fields else None
+        if backend == "ujson":
+            self.__loads = module.loads
+            self.__dumps = lambda obj: module.dumps(obj, double_precision=15,
+                                                    escape_forward_slashes=False)
+            self.__post = self.__walk if hook else None
+        else:
+            decoder = module.JSONDecoder(object_hook=hook)
+            self.__loads = decoder.decode
+            self.__dumps = module.dumps
+            self.__post = None
+        log.debug("JSON codec %s" % self)
+
+
+    def __convert(self, obj):
+        fields = self.numeric_fields
+        if fields is True:
+            for key, value in obj.iteritems():
+                if isinstance(value, basestring):
+                    obj[key] = to_number(value)
+        else:
+            keys = fields if len(fields) < len(obj) else obj.keys()
+            for key in keys:
+                value = obj.get(key)
+                if isinstance(value, basestring) and key in fields:
+                    obj[key] = to_number(value)
+        return obj
+
+
+    def __walk(self, value):
+        """
+        Apply the numeric conversion to every object of a decoded document
+        """
+        if isinstance(value, dict):
+            for item in value.itervalues():
+                if isinstance(item, (dict, list)):
+                    self.__walk(item)
+            self.__convert(value)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, (dict, list)):
+                    self.__walk(item)
+        return value
+
+
+    def loads(self, data):
+        value = self.__loads(data)
+        if self.__post is not None:
+            value = self.__post(value)
+        return value
+
+
+    def dumps(self, obj):
+        return self.__dumps(obj)
+
+
+    def decoder(self):
+        """
+        A simplejson decoder applying the same conversion, for raw_decode
+        """
+        return simplejson.JSONDecoder(object_hook=self.__convert if self.numeric_fields else None)
+
+
+    def __repr__(self):
+        return "JsonCodec %s%s" % (self.backend, " (numeric)" if self.numeric_fields else "")
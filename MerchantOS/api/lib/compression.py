@@ -0,0 +1,75 @@
+"""
+Compression Module
+
+Content-Encoding support for the transports.  Responses are asked for
+gzip or deflate encoded (JSON pages shrink about ten times) and decoded
+as they are read, chunk by chunk when the body is streamed:
+
+    decoder = Decompressor("gzip")
+    for chunk in chunks:
+        data = decoder.decompress(chunk)
+    data += decoder.flush()
+
+Request bodies can be gzip encoded as well, for servers that accept
+compressed bodies (see ConnectionPool compress_requests).
+"""
+import zlib
+import logging
+
+log = logging.getLogger("MerchantOS.compression")
+
+ACCEPT_ENCODING = "gzip, deflate"
+ENCODINGS = ["gzip", "deflate"]
+
+# Balances the time spent compressing a request body with its size
+LEVEL = 6
+
+
+def compress(data, level=LEVEL):
+    """
+    Encode a request body as gzip
+    """
+    encoder = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return encoder.compress(data) + encoder.flush()
+
+
+def decompress(data, encoding):
+    """
+    Decode a whole gzip or deflate encoded body
+    """
+    decoder = Decompressor(encoding)
+    return decoder.decompress(data) + decoder.flush()
+
+
+
+class Decompressor(object):
+    """
+    Decodes a gzip or deflate encoded body fed in chunks
+    """
+
+    def __init__(self, encoding):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unsupported content encoding '%s'" % encoding)
+        self.encoding = encoding
+        self.__first = encoding == "deflate"
+        self.__decoder = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+
+
+    def decompress(self, data):
+        if self.__first and data:
+            # Some servers send deflate bodies without the zlib header
+            self.__first = False
+            try:
+                return self.__decoder.decompress(data)
+            except zlib.error:
+                log.debug("Raw deflate body")
+                self.__decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.__decoder.decompress(data)
+
+
+    def flush(self):
+        return self.__decoder.flush()
+
+
+    def __repr__(self):
+        return "Decompressor %s" % self.encoding
@@ -6,11 +6,18 @@ Handles put and get operations to the Bigcommerce REST API
 import sys
 import time
 import urllib
+import threading
 import logging
 import simplejson
 from urlparse import urlparse
 from pprint import pprint, pformat
-from httplib import HTTPSConnection, HTTPException
+from httplib import HTTPException
+from MerchantOS.api.lib.pool import ConnectionPool
+from MerchantOS.api.lib.ratelimit import RateLimiter
+from MerchantOS.api.lib.stream import RecordStream
+from MerchantOS.api.lib.metrics import RequestRecord
+from MerchantOS.api.lib.codec import JsonCodec
+from MerchantOS.api.lib.singleflight import SingleFlight
 
  
 log = logging.getLogger("MerchantOS.con")
@@ -19,22 +26,67 @@ class EmptyResponseWarning(HTTPException):
     pass
 
 
-class Connection():
+class ResponseError(HTTPException):
+    """
+    The server answered with an error status
+    """
+    def __init__(self, status, reason, host, url):
+        HTTPException.__init__(self, "%d %s @ https://%s%s" % (status, reason, host, url))
+        self.status = status
+        self.reason = reason
+        self.url = url
+
+
+class Connection(object):
     """
     Connection class manages the connection to the Bigcommerce REST API.
     """
+    MAX_RETRIES = 3  # attempts per request while the rate limit is exceeded
     
-    def __init__(self, host, base_url, auth):
+    def __init__(self, host, base_url, auth, pool_size=10, rate_limiter=None, cache=None,
+                 account_cache=None, hooks=[], secure=True, transport=None, codec=None,
+                 single_flight=None, compress=True, compress_requests=None):
         """
         Constructor
         
-        On creation, an initial call is made to load the mappings of resources to URLS
+        No request is made on creation: the account is looked up (or read
+        from the account cache) when the first account resource is requested
+        
+        @param pool_size: Maximum number of keep-alive connections kept to the host
+        @type pool_size: int
+        @param rate_limiter: Limiter pacing the requests, defaults to the one
+                             shared by all connections using the same credentials
+        @type rate_limiter: RateLimiter
+        @param cache: Cache for GET responses, may be shared between connections
+        @type cache: ResponseCache
+        @param account_cache: On-disk cache of the account ID and resource mappings
+        @type account_cache: AccountCache
+        @param hooks: Callables receiving the RequestRecord of every request
+        @type hooks: list
+        @param secure: Connect over HTTPS (False for a local test server)
+        @type secure: bool
+        @param transport: What the requests are sent through, defaults to a
+                          ConnectionPool to the host (see the transport module)
+        @type transport: Transport
+        @param codec: Encodes and decodes the JSON bodies, defaults to the
+                      fastest JSON backend installed
+        @type codec: JsonCodec
+        @param single_flight: Coalesces identical GETs made at the same time
+                              into one request, may be shared between
+                              connections; False sends every GET
+        @type single_flight: SingleFlight
+        @param compress: Ask for compressed responses (default transport only)
+        @type compress: bool
+        @param compress_requests: Gzip PUT and POST bodies of at least this
+                                  many bytes, None to never (default
+                                  transport only)
+        @type compress_requests: int
         """
         self.host = host
         self.base_url = base_url
-        self.resource_base_url = "%s/Account" % self.base_url
         self.auth = auth
         self.account_id = ""
+        self.codec = codec or JsonCodec()
         
         log.info("API Host: %s/%s" % (self.host, self.base_url))
         log.debug("Accepting json, auth: Basic %s" % self.auth)
@@ -42,8 +94,24 @@ class Connection():
                         "Accept": "application/json"}
         
         self.__resource_meta = {}
-        self.__connection = HTTPSConnection(self.host)
-        self.__set_base_url()
+        self.__transport = transport or ConnectionPool(self.host, maxsize=pool_size, secure=secure,
+                                                       compress=compress,
+                                                       compress_requests=compress_requests)
+        self.__limiter = rate_limiter or RateLimiter.shared("%s:%s" % (self.host, self.auth))
+        self.__cache = cache
+        self.__account_cache = account_cache
+        self.__account_key = "%s:%s" % (self.host, self.auth)
+        self.__account_lock = threading.Lock()
+        self.__hooks = list(hooks)
+        self.__flights = SingleFlight() if single_flight is None else single_flight
+        
+        if account_cache is not None:
+            self.__account_key = account_cache.key(self.host, self.auth)
+            entry = account_cache.load(self.__account_key)
+            if entry is not None:
+                self.account_id = entry["account_id"]
+                self.__resource_meta = entry.get("resource_meta", {})
+                log.debug("Account %s read from %s" % (self.account_id, account_cache))
         
         
     def meta_data(self):
@@ -60,72 +128,265 @@ class Connection():
         """
         result = self.get("Account")
         log.debug(pformat(result))
-        account_id = result["accountID"]
-        self.resource_base_url = "%s/%s" % (self.resource_base_url, account_id)
+        self.account_id = result["accountID"]
         log.info("Resource Base URL %s" % self.resource_base_url)
+        self.__store_account()
         
         
+    def __store_account(self):
+        if self.__account_cache is not None:
+            self.__account_cache.store(self.__account_key, self.account_id, self.__resource_meta)
     
-    def get(self, url="", query={}, name=None):
+    
+    def get_resource_base_url(self):
         """
-        Perform the GET request and return the parsed results
+        The base URL of the account's resources, looking the account up 
+        on first use
+        """
+        if not self.account_id:
+            with self.__account_lock:
+                if not self.account_id:
+                    self.__set_base_url()
+        return "%s/Account/%s" % (self.base_url, self.account_id)
+    
+    resource_base_url = property(fget=get_resource_base_url)
+    
+    
+    def get_rate_limiter(self):
+        """
+        The limiter pacing the requests of this connection
+        """
+        return self.__limiter
+    
+    rate_limiter = property(fget=get_rate_limiter)
+    
+    
+    def __record_resource(self, url):
+        """
+        Remember the url of each resource used, in the resource mappings
+        """
+        name = url.split("/")[0]
+        if not name or self.__resource_meta.has_key(name):
+            return
+        self.__resource_meta[name] = {"url": "%s/%s.json" % (self.resource_base_url, name),
+                                      "resource": name}
+        self.__store_account()
+    
+    
+    def add_hook(self, hook):
+        """
+        Call hook(record) with the RequestRecord of every request made
+        """
+        self.__hooks.append(hook)
+    
+    
+    def remove_hook(self, hook):
+        self.__hooks.remove(hook)
+    
+    
+    def __emit(self, record):
+        record.finish()
+        for hook in self.__hooks:
+            try:
+                hook(record)
+            except:
+                log.exception("Request hook %r failed" % hook)
+    
+    
+    def __request(self, method, url, body, headers, stream=False, resource=None):
         """
+        Send a request once the rate limiter allows it, retrying while the 
+        server answers 503 (rate limit exceeded).  A 503 means the request
+        was not processed, so writes are safe to send again as well.
         
-        resource = url if not name else name
-        qs = urllib.urlencode(query)
+        When streaming, the body of the returned response is left unread
+        (data is None) and the caller must close the response and pass it
+        to __finish_stream.
+        """
+        record = RequestRecord(method, resource, url)
+        attempt = 1
+        try:
+            while True:
+                record.waited += self.__limiter.acquire(method)
+                record.attempts = attempt
+                if stream:
+                    response, data = self.__transport.open(method, url, body, headers), None
+                else:
+                    response, data = self.__transport.request(method, url, body, headers)
+                    record.add(response.timing)
+                self.__limiter.update(response)
+                
+                record.status = response.status
+                if response.status == 503:
+                    record.throttled += 1
+                
+                if response.status != 503 or attempt >= self.MAX_RETRIES:
+                    if stream:
+                        response.record = record
+                    else:
+                        self.__emit(record)
+                    return response, data
+                
+                if stream:
+                    response.read()
+                    response.close()
+                    record.add(response.timing)
+                
+                wait = self.__limiter.backoff(response, attempt, method)
+                log.critical("Max API call rate exceeded - waiting %ds [try %d]" % (wait, attempt))
+                self.__limiter.throttle(wait)
+                attempt += 1
+        except Exception, e:
+            record.error = e
+            self.__emit(record)
+            raise
+    
+    
+    def __finish_stream(self, response):
+        response.close()
+        response.record.add(response.timing)
+        self.__emit(response.record)
+        
+    
+    def __check(self, status, reason, url, data):
+        """
+        Check the status of a response and return its parsed body
+        """
+        result = {}
+        if status == 200:
+            result = self.codec.loads(data)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("attributes %s" % data)
+            
+        elif status == 204:
+            raise EmptyResponseWarning("%d %s @ https://%s%s" % (status, reason, self.host, url))
+        
+        elif status == 404:
+            log.debug("%s returned 404 status" % url)
+            raise ResponseError(status, reason, self.host, url)
+        
+        elif status >= 400:
+            log.debug("OUTPUT %s" % data)
+            raise ResponseError(status, reason, self.host, url)
+        
+        return result
+    
+    
+    def __get_url(self, url, query):
+        """
+        Build the full request URL for a resource and query
+        """
+        qs = urllib.urlencode(sorted(query.items()))
         if qs:
             qs = "?%s" % qs
             
         if url in ["Account", "Control"]:
-            url = "%s/%s.json%s" % (self.base_url, url, qs)
-        else:
-            url = "%s/%s.json%s" % (self.resource_base_url, url, qs)
+            return "%s/%s.json%s" % (self.base_url, url, qs)
+        self.__record_resource(url)
+        return "%s/%s.json%s" % (self.resource_base_url, url, qs)
+    
+    
+    def get(self, url="", query={}, name=None):
+        """
+        Perform the GET request and return the parsed results
+        """
+        
+        resource = url if not name else name
+        cache_name = url.split("/")[0]
+        url = self.__get_url(url, query)
             
         log.debug("GET %s" % (url))
         
-        retries = 1
-        last_code = 503
-        result = {}
+        key = "%s %s" % (self.auth, url)
+        if self.__flights:
+            # Concurrent identical GETs share one request; each caller
+            # decodes the body itself, so no two share the decoded objects
+            status, reason, data = self.__flights.do(key, self.__fetch, key, url, cache_name)
+        else:
+            status, reason, data = self.__fetch(key, url, cache_name)
         
-        while retries < 4 and last_code == 503: 
-            self.__connection.connect()
-            request = self.__connection.request("GET", url, None, self.__headers)
-            response = self.__connection.getresponse()
-            data = response.read()
-            self.__connection.close()
+        result = self.__check(status, reason, url, data)
+        
+        if not result.has_key(resource):
+            raise EmptyResponseWarning("%d %s @ https://%s%s" % (status, reason, self.host, url))
+        return result[resource]
+    
+    
+    def __fetch(self, key, url, cache_name):
+        """
+        The status, reason and body of a GET, from the cache when fresh
+        """
+        entry = self.__cache.lookup(key) if self.__cache is not None else None
+        
+        if entry is not None and entry.fresh():
+            log.debug("GET %s served from cache" % (url))
+            return 200, "OK", entry.data
             
-            log.debug("GET %s status %d" % (url,response.status))
+        headers = self.__headers
+        if entry is not None:
+            headers = dict(headers)
+            headers.update(entry.conditions())
+        
+        response, data = self.__request("GET", url, None, headers, resource=cache_name)
+        status, reason = response.status, response.reason
+        
+        log.debug("GET %s status %d" % (url,status))
+        
+        if status == 304 and entry is not None:
+            self.__cache.refresh(entry)
+            status, data = 200, entry.data
             
-            last_code = response.status
+        elif status == 200 and self.__cache is not None:
+            self.__cache.store(key, cache_name, data, 
+                               etag=response.getheader("ETag"),
+                               last_modified=response.getheader("Last-Modified"))
+        return status, reason, data
+    
+    
+    def invalidate(self, url=None):
+        """
+        Drop the cached responses of the resource the url belongs to (ie,
+        "Item/12" drops every cached Item response), or all of them
+        """
+        if self.__cache is not None:
+            self.__cache.invalidate(url.split("/")[0] if url else None)
+    
+    
+    def stream(self, url="", query={}, name=None, chunk_size=64 * 1024):
+        """
+        Perform the GET request and yield the records of the resource one by 
+        one, decoding them as the response body arrives instead of reading
+        and parsing the whole body at once
+        """
+        resource = url if not name else name
+        resource_name = url.split("/")[0]
+        url = self.__get_url(url, query)
+        
+        log.debug("GET %s (streaming)" % (url))
+        
+        response, data = self.__request("GET", url, None, self.__headers, stream=True,
+                                        resource=resource_name)
+        try:
+            log.debug("GET %s status %d" % (url,response.status))
             
-            # Check the return status
-            if response.status == 200:
-                result = simplejson.loads(data)
-                log.debug("attributes %s" % data)
-                #if not int(result["@attributes"]["count"]):
-                #    raise EmptyResponseWarning("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-                
-            elif response.status == 204:
+            if response.status == 204:
                 raise EmptyResponseWarning("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
             
-            elif response.status == 503:
-                # Wait a minute
-                log.critical("Max API call rate exceeded - waiting 60s [try %d]" % (retries * 20))
-                time.sleep(retries * 20)
-                retries += 1
+            elif response.status != 200:
+                log.debug("OUTPUT %s" % response.read())
+                raise ResponseError(response.status, response.reason, self.host, url)
             
-            elif response.status == 404:
-                log.debug("%s returned 404 status" % url)
-                raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
+            records = RecordStream(response, chunk_size, decoder=self.codec.decoder())
+            for record in records.records(resource):
+                yield record
             
-            elif response.status >= 400:
-                _result = simplejson.loads(data)
-                log.debug("OUTPUT %s" % _result)
-                raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-            if not result.has_key(resource):
+            # Drain what is left after the object so the connection is re-used
+            response.read()
+            
+            if not records.found:
                 raise EmptyResponseWarning("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        return result[resource]
+        finally:
+            self.__finish_stream(response)
     
     
     
@@ -142,114 +403,58 @@ class Connection():
         return self.__resource_meta.get(resource_name,{}).get("resource", None)
         
         
-    def update(self, url, updates):
+    def __send(self, method, url, body=None):
         """
-        Make a PUT request to save updates
+        Make a write request to an account resource and return the parsed
+        results
+
+        The cached responses of the resource are dropped before the write is
+        sent and again once it has been answered (or has failed), as a GET
+        made while it was in flight may have stored the old record again.
         """
+        resource_name = url.split("/")[0]
         url = "%s/%s.json" % (self.resource_base_url, url)
-        log.debug("PUT %s" % (url))
-        self.__connection.connect()
+        log.debug("%s %s" % (method, url))
         
         put_headers = {"Content-Type": "application/json"}
         put_headers.update(self.__headers)
-        request = self.__connection.request("PUT", url, simplejson.dumps(updates), put_headers)
-        response = self.__connection.getresponse()
-        data = response.read()
-        self.__connection.close()
+        self.invalidate(resource_name)
+        try:
+            response, data = self.__request(method, url, body, put_headers, resource=resource_name)
+        finally:
+            self.invalidate(resource_name)
         
-        log.debug("PUT %s status %d" % (url,response.status))
+        log.debug("%s %s status %d" % (method, url, response.status))
         log.debug("OUTPUT: %s" % data)
         
-        result = {}
-        if response.status == 200:
-            result = simplejson.loads(data)
-        
-        elif response.status == 204:
-            raise EmptyResponseWarning("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        elif response.status == 404:
-            log.debug("%s returned 404 status" % url)
-            raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        elif response.status >= 400:
-            _result = simplejson.loads(data)
-            log.debug("OUTPUT %s" % _result)
-            raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        return result
+        return self.__check(response.status, response.reason, url, data)
+    
+    
+    def update(self, url, updates):
+        """
+        Make a PUT request to save updates
+        """
+        return self.__send("PUT", url, self.codec.dumps(updates))
+    
     
     def delete(self, url, name=None):
-        resource = url if not name else name
-        url = "%s/%s.json" % (self.resource_base_url, url)
-        log.debug("DELETE %s" % (url))
-        self.__connection.connect()
-        
-        put_headers = {"Content-Type": "application/json"}
-        put_headers.update(self.__headers)
-        request = self.__connection.request("DELETE", url, None, put_headers)
-        response = self.__connection.getresponse()
-        data = response.read()
-        self.__connection.close()
-        
-        log.debug("DELETE %s status %d" % (url,response.status))
-        log.debug("OUTPUT: %s" % data)
-        
-        result = {}
-        if response.status == 200:
-            result = simplejson.loads(data)
-        
-        elif response.status == 204:
-            raise EmptyResponseWarning("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        elif response.status == 404:
-            log.debug("%s returned 404 status" % url)
-            raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        elif response.status >= 400:
-            _result = simplejson.loads(data)
-            log.debug("OUTPUT %s" % _result)
-            raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        return result
+        return self.__send("DELETE", url)
     
-        
     
     def create(self, url, properties, name=""):
         resource = url if not name else name
-        url = "%s/%s.json" % (self.resource_base_url, url)
-        log.debug("POST %s" % (url))
         log.debug("Creating %s" % pformat(properties))
-        self.__connection.connect()
-        
-        put_headers = {"Content-Type": "application/json"}
-        put_headers.update(self.__headers)
-        request = self.__connection.request("POST", url, simplejson.dumps(properties), put_headers)
-        response = self.__connection.getresponse()
-        data = response.read()
-        self.__connection.close()
-        
-        log.debug("POST %s status %d" % (url,response.status))
-        log.debug("OUTPUT: %s" % data)
-        
-        result = {}
-        if response.status == 200:
-            result = simplejson.loads(data)
-        
-        elif response.status == 204:
-            raise EmptyResponseWarning("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        elif response.status == 404:
-            log.debug("%s returned 404 status" % url)
-            raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
-        elif response.status >= 400:
-            _result = simplejson.loads(data)
-            log.debug("OUTPUT %s" % _result)
-            raise HTTPException("%d %s @ https://%s%s" % (response.status, response.reason, self.host, url))
-        
+        result = self.__send("POST", url, self.codec.dumps(properties))
         return result[resource]
     
     
+    def close(self):
+        """
+        Close the transport (the pooled connections to the host)
+        """
+        self.__transport.close()
+    
+    
     def __repr__(self):
         return "Connection %s" % (self.host)
     
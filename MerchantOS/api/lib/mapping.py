@@ -9,6 +9,34 @@ class Mapping(dict):
         self.__dict__ = self
         dict.__init__(self, *args, **kwargs)
 
+
+class Record(dict):
+    """
+    '.' access to dictionary keys without a __dict__ pointing back at the
+    dictionary, so a Record is freed as soon as it is no longer referenced
+    (a Mapping is a reference cycle that only the garbage collector frees).
+    Nested dictionaries are wrapped when they are first read.
+    """
+    __slots__ = ()
+    
+    def __getattr__(self, name):
+        try:
+            value = self[name]
+        except KeyError:
+            raise AttributeError(name)
+        if isinstance(value, dict) and not isinstance(value, Record):
+            value = self[name] = Record(value)
+        return value
+    
+    def __setattr__(self, name, value):
+        self[name] = value
+    
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+
 if __name__ == "__main__":
     g = Mapping(myfield = "value")
     g.foo = "bar"
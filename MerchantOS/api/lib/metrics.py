@@ -0,0 +1,197 @@
+"""
+Metrics Module
+
+Instrumentation of the requests made by a Connection.  After every
+request the Connection hands a RequestRecord to each of its hooks (any
+callable).  RequestStats is a hook that aggregates the records into
+counters and latency histograms per method and resource:
+
+    stats = RequestStats()
+    api._connection.add_hook(stats)
+    ...
+    report(stats.snapshot())
+"""
+import time
+import bisect
+import logging
+import threading
+
+log = logging.getLogger("MerchantOS.metrics")
+
+
+class Timing(object):
+    """
+    Where the time of one HTTP exchange went, in seconds
+    """
+    __slots__ = ("connect", "first_byte", "body", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.connect = 0.0      # opening the socket (and the TLS handshake)
+        self.first_byte = 0.0   # sending the request until the response headers arrived
+        self.body = 0.0         # reading the body
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+
+class RequestRecord(object):
+    """
+    The outcome of one request, including its retries
+    """
+
+    def __init__(self, method, resource, url):
+        self.method = method
+        self.resource = resource
+        self.url = url
+        self.status = None
+        self.error = None
+        self.attempts = 0
+        self.throttled = 0      # 503 responses received
+        self.waited = 0.0       # time spent waiting for the rate limiter
+        self.latency = 0.0      # total time, retries and waits included
+        self.started = time.time()
+        self.connect = 0.0
+        self.first_byte = 0.0
+        self.body = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+    def finish(self):
+        self.latency = time.time() - self.started
+
+
+    def add(self, timing):
+        """
+        Account for the timing of one attempt
+        """
+        self.connect += timing.connect
+        self.first_byte += timing.first_byte
+        self.body += timing.body
+        self.bytes_in += timing.bytes_in
+        self.bytes_out += timing.bytes_out
+
+
+    def __repr__(self):
+        return "RequestRecord %s %s %s (%d attempts, %.3fs)" % (
+            self.method, self.url, self.status, self.attempts, self.latency)
+
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram of durations in seconds
+    """
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile (0-100)
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+
+    def to_dict(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"], self.counts))}
+
+
+
+class RequestStats(object):
+    """
+    Hook aggregating RequestRecords per (method, resource)
+    """
+    COUNTERS = ("requests", "errors", "attempts", "throttled", "bytes_in", "bytes_out")
+    TIMINGS = ("latency", "waited", "connect", "first_byte", "body")
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__series = {}
+
+
+    def __call__(self, record):
+        key = (record.method, record.resource)
+        with self.__lock:
+            series = self.__series.get(key)
+            if series is None:
+                series = self.__series[key] = {"counters": dict((c, 0) for c in self.COUNTERS),
+                                               "status": {},
+                                               "timings": dict((t, Histogram()) for t in self.TIMINGS)}
+            counters = series["counters"]
+            counters["requests"] += 1
+            counters["errors"] += 1 if (record.error is not None or (record.status or 0) >= 400) else 0
+            counters["attempts"] += record.attempts
+            counters["throttled"] += record.throttled
+            counters["bytes_in"] += record.bytes_in
+            counters["bytes_out"] += record.bytes_out
+
+            status = str(record.status) if record.status is not None else "error"
+            series["status"][status] = series["status"].get(status, 0) + 1
+
+            for name in self.TIMINGS:
+                series["timings"][name].observe(getattr(record, name))
+
+
+    def snapshot(self):
+        """
+        Return the collected metrics as plain data, keyed "METHOD Resource"
+        """
+        with self.__lock:
+            return dict(("%s %s" % key,
+                         {"counters": dict(series["counters"]),
+                          "status": dict(series["status"]),
+                          "timings": dict((name, histogram.to_dict())
+                                          for (name, histogram) in series["timings"].iteritems())})
+                        for (key, series) in self.__series.iteritems())
+
+
+    def totals(self):
+        """
+        Return the counters summed over every method and resource
+        """
+        totals = dict((c, 0) for c in self.COUNTERS)
+        with self.__lock:
+            for series in self.__series.itervalues():
+                for name, value in series["counters"].iteritems():
+                    totals[name] += value
+        return totals
+
+
+    def reset(self):
+        with self.__lock:
+            self.__series.clear()
+
+
+    def __repr__(self):
+        return "RequestStats %s" % self.totals()
@@ -0,0 +1,312 @@
+"""
+Connection Pool Module
+
+Keeps HTTPS connections to the MerchantOS API alive between requests so
+that a TCP and TLS handshake is only paid when a socket is first opened
+(or dropped by the server).  Connections are checked out for the
+duration of a single request, so any number of threads can share one
+pool - each gets a connection of its own while its request is in flight.
+
+A streamed response (see open) holds its connection until it is closed,
+and so does an enumerate(stream=True) until it is exhausted or closed.
+A request made while iterating such a stream - a prefetch, a get of a
+related record, another tenant's work on a shared pool - needs a second
+connection; when every connection is held, it waits checkout_timeout
+seconds for one and raises PoolTimeout rather than waiting forever on
+connections that are only released once it returns.
+
+Responses are requested gzip or deflate encoded and decoded as they are
+read, so the layers above only ever see plain bodies.
+"""
+import ssl
+import time
+import socket
+import logging
+import threading
+from httplib import HTTPConnection, HTTPSConnection, HTTPException, BadStatusLine
+from MerchantOS.api.lib.metrics import Timing
+from MerchantOS.api.lib.transport import Transport
+from MerchantOS.api.lib.compression import ACCEPT_ENCODING, ENCODINGS, Decompressor, \
+    compress, decompress
+
+log = logging.getLogger("MerchantOS.pool")
+
+# Requests the server can safely be sent twice
+IDEMPOTENT = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS"]
+
+
+class PoolTimeout(HTTPException):
+    """
+    No connection of the pool was freed in time
+    """
+    pass
+
+
+
+class ConnectionPool(Transport):
+    """
+    A bounded, thread-safe pool of persistent HTTPS connections to one host.
+    The default transport of a Connection.
+    """
+
+    def __init__(self, host, maxsize=10, timeout=60, secure=True, compress=True,
+                 compress_requests=None, checkout_timeout=60):
+        """
+        Constructor
+
+        @param host: The API host to connect to
+        @type host: String
+        @param maxsize: Maximum number of connections open to the host at once
+        @type maxsize: int
+        @param timeout: Socket timeout in seconds
+        @type timeout: int
+        @param secure: Use HTTPS - plain HTTP is only meant for local test servers
+        @type secure: bool
+        @param compress: Ask for gzip or deflate encoded responses
+        @type compress: bool
+        @param compress_requests: Gzip request bodies of at least this many
+                                  bytes, None to never - only for servers
+                                  accepting compressed bodies
+        @type compress_requests: int
+        @param checkout_timeout: Seconds to wait for a free connection when
+                                 all maxsize are in use, None to wait forever
+        @type checkout_timeout: float
+        """
+        self.host = host
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.secure = secure
+        self.compress = compress
+        self.compress_requests = compress_requests
+        self.checkout_timeout = checkout_timeout
+
+        # One context for every connection of the pool so certificates and
+        # cipher configuration are only loaded once
+        self.__context = None
+        if hasattr(ssl, "create_default_context"):
+            self.__context = ssl.create_default_context()
+
+        self.__lock = threading.Lock()
+        self.__freed = threading.Condition(self.__lock)
+        self.__in_use = 0
+        self.__idle = []
+
+
+    def __new_connection(self):
+        log.debug("Opening connection to %s" % self.host)
+        if not self.secure:
+            return HTTPConnection(self.host, timeout=self.timeout)
+        if self.__context is not None:
+            return HTTPSConnection(self.host, timeout=self.timeout, context=self.__context)
+        return HTTPSConnection(self.host, timeout=self.timeout)
+
+
+    def __checkout(self):
+        """
+        Wait for a free slot and hand out the most recently used idle
+        connection (its socket is the most likely to still be open)
+        """
+        with self.__lock:
+            if self.__in_use >= self.maxsize:
+                deadline = None
+                if self.checkout_timeout is not None:
+                    deadline = time.time() + self.checkout_timeout
+                while self.__in_use >= self.maxsize:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout("All %d connections to %s in use for %ss - is a stream "
+                                          "open while requests are made?"
+                                          % (self.maxsize, self.host, self.checkout_timeout))
+                    self.__freed.wait(remaining)
+            self.__in_use += 1
+            if self.__idle:
+                return self.__idle.pop()
+        try:
+            return self.__new_connection()
+        except:
+            self.__release()
+            raise
+
+
+    def __release(self):
+        with self.__lock:
+            self.__in_use -= 1
+            self.__freed.notify()
+
+
+    def __checkin(self, conn, reuse=True):
+        if reuse:
+            with self.__lock:
+                self.__idle.append(conn)
+        else:
+            conn.close()
+        self.__release()
+
+
+    def __encode(self, body, headers):
+        """
+        Add the Accept-Encoding header, and compress the body if large enough
+        """
+        if not self.compress and self.compress_requests is None:
+            return body, headers
+        headers = dict(headers)
+        if self.compress:
+            headers.setdefault("Accept-Encoding", ACCEPT_ENCODING)
+        if (body and self.compress_requests is not None and len(body) >= self.compress_requests
+                and "Content-Encoding" not in headers):
+            body = compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+
+    def __encoding(self, response):
+        encoding = (response.getheader("Content-Encoding") or "").strip().lower()
+        return encoding if encoding in ENCODINGS else None
+
+
+    def __send(self, method, url, body, headers, read):
+        """
+        Send a request on a pooled connection and wait for the response
+
+        A request that fails on a re-used connection is sent once more on a
+        fresh socket, since the server may have closed the idle keep-alive
+        connection in the meantime - but only if it is idempotent.  On a
+        re-used connection the request is written before anything can fail,
+        so a POST may already have reached the server and is never sent
+        again: it could create the record twice.
+        """
+        body, headers = self.__encode(body, headers)
+        conn = self.__checkout()
+        try:
+            while True:
+                reused = conn.sock is not None
+                timing = Timing()
+                timing.bytes_out = len(body or "")
+                try:
+                    start = time.time()
+                    if not reused:
+                        conn.connect()
+                    sent = time.time()
+                    conn.request(method, url, body, headers)
+                    response = conn.getresponse()
+                    received = time.time()
+                    data = response.read() if read else None
+
+                    timing.connect = sent - start
+                    timing.first_byte = received - sent
+                    if read:
+                        timing.bytes_in = len(data)
+                        encoding = self.__encoding(response)
+                        if encoding is not None:
+                            data = decompress(data, encoding)
+                        timing.body = time.time() - received
+                    response.timing = timing
+                    return conn, response, data
+                except (socket.error, BadStatusLine, HTTPException):
+                    conn.close()
+                    if not reused or method not in IDEMPOTENT:
+                        raise
+                    log.debug("Stale connection to %s - reconnecting" % self.host)
+        except:
+            self.__checkin(conn, reuse=False)
+            raise
+
+
+    def request(self, method, url, body=None, headers={}):
+        """
+        Send a request and read the response
+
+        @return: The response and the body that was read from it
+        @rtype: tuple(HTTPResponse, String)
+        """
+        conn, response, data = self.__send(method, url, body, headers, True)
+        self.__checkin(conn, reuse=not response.will_close)
+        return response, data
+
+
+    def open(self, method, url, body=None, headers={}):
+        """
+        Send a request and return the response with its body unread.  The
+        connection stays checked out until the response is closed, so a
+        pool of maxsize connections serves at most maxsize open streams.
+
+        @rtype: StreamedResponse
+        """
+        conn, response, data = self.__send(method, url, body, headers, False)
+        encoding = self.__encoding(response)
+        return StreamedResponse(response, lambda reuse: self.__checkin(conn, reuse),
+                                Decompressor(encoding) if encoding is not None else None)
+
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+
+    def __repr__(self):
+        return "ConnectionPool %s (max %d)" % (self.host, self.maxsize)
+
+
+
+class StreamedResponse(object):
+    """
+    A response whose body is read incrementally, and decoded if it is
+    compressed.  Closing it returns the connection to the pool, or drops it
+    if the body was not read to the end.
+    """
+
+    def __init__(self, response, release, decoder=None):
+        self._response = response
+        self._release = release
+        self._decoder = decoder
+        self.status = response.status
+        self.reason = response.reason
+        self.will_close = response.will_close
+        self.timing = response.timing
+
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+
+    def read(self, amt=None):
+        start = time.time()
+        try:
+            while True:
+                data = self._response.read(amt)
+                self.timing.bytes_in += len(data)
+                decoder = self._decoder
+                if decoder is None:
+                    return data
+                if amt is None or not data:
+                    self._decoder = None
+                    return decoder.decompress(data) + decoder.flush()
+                # A compressed chunk may not be enough to decode anything yet
+                data = decoder.decompress(data)
+                if data:
+                    return data
+        finally:
+            self.timing.body += time.time() - start
+
+
+    def close(self):
+        if self._release is None:
+            return
+        release, self._release = self._release, None
+        finished = self._response.isclosed()
+        if not finished:
+            self._response.close()
+        release(finished and not self.will_close)
+
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,134 @@
+"""
+Projection Module
+
+Reads only part of a resource: the named relations are loaded instead
+of load_relations=all, and every field not named is dropped from the
+records as soon as they are decoded, so it is never kept in the
+objects built from them:
+
+    for item in api.Item.enumerate(fields=["itemID", "upc", "ItemShops.ItemShop.shopID",
+                                           "ItemShops.ItemShop.qoh"],
+                                   relations=["ItemShops"]):
+        ...
+
+Fields are dotted paths.  A path through a list applies to each of its
+elements (and to the single object the API sends in place of a one
+element list).  A relation loaded but not named in the fields is kept
+whole, and without relations the load_relations of the query is left
+as it is.
+
+get_path reads the value at a dotted path, in which a list element is
+picked by its index ("Prices.ItemPrice.0.amount"); the single object in
+place of a list is its element 0.  The export module builds its rows
+with it.
+"""
+import simplejson
+
+from MerchantOS.api.lib.query import Query
+
+
+def get_path(value, path):
+    """
+    The value at a dotted path, None if it does not exist.  A single object
+    where the API would send a list of several counts as the list's element 0.
+    """
+    for part in path.split(".") if path else []:
+        if isinstance(value, list):
+            if not part.isdigit() or int(part) >= len(value):
+                return None
+            value = value[int(part)]
+        elif isinstance(value, dict):
+            if part in value:
+                value = value[part]
+            elif part == "0":
+                continue
+            else:
+                return None
+        else:
+            return None
+    return value
+
+
+def field_tree(paths):
+    """
+    Turn dotted paths into a tree of {name: subtree, or True to keep it whole}
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            if node.get(part) is True:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def prune(value, tree):
+    """
+    Keep only the fields of the tree
+    """
+    if isinstance(value, list):
+        return [prune(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    pruned = {}
+    for name, subtree in tree.iteritems():
+        if name in value:
+            pruned[name] = value[name] if subtree is True else prune(value[name], subtree)
+    return pruned
+
+
+
+class Projection(object):
+    """
+    The fields and relations read from a resource
+    """
+
+    def __init__(self, fields=None, relations=None, key=None):
+        """
+        Constructor
+
+        @param fields: Dotted paths of the fields kept, every field if None
+        @type fields: list
+        @param relations: Relations loaded, none if empty, the query's if None
+        @type relations: list
+        @param key: A field always kept (ie, the ID the objects are built from)
+        @type key: String
+        """
+        self.fields = list(fields) if fields is not None else None
+        self.relations = list(relations) if relations is not None else None
+        self.__tree = None
+        if self.fields is not None:
+            self.__tree = field_tree(self.fields)
+            for name in (self.relations or []) + ([key] if key else []):
+                self.__tree.setdefault(name, True)
+
+
+    def query(self, query=None):
+        """
+        A copy of the query loading only the relations of the projection
+        """
+        query = Query(query)
+        if self.relations is None:
+            return query
+        if self.relations:
+            query["load_relations"] = simplejson.dumps(self.relations)
+        else:
+            query.pop("load_relations", None)
+        return query
+
+
+    def prune(self, record):
+        """
+        The record without the fields outside the projection
+        """
+        if self.__tree is None:
+            return record
+        return prune(record, self.__tree)
+
+
+    def __repr__(self):
+        return "Projection %s, relations %s" % (self.fields or "all", self.relations)
@@ -0,0 +1,165 @@
+"""
+Query Module
+
+Builds and reads queries in the API filter syntax, where each filter is
+"<operator>,<operands>":
+
+    query = Query().since("timeStamp", datetime(2013, 8, 27)) \
+                   .between("itemID", 1000, 1999) \
+                   .where("categoryID", "IN", 3, 4) \
+                   .order_by("itemID") \
+                   .load_relations("ItemShops", "Category")
+
+    query.bounds("itemID")   # -> (1000, True, 1999, True)
+
+A Query is a dict of query parameters, so it can be passed anywhere a
+query dict is accepted.
+"""
+import simplejson
+from datetime import datetime, date
+
+from MerchantOS.api.lib.filters import FilterSet
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
+
+OPERATORS = ["=", "!=", ">", ">=", "<", "<=", "IN", "~", "><"]
+RANGE_OPERATORS = [">", ">=", "<", "<=", "><", "="]
+
+# Query parameters that are not filters
+CONTROL_PARAMS = ["load_relations", "orderby", "orderby_desc", "offset", "limit"]
+
+
+def parse_filter(value):
+    """
+    Split a query value in the API syntax (">=,5", "IN,[1,2]", "~,abc%",
+    "><,1,9" or a plain value) into (operator, operands)
+    """
+    if not isinstance(value, basestring):
+        return "=", [value]
+    op, sep, rest = value.partition(",")
+    if not sep or op not in OPERATORS:
+        return "=", [value]
+    if op == "IN":
+        return op, [v.strip() for v in rest.strip("[]").split(",") if v.strip()]
+    if op == "><":
+        return op, rest.split(",", 1)
+    return op, [rest]
+
+
+def format_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.strftime(TIME_FORMAT)
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+def format_filter(op, *operands):
+    """
+    Build a query value from an operator and its operands
+    """
+    operands = [format_value(v) for v in operands]
+    if op == "=":
+        return operands[0]
+    if op == "IN":
+        return "IN,[%s]" % ",".join(operands)
+    if op not in OPERATORS:
+        raise ValueError("Unknown filter operator '%s'" % op)
+    return "%s,%s" % (op, ",".join(operands))
+
+
+
+class Query(dict):
+    """
+    Query parameters, with builder methods that return the query itself
+    """
+
+    def __init__(self, query=None):
+        if isinstance(query, FilterSet):
+            query = query.query_dict()
+        dict.__init__(self, query or {})
+
+
+    def copy(self):
+        return Query(self)
+
+
+    def where(self, field, op, *operands):
+        self[field] = format_filter(op, *operands)
+        return self
+
+
+    def equals(self, field, value):
+        return self.where(field, "=", value)
+
+
+    def between(self, field, low, high):
+        """
+        low <= field <= high
+        """
+        return self.where(field, "><", low, high)
+
+
+    def since(self, field, value, inclusive=True):
+        return self.where(field, ">=" if inclusive else ">", value)
+
+
+    def until(self, field, value, inclusive=True):
+        return self.where(field, "<=" if inclusive else "<", value)
+
+
+    def order_by(self, field, desc=False):
+        self["orderby"] = field
+        if desc:
+            self["orderby_desc"] = 1
+        else:
+            self.pop("orderby_desc", None)
+        return self
+
+
+    def load_relations(self, *relations):
+        """
+        Load the named relations, or all of them when none are named
+        """
+        self["load_relations"] = simplejson.dumps(list(relations)) if relations else "all"
+        return self
+
+
+    def without(self, *fields):
+        """
+        A copy of the query without the filters on fields
+        """
+        query = self.copy()
+        for field in fields:
+            query.pop(field, None)
+        return query
+
+
+    def filters(self):
+        """
+        The filters of the query, as {field: (operator, operands)}
+        """
+        return dict((field, parse_filter(value)) for (field, value) in self.iteritems()
+                    if field not in CONTROL_PARAMS)
+
+
+    def bounds(self, field):
+        """
+        The range the filter on field allows, as (low, low_inclusive, high,
+        high_inclusive) with None for an open end.  The operands are
+        returned as strings.
+
+        @raise ValueError: The filter on field is not a range
+        """
+        if field not in self:
+            return None, True, None, True
+        op, operands = parse_filter(self[field])
+        if op not in RANGE_OPERATORS:
+            raise ValueError("The %s filter '%s' is not a range" % (field, self[field]))
+        if op == "=":
+            return operands[0], True, operands[0], True
+        if op == "><":
+            return operands[0], True, operands[1], True
+        if op in (">", ">="):
+            return operands[0], op == ">=", None, True
+        return None, True, operands[0], op == "<="
@@ -0,0 +1,179 @@
+"""
+Rate Limit Module
+
+Client side model of the MerchantOS leaky bucket.  Each request adds
+its cost to the bucket, which drains at the drip rate; a request that
+would overflow the bucket waits until enough has drained.  The level,
+size and drip rate reported by the server in the response headers
+replace the local estimate after every response, so requests are paced
+just under the limit instead of running into it and backing off.
+
+One limiter is shared by every Connection (and thread) using the same
+account credentials.
+"""
+import time
+import logging
+import threading
+
+log = logging.getLogger("MerchantOS.ratelimit")
+
+
+class RateLimiter(object):
+    """
+    Thread-safe leaky bucket
+    """
+    BUCKET_LEVEL_HEADER = "X-LS-API-Bucket-Level"
+    DRIP_RATE_HEADER = "X-LS-API-Drip-Rate"
+    RETRY_AFTER_HEADER = "Retry-After"
+
+    # Units a request adds to the bucket - writes are more expensive
+    COSTS = {"GET": 1}
+    WRITE_COST = 10
+
+    __registry = {}
+    __registry_lock = threading.Lock()
+
+    def __init__(self, capacity=60, drip_rate=1.0, margin=2):
+        """
+        Constructor
+
+        @param capacity: Size of the bucket, until the server reports it
+        @type capacity: float
+        @param drip_rate: Units drained per second, until the server reports it
+        @type drip_rate: float
+        @param margin: Units kept free below the capacity, as headroom for
+                       other clients of the account
+        @type margin: float
+        """
+        self.capacity = float(capacity)
+        self.drip_rate = float(drip_rate)
+        self.margin = margin
+        self.reported = False  # Set once the server has reported the bucket
+
+        self.__lock = threading.Lock()
+        self.__level = 0.0
+        self.__stamp = time.time()
+        self.__blocked_until = 0.0
+
+
+    @classmethod
+    def shared(cls, key, **kwargs):
+        """
+        Return the limiter for key (ie, the account), creating it on first use
+        """
+        with cls.__registry_lock:
+            limiter = cls.__registry.get(key)
+            if limiter is None:
+                limiter = cls.__registry[key] = cls(**kwargs)
+            return limiter
+
+
+    def cost(self, method):
+        return self.COSTS.get(method, self.WRITE_COST)
+
+
+    def __leak(self, now):
+        self.__level = max(0.0, self.__level - (now - self.__stamp) * self.drip_rate)
+        self.__stamp = now
+
+
+    def level(self):
+        with self.__lock:
+            self.__leak(time.time())
+            return self.__level
+
+
+    def acquire(self, method="GET"):
+        """
+        Block until the bucket has room for the request, then add its cost
+
+        @return: The number of seconds spent waiting
+        @rtype: float
+        """
+        cost = self.cost(method)
+        waited = 0.0
+        while True:
+            with self.__lock:
+                wait = self.__wait(cost, time.time())
+                if wait <= 0:
+                    self.__level += cost
+                    return waited
+
+            log.debug("Rate limit: waiting %.2fs" % wait)
+            time.sleep(wait)
+            waited += wait
+
+
+    def __wait(self, cost, now):
+        self.__leak(now)
+        wait = self.__blocked_until - now
+        if wait > 0:
+            return wait
+        limit = max(self.capacity - self.margin, cost)
+        return max(0.0, (self.__level + cost - limit) / self.drip_rate)
+
+
+    def delay(self, method="GET"):
+        """
+        Seconds until the bucket has room for the request, without taking
+        the room - 0 if it could be sent now
+        """
+        with self.__lock:
+            return self.__wait(self.cost(method), time.time())
+
+
+    def update(self, response):
+        """
+        Adopt the bucket state reported in the response headers
+        ("X-LS-API-Bucket-Level: 12/60", "X-LS-API-Drip-Rate: 1")
+        """
+        level = response.getheader(self.BUCKET_LEVEL_HEADER)
+        rate = response.getheader(self.DRIP_RATE_HEADER)
+        if not level and not rate:
+            return
+
+        with self.__lock:
+            try:
+                if level:
+                    current, capacity = level.split("/")
+                    self.__level = float(current)
+                    self.capacity = float(capacity)
+                    self.__stamp = time.time()
+                if rate:
+                    self.drip_rate = float(rate)
+                self.reported = True
+            except ValueError:
+                log.debug("Unable to parse rate limit headers %s, %s" % (level, rate))
+
+
+    def backoff(self, response, attempt, method="GET"):
+        """
+        Seconds to wait after a 503: the server's Retry-After if given, the
+        time to drain the request's cost from a full bucket if the bucket
+        is known, or an increasing fixed delay otherwise
+        """
+        retry_after = response.getheader(self.RETRY_AFTER_HEADER)
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        if self.reported:
+            return self.cost(method) / self.drip_rate
+        return attempt * 20
+
+
+    def throttle(self, wait):
+        """
+        The server rejected a request - treat the bucket as full and hold
+        back every request on the account for wait seconds
+        """
+        with self.__lock:
+            now = time.time()
+            self.__level = self.capacity
+            self.__stamp = now
+            self.__blocked_until = max(self.__blocked_until, now + wait)
+
+
+    def __repr__(self):
+        return "RateLimiter %.1f/%.0f @ %.2f/s" % (self.level(), self.capacity, self.drip_rate)
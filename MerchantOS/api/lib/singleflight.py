@@ -0,0 +1,80 @@
+"""
+Single Flight Module
+
+Coalesces identical concurrent calls: while a call for a key is in
+flight, other callers asking for the same key wait for it and get its
+result (or its exception) instead of making the call again.
+
+    flights = SingleFlight()
+    data = flights.do("GET /API/Account/42/Item/12.json", fetch, url)
+
+Only calls that overlap are shared - nothing is kept once a call
+returns, so this is not a cache.  Results are handed to every caller as
+is, so they should be immutable (ie, a response body rather than the
+objects decoded from it).
+"""
+import sys
+import logging
+import threading
+
+log = logging.getLogger("MerchantOS.singleflight")
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+
+class SingleFlight(object):
+    """
+    A group of calls, keyed by the caller
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        self.shared = 0     # calls answered by another caller's call
+
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Return fn(*args, **kwargs), or wait for the result of the call for
+        key already in flight
+        """
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            log.debug("Joined call in flight for %s" % key)
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+
+    def in_flight(self):
+        with self.__lock:
+            return len(self.__calls)
+
+
+    def __repr__(self):
+        return "SingleFlight (%d in flight, %d shared)" % (self.in_flight(), self.shared)
@@ -0,0 +1,146 @@
+"""
+Stream Module
+
+Incremental decoding of API responses.  A page response looks like
+
+    {"@attributes": {"count": "1523", ...}, "Item": [{...}, {...}, ...]}
+
+RecordStream reads the body in chunks and decodes the records of the
+resource array one at a time, so only the record being decoded (and
+the unread remainder of the current chunk) is held in memory, however
+large the page or its loaded relations are.
+"""
+import logging
+import simplejson
+
+log = logging.getLogger("MerchantOS.stream")
+
+WHITESPACE = " \t\n\r"
+
+
+class RecordStream(object):
+    """
+    Walks the top level object of a response body, yielding the records
+    stored under one key and skipping over every other value.
+    """
+
+    def __init__(self, fp, chunk_size=64 * 1024, decoder=None):
+        """
+        Constructor
+
+        @param fp: File-like object the body is read from
+        @type fp: file
+        @param chunk_size: Number of bytes read at a time
+        @type chunk_size: int
+        @param decoder: The simplejson decoder used for the values
+        @type decoder: JSONDecoder
+        """
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.found = False  # Set once the requested key was seen
+        self.bytes_read = 0
+        self.__read_size = chunk_size
+        self.__buf = ""
+        self.__pos = 0
+        self.__eof = False
+        self.__decoder = decoder or simplejson.JSONDecoder()
+
+
+    def __fill(self):
+        """
+        Append the next chunk to the unconsumed part of the buffer
+        """
+        if self.__eof:
+            return False
+        chunk = self.fp.read(self.__read_size)
+        if not chunk:
+            self.__eof = True
+            return False
+        self.bytes_read += len(chunk)
+        self.__buf = self.__buf[self.__pos:] + chunk
+        self.__pos = 0
+        return True
+
+
+    def __peek(self):
+        """
+        Return the next non-whitespace character without consuming it
+        """
+        while True:
+            buf, pos = self.__buf, self.__pos
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            self.__pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self.__fill():
+                raise ValueError("Unexpected end of JSON response")
+
+
+    def __expect(self, char):
+        if self.__peek() != char:
+            raise ValueError("Expected '%s' at position %d of the response" % (char, self.bytes_read))
+        self.__pos += 1
+
+
+    def __value(self):
+        """
+        Decode the next complete JSON value, reading more of the body
+        while the value is still incomplete
+        """
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buf, self.__pos)
+                # A value ending right at the end of the buffer may have
+                # been cut short (ie, a number) - make sure it is complete
+                if end < len(self.__buf) or self.__eof:
+                    self.__pos = end
+                    self.__read_size = self.chunk_size
+                    return value
+                if not self.__fill():
+                    continue
+            except ValueError:
+                if not self.__fill():
+                    raise
+                # Grow the reads for large values to avoid re-decoding
+                # the same prefix over and over
+                self.__read_size *= 2
+
+
+    def records(self, key):
+        """
+        Yield the record(s) stored under key: every element if the value
+        is an array, or the value itself if it is a single object
+        """
+        self.__expect("{")
+        while True:
+            char = self.__peek()
+            if char == "}":
+                self.__pos += 1
+                return
+            if char == ",":
+                self.__pos += 1
+                continue
+
+            name = self.__value()
+            self.__expect(":")
+            if name != key:
+                self.__value()
+                continue
+
+            self.found = True
+            if self.__peek() != "[":
+                yield self.__value()
+                continue
+
+            self.__pos += 1
+            while True:
+                char = self.__peek()
+                if char == "]":
+                    self.__pos += 1
+                    break
+                if char == ",":
+                    self.__pos += 1
+                    continue
+                yield self.__value()
@@ -0,0 +1,323 @@
+"""
+Transport Module
+
+The layer a Connection sends its requests through.  A transport has
+three methods:
+
+    request(method, url, body, headers) -> (response, body)
+    open(method, url, body, headers)    -> response, body unread
+    close()
+
+Responses have status, reason, will_close, timing, getheader(),
+getheaders(), read() and close().  ConnectionPool (pooled keep-alive
+HTTPS) is the default; this module adds:
+
+    MemoryTransport     canned responses (or a handler) answered in memory
+    RecordingTransport  wraps another transport and writes every exchange
+                        to a cassette file
+    ReplayTransport     answers from a cassette, with no network at all
+
+    transport = RecordingTransport(ConnectionPool(host), "traffic.jsonl")
+    api = ApiClient(host, token, user_id, transport=transport)
+    ...
+    api = ApiClient(host, token, user_id, transport=ReplayTransport("traffic.jsonl"))
+
+Cassettes hold one JSON exchange per line.  Request headers are not
+recorded, so credentials never end up in a cassette.
+"""
+import logging
+import threading
+import simplejson
+from cStringIO import StringIO
+from httplib import HTTPException, responses
+from urlparse import urlparse
+from MerchantOS.api.lib.metrics import Timing
+
+log = logging.getLogger("MerchantOS.transport")
+
+
+class CassetteError(HTTPException):
+    """
+    No recorded exchange matches a request
+    """
+    pass
+
+
+
+class Transport(object):
+    """
+    Base class of the transports
+    """
+
+    def request(self, method, url, body=None, headers={}):
+        """
+        Send a request and read the response
+
+        @return: The response and its body
+        @rtype: tuple(response, String)
+        """
+        raise NotImplementedError()
+
+
+    def open(self, method, url, body=None, headers={}):
+        """
+        Send a request and return the response with its body unread.  The
+        caller must close it.
+        """
+        raise NotImplementedError()
+
+
+    def close(self):
+        pass
+
+
+
+class Response(object):
+    """
+    A response held in memory
+    """
+
+    def __init__(self, status, body="", headers=[], reason=None):
+        self.status = status
+        self.reason = reason or responses.get(status, "")
+        self.will_close = False
+        self.timing = Timing()
+        self.__headers = list(headers.items() if isinstance(headers, dict) else headers)
+        self.__body = StringIO(body)
+        self.__closed = False
+
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for header, value in self.__headers:
+            if header.lower() == name:
+                return value
+        return default
+
+
+    def getheaders(self):
+        return list(self.__headers)
+
+
+    def read(self, amt=None):
+        data = self.__body.read() if amt is None else self.__body.read(amt)
+        self.timing.bytes_in += len(data)
+        return data
+
+
+    def isclosed(self):
+        return self.__closed
+
+
+    def close(self):
+        self.__closed = True
+
+
+    def __repr__(self):
+        return "Response %d %s" % (self.status, self.reason)
+
+
+
+class MemoryTransport(Transport):
+    """
+    Answers from responses registered with add, or from a handler
+    function(method, url, body, headers) returning (status, headers, body)
+    or None.  Requests nothing answers get a 404.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.requests = []      # (method, url, body) of every request, in order
+        self.__routes = {}
+        self.__lock = threading.Lock()
+
+
+    def add(self, method, url, body="", status=200, headers={}, reason=None):
+        """
+        Answer requests for url (a path, with or without the query) with
+        this response.  A body that is not a string is sent as JSON.
+        """
+        if not isinstance(body, basestring):
+            body = simplejson.dumps(body)
+        with self.__lock:
+            self.__routes[(method, url)] = (status, headers, body, reason)
+
+
+    def __answer(self, method, url, body, headers):
+        with self.__lock:
+            self.requests.append((method, url, body))
+            route = self.__routes.get((method, url)) or self.__routes.get((method, urlparse(url).path))
+        if route is not None:
+            status, response_headers, data, reason = route
+            return Response(status, data, response_headers, reason)
+        if self.handler is not None:
+            answer = self.handler(method, url, body, headers)
+            if answer is not None:
+                status, response_headers, data = answer
+                if not isinstance(data, basestring):
+                    data = simplejson.dumps(data)
+                return Response(status, data, response_headers)
+        log.debug("No response for %s %s" % (method, url))
+        return Response(404, "")
+
+
+    def request(self, method, url, body=None, headers={}):
+        response = self.__answer(method, url, body, headers)
+        return response, response.read()
+
+
+    def open(self, method, url, body=None, headers={}):
+        return self.__answer(method, url, body, headers)
+
+
+    def __repr__(self):
+        return "MemoryTransport (%d routes)" % len(self.__routes)
+
+
+
+class RecordingTransport(Transport):
+    """
+    Sends requests through another transport and appends every exchange
+    to a cassette file
+    """
+
+    def __init__(self, transport, path):
+        """
+        Constructor
+
+        @param transport: The transport the requests are sent through
+        @type transport: Transport
+        @param path: The cassette file, appended to
+        @type path: String
+        """
+        self.transport = transport
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__file = open(path, "a")
+
+
+    def __record(self, method, url, body, response, data):
+        exchange = {"method": method,
+                    "url": url,
+                    "body": body,
+                    "status": response.status,
+                    "reason": response.reason,
+                    "headers": response.getheaders(),
+                    "response": data}
+        line = simplejson.dumps(exchange)
+        with self.__lock:
+            self.__file.write(line + "\n")
+            self.__file.flush()
+
+
+    def request(self, method, url, body=None, headers={}):
+        response, data = self.transport.request(method, url, body, headers)
+        self.__record(method, url, body, response, data)
+        return response, data
+
+
+    def open(self, method, url, body=None, headers={}):
+        # The body is read up front so it can be recorded, then streamed
+        # to the caller from memory
+        streamed = self.transport.open(method, url, body, headers)
+        try:
+            data = streamed.read()
+        finally:
+            streamed.close()
+        self.__record(method, url, body, streamed, data)
+        response = Response(streamed.status, data, streamed.getheaders(), streamed.reason)
+        response.timing = streamed.timing
+        response.timing.bytes_in = 0
+        return response
+
+
+    def close(self):
+        self.transport.close()
+        with self.__lock:
+            self.__file.close()
+
+
+    def __repr__(self):
+        return "RecordingTransport %s -> %s" % (self.transport, self.path)
+
+
+
+class ReplayTransport(Transport):
+    """
+    Answers requests from a cassette.  Exchanges are matched on method, url
+    and body (or just method and url), and identical requests get the
+    recorded responses in the order they were recorded.
+    """
+
+    def __init__(self, path, loop=False):
+        """
+        Constructor
+
+        @param path: The cassette file
+        @type path: String
+        @param loop: Start over from the first recorded response once a
+                     request has used up its responses (ie, to replay the
+                     same traffic repeatedly when profiling)
+        @type loop: bool
+        """
+        self.path = path
+        self.loop = loop
+        self.__lock = threading.Lock()
+        self.__exchanges = {}
+        self.__replayed = {}
+        with open(path) as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                exchange = simplejson.loads(line)
+                for key in self.__keys(exchange["method"], exchange["url"], exchange.get("body")):
+                    self.__exchanges.setdefault(key, []).append(exchange)
+        log.debug("Loaded %d requests from %s" % (len(self.__exchanges), path))
+
+
+    def __keys(self, method, url, body):
+        return [(method, url, body), (method, url)]
+
+
+    def __answer(self, method, url, body):
+        with self.__lock:
+            for key in self.__keys(method, url, body):
+                exchanges = self.__exchanges.get(key)
+                if not exchanges:
+                    continue
+                index = self.__replayed.get(key, 0)
+                if index >= len(exchanges):
+                    if not self.loop:
+                        continue
+                    index = 0
+                self.__replayed[key] = index + 1
+                exchange = exchanges[index]
+                break
+            else:
+                raise CassetteError("No recorded response for %s %s in %s" % (method, url, self.path))
+        data = exchange["response"]
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        return Response(exchange["status"], data, [tuple(h) for h in exchange["headers"]],
+                        exchange.get("reason"))
+
+
+    def request(self, method, url, body=None, headers={}):
+        response = self.__answer(method, url, body)
+        return response, response.read()
+
+
+    def open(self, method, url, body=None, headers={}):
+        return self.__answer(method, url, body)
+
+
+    def rewind(self):
+        """
+        Replay every request from its first recorded response again
+        """
+        with self.__lock:
+            self.__replayed.clear()
+
+
+    def __repr__(self):
+        return "ReplayTransport %s" % self.path
@@ -0,0 +1,190 @@
+"""
+Workers Module
+
+A small thread pool and future type used to run API requests
+concurrently (page prefetching, bulk writes, ...).
+"""
+import sys
+import Queue
+import logging
+import threading
+
+log = logging.getLogger("MerchantOS.workers")
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Future(object):
+    """
+    The pending result of a call submitted to a WorkerPool
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__done = threading.Event()
+        self.__state = "pending"
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+
+
+    def start(self):
+        """
+        Mark the future as running.  Returns False if it was cancelled
+        before a worker got to it.
+        """
+        with self.__lock:
+            if self.__state != "pending":
+                return False
+            self.__state = "running"
+            return True
+
+
+    def cancel(self):
+        """
+        Cancel the call if it has not started yet
+        """
+        with self.__lock:
+            if self.__state != "pending":
+                return self.__state == "cancelled"
+            self.__state = "cancelled"
+        self.__finish()
+        return True
+
+
+    def set_result(self, result):
+        with self.__lock:
+            self.__result = result
+            self.__state = "finished"
+        self.__finish()
+
+
+    def set_exception(self, exc_info):
+        with self.__lock:
+            self.__exc_info = exc_info
+            self.__state = "finished"
+        self.__finish()
+
+
+    def __finish(self):
+        with self.__lock:
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                log.exception("Future callback failed")
+
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) once the future is finished or cancelled
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+
+    def done(self):
+        return self.__done.is_set()
+
+
+    def cancelled(self):
+        return self.__state == "cancelled"
+
+
+    def exception(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+        if self.__state == "cancelled":
+            raise CancelledError()
+        return self.__exc_info[1] if self.__exc_info else None
+
+
+    def result(self, timeout=None):
+        """
+        Wait for and return the result, re-raising any exception the call raised
+        """
+        if not self.__done.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+        if self.__state == "cancelled":
+            raise CancelledError()
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+
+
+class WorkerPool(object):
+    """
+    A fixed set of daemon threads executing submitted calls
+    """
+
+    def __init__(self, workers=4, name="MerchantOS-worker"):
+        """
+        Constructor
+
+        @param workers: Number of worker threads
+        @type workers: int
+        @param name: Prefix for the worker thread names
+        @type name: String
+        """
+        self.workers = max(1, workers)
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__run, name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            future, fn, args, kwargs = item
+            if not future.start():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) and return its Future
+        """
+        future = Future()
+        self.__queue.put((future, fn, args, kwargs))
+        return future
+
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the queued calls are done
+        """
+        for thread in self.__threads:
+            self.__queue.put(None)
+        if wait:
+            for thread in self.__threads:
+                thread.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+    def __repr__(self):
+        return "WorkerPool (%d workers)" % self.workers
@@ -0,0 +1,462 @@
+"""
+Mirror Module
+
+A local SQLite copy of selected resources.  Each mirrored resource gets
+a table keyed on its <name>ID, holding the JSON record plus indexed
+columns for the fields it is commonly filtered on:
+
+    mirror = LocalMirror(api, "/var/lib/pos/mirror.db",
+                         resources={"Item": ["upc", "categoryID", "timeStamp"],
+                                    "Shop": []})
+    mirror.refresh()
+    mirror.refresh_in_background(interval=300)
+
+    mirror.Item.get(1234)
+    mirror.Item.enumerate(query={"categoryID": "IN,[3,4]", "upc": "~,0123%"})
+
+Values are stored as the text the API sent, even when the client's codec
+turns numeric fields into numbers, so "~" filters match them as text (a
+UPC keeps its leading zeros).  =, != and IN compare the values as text;
+<, >, >=, <=, >< and orderby compare numeric values as numbers.
+
+The mirror has the same accessor surface as the ApiClient it wraps.
+While serve_local is set, reads of mirrored resources are answered from
+SQLite; everything else (and every write) goes to the API.  Refreshes
+are delta syncs (see the sync module), so deleted records stay in the
+mirror until the resource is reloaded.
+"""
+import re
+import logging
+import sqlite3
+import threading
+import simplejson
+
+from MerchantOS.api.lib.filters import FilterSet
+from MerchantOS.api.lib.query import Query, parse_filter, CONTROL_PARAMS
+from MerchantOS.api.lib.projection import Projection
+from MerchantOS.api.resources import CompactResourceObject
+from MerchantOS.api.sync import SyncEngine
+
+log = logging.getLogger("MerchantOS.mirror")
+
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+OPERATORS = {"=": "=", "!=": "!=", ">": ">", ">=": ">=", "<": "<", "<=": "<="}
+
+
+def _number(value):
+    """
+    Numeric strings as numbers, for the comparisons and orderings by value
+    """
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return value
+
+
+def _text(value):
+    """
+    A value as the text it was sent as, so the records decoded with numeric
+    fields (see the codec module) compare like the others
+    """
+    if value is None:
+        return None
+    if isinstance(value, float):
+        return unicode(repr(value))
+    return unicode(value)
+
+
+def _sql_number(value):
+    """
+    _number as an SQLite function - numbers SQLite cannot hold stay reals
+    """
+    value = _number(value)
+    if isinstance(value, (int, long)) and not -2 ** 63 <= value < 2 ** 63:
+        return float(value)
+    return value
+
+
+def match_filter(field, value):
+    """
+    Test a record value against a query value, for the non-indexed fields
+    """
+    op, operands = parse_filter(value)
+    if op == "IN":
+        return _text(field) in [_text(v) for v in operands]
+    if op == "~":
+        pattern = re.escape(operands[0]).replace("\\%", ".*").replace("\\_", ".")
+        return field is not None and re.match("^%s$" % pattern, unicode(field), re.I) is not None
+    if op == "=":
+        return _text(field) == _text(operands[0])
+    if op == "!=":
+        return _text(field) != _text(operands[0])
+    if op == "><":
+        return _number(operands[0]) <= _number(field) <= _number(operands[1])
+    field, operand = _number(field), _number(operands[0])
+    return {">": field > operand, ">=": field >= operand,
+            "<": field < operand, "<=": field <= operand}[op]
+
+
+
+class MirrorWatermarks(object):
+    """
+    Sync watermarks kept inside the mirror database, so the data and its
+    watermark are always committed together
+    """
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+
+    def get(self, name):
+        row = self.mirror._execute("SELECT watermark, seen FROM _watermarks WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], simplejson.loads(row[1])
+
+
+    def commit(self, name, watermark, seen):
+        self.mirror._execute("INSERT OR REPLACE INTO _watermarks VALUES (?, ?, ?)",
+                             (name, watermark, simplejson.dumps(seen)), commit=True)
+
+
+    def reset(self, name=None):
+        if name is None:
+            self.mirror._execute("DELETE FROM _watermarks", commit=True)
+        else:
+            self.mirror._execute("DELETE FROM _watermarks WHERE name = ?", (name,), commit=True)
+
+
+
+class MirroredAccessor(object):
+    """
+    Read access to one mirrored resource, with the ResourceAccessor surface
+    """
+
+    def __init__(self, mirror, resource_name, accessor):
+        self._mirror = mirror
+        self._accessor = accessor
+        self._resource_name = resource_name
+
+
+    def get(self, id, query={}):
+        row = self._mirror._execute('SELECT data FROM "%s" WHERE id = ?' % self._resource_name,
+                                    (_text(id),)).fetchone()
+        if row is None:
+            return None
+        return self.__realize(row[0])
+
+
+    def __realize(self, data):
+        return self._accessor._klass(self._accessor._connection, self._accessor._url,
+                                     simplejson.loads(data), None)
+
+
+    def __select(self, query):
+        """
+        Build the SQL for the filters on indexed columns and return the
+        remaining filters, which are applied to the records
+        """
+        if isinstance(query, FilterSet):
+            query = query.query_dict()
+        columns = self._mirror.columns(self._resource_name)
+        id_field = self._mirror.id_field(self._resource_name)
+
+        where, params, remaining = [], [], {}
+        for field, value in query.iteritems():
+            if field in CONTROL_PARAMS:
+                continue
+            column = "id" if field == id_field else field
+            if column != "id" and column not in columns:
+                remaining[field] = value
+                continue
+
+            # Values are stored as sent; only the comparisons by value
+            # convert them to numbers
+            op, operands = parse_filter(value)
+            operands = [_text(v) for v in operands]
+            if op == "IN":
+                where.append('"%s" IN (%s)' % (column, ",".join("?" * len(operands))))
+            elif op == "~":
+                where.append('"%s" LIKE ?' % column)
+            elif op in ("=", "!="):
+                where.append('"%s" %s ?' % (column, OPERATORS[op]))
+            elif op == "><":
+                where.append('number("%s") BETWEEN ? AND ?' % column)
+                operands = [_sql_number(v) for v in operands]
+            else:
+                where.append('number("%s") %s ?' % (column, OPERATORS[op]))
+                operands = [_sql_number(v) for v in operands]
+            params.extend(operands)
+
+        sql = 'SELECT data FROM "%s"' % self._resource_name
+        if where:
+            sql += " WHERE %s" % " AND ".join(where)
+
+        order = query.get("orderby")
+        if order:
+            order = "id" if order == id_field else order
+            if order == "id" or order in columns:
+                sql += ' ORDER BY number("%s")%s' % (order, " DESC" if query.get("orderby_desc") else "")
+            else:
+                remaining["orderby"] = query["orderby"]
+        else:
+            sql += " ORDER BY number(id)"
+        return sql, params, remaining
+
+
+    def enumerate(self, start=0, limit=0, query={}, max_per_call=100, workers=0, read_ahead=None,
+                  stream=False, raw=False, columns=None, compact=False, keyset=False,
+                  fields=None, relations=None):
+        """
+        Enumerate the mirrored records matching the query, in the shapes of
+        ResourceAccessor.enumerate.  max_per_call, workers, read_ahead and
+        stream only tune how the API is paged, so make no difference here.
+        The mirror holds the relations it was synced with: relations can
+        only name the ones kept by fields.
+        """
+        query = Query(query)
+        if relations is not None and fields is None:
+            raise TypeError("A mirror cannot load relations - name the fields kept with them")
+        if keyset:
+            key = keyset if isinstance(keyset, basestring) else self._mirror.id_field(self._resource_name)
+            if query.get("orderby", key) != key or query.get("orderby_desc"):
+                raise ValueError("Keyset pagination orders by %s" % key)
+            query.order_by(key)
+        build = self.__builder(raw, columns, compact, fields, relations)
+
+        sql, params, remaining = self.__select(query)
+        order = remaining.pop("orderby", None)
+        rows = self._mirror._execute(sql, params).fetchall()
+
+        records = (simplejson.loads(row[0]) for row in rows)
+        if remaining:
+            records = (r for r in records
+                       if all(match_filter(r.get(f), v) for (f, v) in remaining.iteritems()))
+        if order:
+            records = sorted(records, key=lambda r: _number(r.get(order)),
+                             reverse=bool(query.get("orderby_desc")))
+
+        for i, record in enumerate(records):
+            if i < start:
+                continue
+            if limit and i >= start + limit:
+                break
+            yield build(record)
+
+
+    def __builder(self, raw, columns, compact, fields, relations):
+        """
+        Return the function turning a record into what enumerate yields
+        """
+        if fields is not None:
+            projection = Projection(fields, relations, key=self._mirror.id_field(self._resource_name))
+            build = self.__builder(raw, columns, compact, None, None)
+            return lambda record: build(projection.prune(record))
+        if columns:
+            columns = tuple(columns)
+            return lambda record: tuple([record.get(column) for column in columns])
+        if raw:
+            return lambda record: record
+        klass = self._accessor._klass
+        if compact:
+            klass = CompactResourceObject.for_class(klass)
+        connection, url = self._accessor._connection, self._accessor._url
+        return lambda record: klass(connection, url, record, None)
+
+
+    def get_count(self, query={}):
+        return sum(1 for record in self.enumerate(query=query, raw=True))
+
+
+    def __getattr__(self, attrname):
+        # Writes and everything else go to the API
+        return getattr(self._accessor, attrname)
+
+
+
+class LocalMirror(object):
+    """
+    SQLite mirror of selected resources of an ApiClient
+    """
+
+    def __init__(self, api, path=":memory:", resources={}, serve_local=True):
+        """
+        Constructor
+
+        @param api: The client the resources are mirrored from
+        @type api: ApiClient
+        @param path: The SQLite database file
+        @type path: String
+        @param resources: The mirrored resources and, for each, either the list
+                          of indexed fields or a dict with "columns" and the
+                          "query" used when syncing
+        @type resources: dict
+        @param serve_local: Answer reads of mirrored resources from SQLite
+        @type serve_local: bool
+        """
+        self.api = api
+        self.path = path
+        self.serve_local = serve_local
+        self.__lock = threading.RLock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.create_function("number", 1, _sql_number)
+        self.__resources = {}
+        self.__thread = None
+        self.__stop = threading.Event()
+
+        self._execute("CREATE TABLE IF NOT EXISTS _watermarks "
+                      "(name TEXT PRIMARY KEY, watermark TEXT, seen TEXT)", commit=True)
+        for name, spec in resources.iteritems():
+            if not isinstance(spec, dict):
+                spec = {"columns": list(spec)}
+            self.add(name, spec.get("columns", []), spec.get("query", {}))
+
+
+    def _execute(self, sql, params=(), commit=False):
+        with self.__lock:
+            cursor = self.__db.execute(sql, params)
+            if commit:
+                self.__db.commit()
+            return cursor
+
+
+    def add(self, name, columns=[], query={}):
+        """
+        Mirror a resource, indexing the given fields
+        """
+        for identifier in [name] + list(columns):
+            if not IDENTIFIER.match(identifier):
+                raise ValueError("Invalid resource or field name '%s'" % identifier)
+
+        self.__resources[name] = {"columns": list(columns), "query": dict(query)}
+        with self.__lock:
+            existing = dict((row[1], row[2]) for row in self._execute('PRAGMA table_info("%s")' % name))
+            if "NUMERIC" in existing.values():
+                # Mirrored by an older version, which turned numeric strings
+                # into numbers - load it again
+                log.info("Rebuilding the mirror of %s" % name)
+                self._execute('DROP TABLE "%s"' % name)
+                MirrorWatermarks(self).reset(name)
+                existing = {}
+            if not existing:
+                # No column types, so values keep the type they were sent with
+                self._execute('CREATE TABLE "%s" (id PRIMARY KEY, data TEXT)' % name)
+                existing = {"id": "", "data": "TEXT"}
+            for column in columns:
+                if column not in existing:
+                    self._execute('ALTER TABLE "%s" ADD COLUMN "%s"' % (name, column))
+                self._execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON "%s" ("%s")'
+                              % (name, column, name, column))
+            self.__db.commit()
+
+
+    def resources(self):
+        return self.__resources.keys()
+
+
+    def columns(self, name):
+        return self.__resources[name]["columns"]
+
+
+    def id_field(self, name):
+        return "%s%sID" % (name[0].lower(), name[1:])
+
+
+    def __store(self, name, records):
+        columns = self.columns(name)
+        id_field = self.id_field(name)
+        sql = 'INSERT OR REPLACE INTO "%s" (id, data%s) VALUES (?, ?%s)' % (
+            name, "".join(', "%s"' % c for c in columns), ", ?" * len(columns))
+        rows = [[_text(r.get(id_field)), simplejson.dumps(r)] +
+                [_text(r.get(c)) if not isinstance(r.get(c), (dict, list)) else None for c in columns]
+                for r in records]
+        with self.__lock:
+            self.__db.executemany(sql, rows)
+
+
+    def refresh(self, name=None, batch_size=500):
+        """
+        Pull the changes of one (or every) mirrored resource since its last refresh
+        """
+        names = [name] if name else self.resources()
+        engine = SyncEngine(self.api, MirrorWatermarks(self), checkpoint=batch_size)
+        for name in names:
+            engine.add(name, query=self.__resources[name]["query"])
+
+        for name in names:
+            batch, count = [], 0
+            for obj in engine.sync(name, commit=False):
+                batch.append(obj.to_dict())
+                if len(batch) >= batch_size:
+                    self.__store(name, batch)
+                    count += len(batch)
+                    batch = []
+            self.__store(name, batch)
+            count += len(batch)
+            # The watermark goes in the same transaction as the last batch
+            engine.commit(name)
+            with self.__lock:
+                self.__db.commit()
+            log.info("Mirrored %d changed %s records" % (count, name))
+
+
+    def reload(self, name):
+        """
+        Drop the mirrored records of a resource and load it again in full
+        """
+        self._execute('DELETE FROM "%s"' % name)
+        MirrorWatermarks(self).reset(name)
+        self.refresh(name)
+
+
+    def refresh_in_background(self, interval=300):
+        """
+        Refresh every mirrored resource every interval seconds on a daemon thread
+        """
+        if self.__thread is not None:
+            return
+        self.__stop.clear()
+
+        def run():
+            while not self.__stop.is_set():
+                try:
+                    self.refresh()
+                except:
+                    log.exception("Background refresh of the mirror failed")
+                self.__stop.wait(interval)
+
+        self.__thread = threading.Thread(target=run, name="MerchantOS-mirror")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def stop(self):
+        """
+        Stop the background refresh
+        """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+
+    def close(self):
+        self.stop()
+        with self.__lock:
+            self.__db.close()
+
+
+    def __getattr__(self, attrname):
+        if attrname.startswith("_"):
+            raise AttributeError(attrname)
+        accessor = getattr(self.api, attrname)
+        if self.serve_local and attrname in self.__resources:
+            return MirroredAccessor(self, attrname, accessor)
+        return accessor
+
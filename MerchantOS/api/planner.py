@@ -0,0 +1,302 @@
+"""
+Planner Module
+
+Splits a large enumeration into disjoint ranges of an ID or time column
+("shards") that are enumerated in parallel and merged:
+
+    planner = QueryPlanner(api, workers=8)
+    for item in planner.enumerate("Item", query={"archived": "false"}):
+        ...
+
+    plan = planner.plan("Sale", Query().since("timeStamp", yesterday), field="timeStamp")
+
+Every shard is a "><,low,high" filter on the column, with consecutive
+shards meeting without a gap, so no row is returned twice or skipped.
+Each shard is paged from offset 0, so no request needs a deep offset.
+By default the range between the lowest and highest value is cut into
+equal spans; balanced plans look up the value at every shard_size-th
+row instead, so every shard holds the same number of rows however
+unevenly the values are spread.
+
+Rows are only split on the column at the time they are read.  When
+rows may change while a plan runs, use the ID column, which does not
+change.
+"""
+import sys
+import Queue
+import logging
+import threading
+from calendar import timegm
+from datetime import datetime
+
+from MerchantOS.api.lib.query import Query
+from MerchantOS.api.lib.workers import WorkerPool
+from MerchantOS.api.sync import parse_timestamp, format_timestamp
+
+log = logging.getLogger("MerchantOS.planner")
+
+# Objects handed from a shard's worker to the consumer at a time
+BATCH_SIZE = 100
+
+
+class IdColumn(object):
+    """
+    An integer column (ie, itemID)
+    """
+
+    def to_int(self, value):
+        return int(value)
+
+
+    def from_int(self, value):
+        return value
+
+
+
+class TimeColumn(object):
+    """
+    A timestamp column (ie, timeStamp), split by the second
+    """
+
+    def to_int(self, value):
+        if not isinstance(value, datetime):
+            value = parse_timestamp(value)
+        return timegm(value.timetuple())
+
+
+    def from_int(self, value):
+        return format_timestamp(datetime.utcfromtimestamp(value))
+
+
+
+class Shard(object):
+    """
+    One range of the column, and the query enumerating it
+    """
+
+    def __init__(self, index, low, high, query):
+        self.index = index
+        self.low = low
+        self.high = high
+        self.query = query
+
+
+    def __repr__(self):
+        return "Shard %d [%s, %s]" % (self.index, self.low, self.high)
+
+
+
+class QueryPlan(object):
+    """
+    The shards of a query
+    """
+
+    def __init__(self, resource, field, query, shards, count):
+        self.resource = resource
+        self.field = field
+        self.query = query
+        self.shards = shards
+        self.count = count  # rows matching the query when it was planned
+
+
+    def __len__(self):
+        return len(self.shards)
+
+
+    def __iter__(self):
+        return iter(self.shards)
+
+
+    def __repr__(self):
+        return "QueryPlan %s by %s: %d shards, %d rows" % (self.resource, self.field,
+                                                            len(self.shards), self.count)
+
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+
+class QueryPlanner(object):
+    """
+    Plans sharded enumerations and runs them on a worker pool
+    """
+
+    def __init__(self, api, workers=4, shard_size=1000):
+        """
+        Constructor
+
+        @param api: The client to query
+        @type api: ApiClient
+        @param workers: Number of shards enumerated at once
+        @type workers: int
+        @param shard_size: Rows per shard aimed for
+        @type shard_size: int
+        """
+        self.api = api
+        self.workers = workers
+        self.shard_size = shard_size
+
+
+    def __column(self, field, value):
+        if field.endswith("ID"):
+            return IdColumn()
+        try:
+            int(value)
+            return IdColumn()
+        except (TypeError, ValueError):
+            return TimeColumn()
+
+
+    def __first(self, accessor, query, offset=0):
+        for record in accessor.enumerate(start=offset, limit=1, query=query, raw=True):
+            return record
+        return None
+
+
+    def plan(self, resource, query=None, field=None, shards=None, balanced=False):
+        """
+        Split a query into shards
+
+        @param resource: The resource to enumerate (ie, "Item")
+        @type resource: String
+        @param query: The filters - a filter on field must be a range
+        @type query: dict
+        @param field: The ID or time column to split on, defaults to the
+                      resource ID ("itemID")
+        @type field: String
+        @param shards: Number of shards, defaults to one per shard_size rows
+        @type shards: int
+        @param balanced: Cut the shards at every shard_size-th row rather
+                         than into equal spans of values (one request per shard)
+        @type balanced: bool
+        @rtype: QueryPlan
+        """
+        query = Query(query)
+        field = field or "%s%sID" % (resource[0].lower(), resource[1:])
+        query.bounds(field)  # raises unless the filter on field is a range
+        accessor = getattr(self.api, resource)
+
+        count = accessor.get_count(query)
+        if not count:
+            return QueryPlan(resource, field, query, [], 0)
+
+        ascending = query.copy().order_by(field)
+        first = self.__first(accessor, ascending)
+        last = self.__first(accessor, query.copy().order_by(field, desc=True))
+        if first is None or last is None:
+            return QueryPlan(resource, field, query, [], 0)
+        column = self.__column(field, first[field])
+        low, high = column.to_int(first[field]), column.to_int(last[field])
+
+        shards = max(1, min(shards or -(-count // self.shard_size), high - low + 1))
+        if balanced:
+            step = -(-count // shards)
+            pool = WorkerPool(self.workers, name="MerchantOS-planner")
+            try:
+                probes = [pool.submit(self.__first, accessor, ascending, offset)
+                          for offset in xrange(step, count, step)]
+                probes = [probe.result() for probe in probes]
+            finally:
+                pool.shutdown()
+            cuts = [low] + [column.to_int(p[field]) for p in probes if p is not None] + [high + 1]
+        else:
+            cuts = [low + (high - low + 1) * i // shards for i in xrange(shards)] + [high + 1]
+
+        # Rows sharing a value go to the shard starting at it
+        cuts = sorted(set(cuts))
+        ranges = [(column.from_int(a), column.from_int(b - 1)) for (a, b) in zip(cuts, cuts[1:])]
+        plan = QueryPlan(resource, field, query,
+                         [Shard(i, a, b, ascending.copy().where(field, "><", a, b))
+                          for (i, (a, b)) in enumerate(ranges)],
+                         count)
+        log.debug(repr(plan))
+        return plan
+
+
+    def __put(self, queue, item, stop):
+        """
+        Hand item to the consumer, unless it stopped reading
+        """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+
+    def __run_shard(self, accessor, shard, kwargs, queue, stop):
+        try:
+            batch = []
+            for obj in accessor.enumerate(query=shard.query, **kwargs):
+                batch.append(obj)
+                if len(batch) >= BATCH_SIZE:
+                    if not self.__put(queue, batch, stop):
+                        return
+                    batch = []
+            if batch:
+                self.__put(queue, batch, stop)
+        except:
+            self.__put(queue, _Failure(sys.exc_info()), stop)
+        finally:
+            self.__put(queue, None, stop)
+
+
+    def run(self, plan, ordered=True, read_ahead=10, **kwargs):
+        """
+        Enumerate the shards of a plan on the worker pool
+
+        @param ordered: Yield the rows in column order, shard after shard;
+                        otherwise rows are yielded as soon as any shard
+                        returns them
+        @type ordered: bool
+        @param read_ahead: Batches of objects buffered per shard
+        @type read_ahead: int
+        @param kwargs: Passed to ResourceAccessor.enumerate (ie, raw=True)
+        """
+        if not plan.shards:
+            return
+        accessor = getattr(self.api, plan.resource)
+        stop = threading.Event()
+        if ordered:
+            queues = [Queue.Queue(read_ahead) for shard in plan.shards]
+        else:
+            queues = [Queue.Queue(read_ahead * self.workers)] * len(plan.shards)
+
+        pool = WorkerPool(min(self.workers, len(plan.shards)), name="MerchantOS-planner")
+        futures = [pool.submit(self.__run_shard, accessor, shard, kwargs, queue, stop)
+                   for (shard, queue) in zip(plan.shards, queues)]
+        try:
+            pending = len(plan.shards)
+            index = 0
+            while pending:
+                item = queues[index].get()
+                if item is None:
+                    pending -= 1
+                    if ordered:
+                        index += 1
+                elif isinstance(item, _Failure):
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                else:
+                    for obj in item:
+                        yield obj
+        finally:
+            # The consumer may stop early - stop the shards still running
+            stop.set()
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+
+    def enumerate(self, resource, query=None, field=None, shards=None, balanced=False,
+                  ordered=True, **kwargs):
+        """
+        Plan a query and enumerate its shards in parallel (see plan and run)
+        """
+        plan = self.plan(resource, query, field, shards, balanced)
+        for obj in self.run(plan, ordered=ordered, **kwargs):
+            yield obj
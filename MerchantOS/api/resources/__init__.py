@@ -1,19 +1,89 @@
+import imp
 import sys
 import logging
+import threading
+from collections import deque
 from pprint import pprint
-from MerchantOS.api.lib.mapping import Mapping
+from MerchantOS.api.lib.mapping import Mapping, Record
 from MerchantOS.api.lib.filters import FilterSet
+from MerchantOS.api.lib.query import Query
+from MerchantOS.api.lib.projection import Projection
 from MerchantOS.api.lib.connection import EmptyResponseWarning
+from MerchantOS.api.lib.workers import WorkerPool
 
 log = logging.getLogger("MerchantOS")
 
 
+class ResourceRegistry(object):
+    """
+    Maps resource names to their ResourceObject classes.  A class is either
+    registered explicitly or found as the class of the same name in the
+    module of the same name in this package; resources without one use
+    ResourceObject.  Every name is resolved once and then cached.
+    """
+    
+    def __init__(self, parent=None):
+        """
+        Constructor
+        
+        @param parent: Registry consulted for names not registered here
+        @type parent: ResourceRegistry
+        """
+        self._parent = parent
+        self.__classes = {}
+        self.__lock = threading.Lock()
+    
+    
+    def register(self, name, klass=None):
+        """
+        Declare the class of a resource.  Without klass, returns a class
+        decorator registering the decorated class.
+        """
+        if klass is None:
+            def decorator(klass):
+                self.register(name, klass)
+                return klass
+            return decorator
+        with self.__lock:
+            self.__classes[name] = klass
+        return klass
+    
+    
+    def __find(self, name):
+        if self._parent is not None:
+            return self._parent.resolve(name)
+        
+        # Only a missing module falls back to ResourceObject - errors raised
+        # while importing an existing one are not hidden
+        try:
+            imp.find_module(name, __path__)
+        except ImportError:
+            return ResourceObject
+        module = __import__("%s.%s" % (__name__, name), globals(), locals(), [name], 0)
+        return getattr(module, name, ResourceObject)
+    
+    
+    def resolve(self, name):
+        """
+        Return the class for a resource name
+        """
+        klass = self.__classes.get(name)
+        if klass is None:
+            klass = self.__find(name)
+            with self.__lock:
+                klass = self.__classes.setdefault(name, klass)
+        return klass
+
+
+
 class ResourceAccessor(object):
     """
     Provides methods that will create, get, and enumerate resourcesObjects.
     """
     
-    def __init__(self, resource_name, connection):
+    _registry = None
+    
+    def __init__(self, resource_name, connection, klass=None, registry=None):
         """
         Constructor
         
@@ -22,22 +92,27 @@ class ResourceAccessor(object):
         @type resource_name: String
         @param connection: Connection to the bigCommerce REST API
         @type connection: {Connection}
+        @param klass: The ResourceObject class, looked up in the registry if not given
+        @type klass: class
+        @param registry: Where the classes of this and related resources are
+                         looked up, defaults to the shared registry
+        @type registry: ResourceRegistry
         """
         log.debug("Resource Accessor for %s" % resource_name)
         self._parent = None
         self.__resource_name = resource_name
         self._connection = connection
-        
-        try:
-            mod = __import__('%s' % resource_name, globals(), locals(), [resource_name], -1)
-            self._klass = getattr(mod, resource_name)
-        except:
-            self._klass = ResourceObject
+        self._registry = registry
+        self._klass = klass or self.__registry().resolve(resource_name)
             
         # Work around for option values URL being incorrect
         self._url = self.__resource_name
             
          
+    def __registry(self):
+        return self._registry or registry
+    
+    
     def __get_page(self, offset, limit, query={}):
         """
         Get specific pages
@@ -50,7 +125,131 @@ class ResourceAccessor(object):
         return [result] if isinstance(result, dict) else result
     
     
-    def enumerate(self, start=0, limit=0, query={}, max_per_call=100):
+    def __stream_page(self, offset, limit, query={}):
+        """
+        Get a specific page, decoding its records as they arrive
+        """
+        log.debug("Streaming Page")
+        _query = {"offset": offset, "limit": limit}
+        
+        _query.update(query)
+        return self._connection.stream(self._url, _query)
+    
+    
+    def __get_page_or_empty(self, offset, limit, query={}):
+        try:
+            return self.__get_page(offset, limit, query)
+        except EmptyResponseWarning:
+            return []
+    
+    
+    def __projection(self, fields=None, relations=None):
+        if fields is None and relations is None:
+            return None
+        return Projection(fields, relations, key="%s%sID" % (self._url[0].lower(), self._url[1:]))
+    
+    
+    def __builder(self, raw=False, columns=None, compact=False, projection=None):
+        """
+        Return the function turning a record into what enumerate yields
+        """
+        if projection is not None and projection.fields is not None:
+            build = self.__builder(raw, columns, compact)
+            return lambda res: build(projection.prune(res))
+        if columns:
+            columns = tuple(columns)
+            return lambda res: tuple([res.get(column) for column in columns])
+        if raw:
+            return lambda res: res
+        klass = CompactResourceObject.for_class(self._klass) if compact else self._klass
+        return lambda res: klass(self._connection, self._url, res, self._parent)
+    
+    
+    def __enumerate_parallel(self, start, requested_items, query, max_per_call, workers, read_ahead, build):
+        """
+        Fetch the pages of an enumeration on a worker pool, keeping at most
+        read_ahead pages requested ahead of the consumer, and yield the
+        objects in page order
+        """
+        total = self.get_count(query)
+        stop = min(total, start + requested_items)
+        log.debug("Prefetching %d %s with %d workers" % (stop - start, self.__resource_name, workers))
+        
+        offsets = iter(xrange(start, stop, max_per_call))
+        pending = deque()
+        pool = WorkerPool(workers, name="MerchantOS-prefetch")
+        try:
+            for offset in offsets:
+                pending.append(pool.submit(self.__get_page_or_empty, offset, 
+                                           min(max_per_call, stop - offset), query))
+                if len(pending) >= read_ahead:
+                    break
+            
+            while pending:
+                page = pending.popleft().result()
+                
+                # Keep the read-ahead buffer full while this page is consumed
+                for offset in offsets:
+                    pending.append(pool.submit(self.__get_page_or_empty, offset, 
+                                               min(max_per_call, stop - offset), query))
+                    break
+                
+                for res in page:
+                    yield build(res)
+        finally:
+            # The consumer may stop early - drop the pages not yet requested
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+    
+    
+    def __enumerate_keyset(self, start, requested_items, query, max_per_call, key, get_page, build):
+        """
+        Page by key instead of offset: each page asks for the rows whose key
+        is above the last one seen, in key order
+        """
+        query = Query(query)
+        if query.get("orderby", key) != key or query.get("orderby_desc"):
+            raise ValueError("Keyset pagination orders by %s" % key)
+        low, low_inclusive, high, high_inclusive = query.bounds(key)
+        if high is not None and not high_inclusive:
+            high = int(high) - 1
+        query.order_by(key)
+        
+        offset = start
+        while requested_items > 0:
+            # Every page keeps the upper bound of the query
+            page_size = min(max_per_call, requested_items)
+            if low is None and high is None:
+                page_query = query.without(key)
+            elif low is None:
+                page_query = query.copy().until(key, high)
+            elif high is None:
+                page_query = query.copy().since(key, low, low_inclusive)
+            else:
+                lowest = int(low) if low_inclusive else int(low) + 1
+                if lowest > int(high):
+                    return
+                page_query = query.copy().between(key, lowest, high)
+            
+            count = 0
+            try:
+                for res in get_page(offset, page_size, page_query):
+                    count += 1
+                    requested_items -= 1
+                    low, low_inclusive = res[key], False
+                    yield build(res)
+            except EmptyResponseWarning:
+                return
+            
+            if count < page_size:
+                return
+            offset = 0
+    
+    
+    def enumerate(self, start=0, limit=0, query={}, max_per_call=100, workers=0, read_ahead=None,
+                  stream=False, raw=False, columns=None, compact=False, keyset=False,
+                  fields=None, relations=None):
         """
         Enumerate resources
         
@@ -62,26 +261,83 @@ class ResourceAccessor(object):
         @type query: FilterSet
         @param max_per_call: Number of items to return per request
         @type max_per_call: int
+        @param workers: Number of pages to fetch concurrently.  When set, the
+                        total is counted up front and pages are prefetched in
+                        parallel; 0 fetches one page at a time
+        @type workers: int
+        @param read_ahead: Maximum number of pages requested ahead of the
+                           consumer, defaults to twice the workers
+        @type read_ahead: int
+        @param stream: Decode the records of each page as they arrive, keeping
+                       memory flat however large the pages are (ignored
+                       when pages are prefetched by workers).  Each page
+                       holds a pooled connection until it is consumed,
+                       so requests made meanwhile need another one
+                       (see the pool module)
+        @type stream: bool
+        @param raw: Yield the records as plain dicts, without building objects
+        @type raw: bool
+        @param columns: Yield a tuple of these fields for each record
+        @type columns: list
+        @param compact: Yield slotted CompactResourceObjects
+        @type compact: bool
+        @param keyset: Page by primary key ("itemID" > the last one seen,
+                       ordered by itemID) instead of by offset, so every page
+                       costs the same however deep the enumeration goes, and
+                       rows changing during the enumeration are neither
+                       skipped nor repeated.  The name of another unique,
+                       numeric key can be given instead of True.  Pages are
+                       fetched one at a time (workers are ignored)
+        @type keyset: bool
+        @param fields: Keep only these fields (dotted paths, ie 
+                       "ItemShops.ItemShop.qoh") of each record, dropping
+                       the others as the records are decoded
+        @type fields: list
+        @param relations: Load only these relations (see the projection module)
+        @type relations: list
         """
         _query = {}
         if query:
             _query = query
         
+        projection = self.__projection(fields, relations)
+        if projection is not None:
+            _query = projection.query(_query)
             
         requested_items = limit if limit else sys.maxint
         max_per_call = min(max_per_call, 100)
         max_per_call = min(requested_items, max_per_call)
         
+        build = self.__builder(raw, columns, compact, projection)
+        
+        if keyset:
+            key = keyset if isinstance(keyset, basestring) else \
+                "%s%sID" % (self.__resource_name[0].lower(), self.__resource_name[1:])
+            get_page = self.__stream_page if stream else self.__get_page
+            for res in self.__enumerate_keyset(start, requested_items, _query, max_per_call, 
+                                               key, get_page, build):
+                yield res
+            return
+        
+        if workers:
+            read_ahead = max(read_ahead or workers * 2, 1)
+            for res in self.__enumerate_parallel(start, requested_items, _query, 
+                                                 max_per_call, workers, read_ahead, build):
+                yield res
+            return
+        
+        get_page = self.__stream_page if stream else self.__get_page
         offset = start
          
-        #while current_page < total_pages and requested_items:
-        while requested_items:
+        while requested_items > 0:
+            # The last page only asks for the items still wanted
+            page_size = min(max_per_call, requested_items)
             try:
-                for res in self.__get_page(offset, max_per_call, _query):
+                for res in get_page(offset, page_size, _query):
                     requested_items -= 1
-                    yield self._klass(self._connection, self._url, res, self._parent)
+                    yield build(res)
                 
-                offset = offset + max_per_call
+                offset = offset + page_size
                 
                 
             # If the response was empty - we are done
@@ -92,10 +348,18 @@ class ResourceAccessor(object):
                     
 
 
-    def get(self, id, query={}):
+    def get(self, id, query={}, fields=None, relations=None):
+        """
+        Get a resource by ID, with only the fields and relations given (see enumerate)
+        """
         url = "%s/%s" % (self._url, id)
+        projection = self.__projection(fields, relations)
+        if projection is not None:
+            query = projection.query(query)
         try:
             result = self._connection.get(url, query, name=self.__resource_name)
+            if projection is not None:
+                result = projection.prune(result)
             return self._klass(self._connection, self._url, result, self._parent)
         except:
             return None
@@ -104,20 +368,123 @@ class ResourceAccessor(object):
     def create(self, properties, opts={}):
         try:
             result = self._connection.create(self._url, properties, name=self.__resource_name)
-            print result
             return self._klass(self._connection, self._url, result, self._parent)
         except:
             return None
         pass
     
-    def get_count(self, query={}):
+    def __inflate_batch(self, batch, relation, accessor, key):
+        """
+        Load relation for one batch of objects with "key IN" queries on the 
+        related resource, and store it in each object's fields
+        """
+        ids = []
+        for obj in batch:
+            id = obj._fields.get(key)
+            if id is not None and str(id) not in ids:
+                ids.append(str(id))
+        if not ids:
+            return
         
-        if query:
+        log.debug("Loading %s for %d %s objects" % (relation, len(ids), self._url))
+        related = {}
+        for res in accessor.enumerate(query={key: "IN,[%s]" % ",".join(ids)}, raw=True):
+            related.setdefault(str(res.get(key)), []).append(res)
+        
+        for obj in batch:
+            if obj._fields.get(key) is None:
+                continue
+            found = related.get(str(obj._fields[key]), [])
+            sub_resource = obj.sub_resources.get(relation)
+            
+            # Not a declared sub resource - store it as load_relations would
+            if sub_resource is None:
+                obj._fields[relation] = {accessor._url: found}
+                continue
+            
+            # The class registered for the related resource, in the compact
+            # type when the objects are compact
+            klass = sub_resource.get("klass") or accessor._klass
+            if isinstance(obj, CompactResourceObject):
+                klass = CompactResourceObject.for_class(klass)
+            found = [klass(self._connection, accessor._url, res, obj) for res in found]
+            if sub_resource.get("single", False):
+                obj._fields[relation] = found[0] if found else None
+            else:
+                obj._fields[relation] = found
+    
+    
+    def prefetch(self, objects, relation, resource=None, key=None, batch_size=100):
+        """
+        Load a relation for many objects in a few bulk requests instead of
+        one request per object, and yield the objects (in order) once it is
+        loaded.  Reading the relation afterwards makes no request.
+        
+            for item in api.Item.prefetch(api.Item.enumerate(), "ItemShops"):
+                item.ItemShops["ItemShop"]
+        
+        Declared sub resources are stored as their ResourceObjects; other
+        relations are stored in the load_relations layout, with the records
+        always in a list ({"ItemShop": [...]}).
+        
+        @param objects: Objects of this resource (list or generator)
+        @type objects: iterable
+        @param relation: Name of the relation field (ie, "ItemShops")
+        @type relation: String
+        @param resource: The related resource, defaults to the relation name
+                         without its plural "s" (ie, "ItemShop")
+        @type resource: String
+        @param key: Field of the related resource referencing these objects,
+                    defaults to this resource's ID field (ie, "itemID")
+        @type key: String
+        @param batch_size: Number of objects loaded per bulk query
+        @type batch_size: int
+        """
+        if resource is None:
+            resource = relation[:-1] if relation.endswith("s") else relation
+        if key is None:
+            key = "%s%sID" % (self._url[0].lower(), self._url[1:])
+        accessor = ResourceAccessor(resource, self._connection,
+                                    klass=self.__registry().resolve(resource),
+                                    registry=self._registry)
+        
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                self.__inflate_batch(batch, relation, accessor, key)
+                for obj in batch:
+                    yield obj
+                batch = []
+        
+        if batch:
+            self.__inflate_batch(batch, relation, accessor, key)
+            for obj in batch:
+                yield obj
+    
+    
+    def inflate(self, objects, relation, resource=None, key=None, batch_size=100):
+        """
+        Load a relation for all objects right away, see prefetch
+        
+        @return: The objects
+        @rtype: list
+        """
+        return list(self.prefetch(objects, relation, resource, key, batch_size))
+    
+    
+    def get_count(self, query={}):
+        """
+        Return the number of resources matching the query, as reported in 
+        the @attributes of a one item page
+        """
+        if isinstance(query, FilterSet):
             _query = query.query_dict()
         else:
-            _query = query
-        result = self._connection.get("%s/%s" % (self._url, "count"), _query)
-        return result.get("count")
+            _query = dict(query)
+        _query.update({"offset": 0, "limit": 1})
+        result = self._connection.get(self._url, _query, name="@attributes")
+        return int(result.get("count", 0))
     
     def filters(self):
         try:
@@ -147,30 +514,20 @@ class SubResourceAccessor(ResourceAccessor):
         
     
 
-class ResourceObject(object):
+class BaseResourceObject(object):
     """
-    The realized resource instance type.
+    Field access, updates and persistence shared by the realized resource types
     """
+    __slots__ = ()
+    
     writeable = [] # list of properties that are writeable
     read_only = [] # list of properties that are read_only
     sub_resources = {}  # list of properties that are subresources
     can_create = False  # If create is supported
     can_update = False
     
-    def __init__(self, connection, url, fields, parent):
-        #  Very important!! These two lines must be first to support 
-        # customized getattr and setattr
-        self._fields = fields or dict()
-        self._updates = {} # the fields to update
-        
-        self._parent = parent
-        self._connection = connection
-        
-        _name = "%s%s" % (url[0].lower(), url[1:])
-        self._url = "%s/%s" % (url, self._fields["%sID" % _name])
-        log.debug("Resource Object URL: %s" % self._url)
-        
-        
+    _mapping = Mapping  # type nested dicts are wrapped in for . access
+    
     def __getattr__(self, attrname):
         """
         Override get access to look up values in the updates first, 
@@ -181,7 +538,7 @@ class ResourceObject(object):
         
         # If the value was set, when asked give this value,
         # not the original value
-        if self._updates.has_key(attrname):
+        if self._updates and self._updates.has_key(attrname):
             return self._updates[attrname]
         
         if not self._fields.has_key(attrname):
@@ -213,8 +570,8 @@ class ResourceObject(object):
                     self._fields[attrname] = _con.get("")
                     
             # Cast all dicts to Mappings - for . access
-            elif isinstance(data, dict):
-                val = Mapping(data)
+            elif isinstance(data, dict) and not isinstance(data, self._mapping):
+                val = self._mapping(data)
                 self._fields[attrname] = val
                 
             return self._fields[attrname]
@@ -234,6 +591,8 @@ class ResourceObject(object):
             if name in self.read_only:
                 raise AttributeError("Attempt to assign to a read-only property '%s'" % name)
             elif not self.writeable or name in self.writeable:
+                if self._updates is None:
+                    self._updates = {}
                 self._updates.update({name:value})
         else:
             object.__setattr__(self, name, value)
@@ -265,3 +624,75 @@ class ResourceObject(object):
         return self._fields
     
 
+
+class ResourceObject(BaseResourceObject):
+    """
+    The realized resource instance type.
+    """
+    
+    def __init__(self, connection, url, fields, parent):
+        #  Very important!! These two lines must be first to support 
+        # customized getattr and setattr
+        self._fields = fields or dict()
+        self._updates = {} # the fields to update
+        
+        self._parent = parent
+        self._connection = connection
+        
+        _name = "%s%s" % (url[0].lower(), url[1:])
+        self._url = "%s/%s" % (url, self._fields["%sID" % _name])
+        log.debug("Resource Object URL: %s" % self._url)
+
+
+
+class CompactResourceObject(BaseResourceObject):
+    """
+    Slotted resource instance type for bulk reads: no per-instance __dict__,
+    no updates dictionary until a field is set, and nested dicts wrapped in
+    Records, which create no reference cycles.
+    """
+    __slots__ = ("_fields", "_updates", "_parent", "_connection", "_url")
+    
+    _mapping = Record
+    
+    def __init__(self, connection, url, fields, parent):
+        self._fields = fields or dict()
+        self._updates = None
+        
+        self._parent = parent
+        self._connection = connection
+        self._url = "%s/%s" % (url, self._fields["%s%sID" % (url[0].lower(), url[1:])])
+    
+    
+    __compact_classes = {}
+    
+    @classmethod
+    def for_class(cls, klass):
+        """
+        Return the compact type of a resource class, carrying its field
+        and sub resource declarations, methods and properties - everything
+        but the special (__dunder__) attributes its classes define
+        """
+        if issubclass(klass, CompactResourceObject):
+            return klass
+        if klass is ResourceObject:
+            return cls
+        compact = cls.__compact_classes.get(klass)
+        if compact is None:
+            attributes = {}
+            # Base classes first, so their subclasses' attributes win
+            for base in reversed(klass.__mro__):
+                if base in ResourceObject.__mro__:
+                    continue
+                for name, value in vars(base).iteritems():
+                    if not (name.startswith("__") and name.endswith("__")):
+                        attributes[name] = value
+            attributes["__slots__"] = ()
+            compact = type("Compact%s" % klass.__name__, (cls,), attributes)
+            cls.__compact_classes[klass] = compact
+        return compact
+
+
+
+# Default registry, shared by all clients
+registry = ResourceRegistry()
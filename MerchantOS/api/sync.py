@@ -0,0 +1,289 @@
+"""
+Sync Module
+
+Incremental (delta) synchronisation of resources.  For every source the
+engine keeps a high-water mark - the latest timeStamp (or other time
+column) it has handed out - and only asks for the rows changed since:
+
+    store = WatermarkStore("/var/lib/pos/sync.json")
+    engine = SyncEngine(api, store, since=datetime(2013, 8, 27))
+    engine.add("OrderLine", query={"checkedIn": ">,0"})
+    engine.add("SaleLine", column="createTime")
+    engine.add("Item", query={"load_relations": "all"})
+
+    for name, obj in engine.run():
+        ...
+
+Queries start an overlap window before the watermark so rows written
+with a slightly skewed clock are not missed; rows already handed out in
+that window (same key and same time) are skipped.  Rows are requested
+in time order and the watermark is committed to the store as they are
+consumed, so a crashed sync resumes from the last committed row.
+
+Pages are cut on the time column rather than by offset: each page asks
+for the rows at or after the latest time seen so far.  A row changed
+during the sync moves to the end of the time order; with offsets, every
+row behind it would shift back a place and one would fall between two
+pages, never to be read again once the watermark has passed it.
+"""
+import os
+import logging
+import threading
+import simplejson
+from datetime import datetime, timedelta
+
+log = logging.getLogger("MerchantOS.sync")
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
+
+
+def parse_timestamp(value):
+    """
+    Parse an API timestamp ("2013-08-27T16:01:15-07:00") into a naive UTC datetime
+    """
+    stamp = datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    offset = value[19:].lstrip(".0123456789")
+    if offset and offset != "Z":
+        hours, minutes = offset[1:].split(":")
+        delta = timedelta(hours=int(hours), minutes=int(minutes))
+        stamp = stamp - delta if offset[0] == "+" else stamp + delta
+    return stamp
+
+
+def format_timestamp(stamp):
+    return stamp.strftime(TIME_FORMAT)
+
+
+
+class WatermarkStore(object):
+    """
+    Committed watermarks, persisted to a JSON file.  Every commit replaces
+    the file atomically, so a crash leaves either the old or the new state.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__state = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.__state = simplejson.load(fp)
+
+
+    def get(self, name):
+        """
+        Return (watermark, seen) for a source: the committed timestamp
+        string (or None) and the {key: timestamp} of the rows handed out
+        within the overlap window
+        """
+        with self.__lock:
+            state = self.__state.get(name, {})
+            return state.get("watermark"), dict(state.get("seen", {}))
+
+
+    def commit(self, name, watermark, seen):
+        with self.__lock:
+            self.__state[name] = {"watermark": watermark, "seen": seen}
+            tmp = "%s.tmp" % self.path
+            with open(tmp, "w") as fp:
+                simplejson.dump(self.__state, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+
+
+    def reset(self, name=None):
+        """
+        Forget the watermark of a source (or of all of them)
+        """
+        with self.__lock:
+            if name is None:
+                self.__state.clear()
+            else:
+                self.__state.pop(name, None)
+
+
+
+class SyncSource(object):
+    """
+    One delta query: a resource, the time column tracked and extra filters
+    """
+
+    def __init__(self, name, resource, column, query, key):
+        self.name = name
+        self.resource = resource
+        self.column = column
+        self.query = query
+        self.key = key
+
+
+    def __repr__(self):
+        return "SyncSource %s (%s.%s)" % (self.name, self.resource, self.column)
+
+
+
+class SyncEngine(object):
+    """
+    Runs the delta queries of its sources and keeps their watermarks
+    """
+
+    def __init__(self, api, store, overlap=timedelta(minutes=5), since=None, checkpoint=500,
+                 page_size=100):
+        """
+        Constructor
+
+        @param api: The client to query
+        @type api: ApiClient
+        @param store: Where watermarks are committed
+        @type store: WatermarkStore
+        @param overlap: How far before the watermark each query starts
+        @type overlap: timedelta
+        @param since: Starting point (UTC) of sources without a watermark,
+                      None to load them in full
+        @type since: datetime
+        @param checkpoint: Commit the watermark every so many rows
+        @type checkpoint: int
+        @param page_size: Rows requested per page
+        @type page_size: int
+        """
+        self.api = api
+        self.store = store
+        self.overlap = overlap
+        self.since = since
+        self.checkpoint = checkpoint
+        self.page_size = page_size
+        self.__sources = []
+        self.__pending = {}
+
+
+    def add(self, resource, name=None, column="timeStamp", query=None, key=None):
+        """
+        Add a source to the sync
+
+        @param resource: The resource to query (ie, "Item")
+        @type resource: String
+        @param name: Name the watermark is stored under, defaults to the
+                     resource - needed when one resource is synced twice
+        @type name: String
+        @param column: The time column compared against the watermark
+        @type column: String
+        @param query: Additional filters
+        @type query: dict
+        @param key: Primary key field, defaults to "<resource>ID"
+        @type key: String
+        """
+        name = name or resource
+        if name in [source.name for source in self.__sources]:
+            raise ValueError("A sync source named %s already exists" % name)
+        key = key or "%s%sID" % (resource[0].lower(), resource[1:])
+        self.__sources.append(SyncSource(name, resource, column, dict(query or {}), key))
+        return self
+
+
+    def sources(self):
+        return list(self.__sources)
+
+
+    def __start(self, watermark):
+        start = parse_timestamp(watermark) - self.overlap if watermark else self.since
+        return format_timestamp(start) if start is not None else None
+
+
+    def __rows(self, source, start):
+        """
+        Yield the rows from start on in time order, a page at a time, each
+        page starting at the latest time of the one before
+        """
+        accessor = getattr(self.api, source.resource)
+        low, offset = start, 0
+        while True:
+            query = dict(source.query)
+            query["orderby"] = source.column
+            if low is not None:
+                query[source.column] = ">=,%s" % low
+            page = list(accessor.enumerate(start=offset, limit=self.page_size,
+                                           max_per_call=self.page_size, query=query))
+            for obj in page:
+                yield obj
+            if len(page) < self.page_size:
+                return
+
+            stamps = [obj.to_dict().get(source.column) for obj in page]
+            stamps = [format_timestamp(parse_timestamp(s)) for s in stamps if s]
+            top = max(stamps) if stamps else None
+            if top is None or (low is not None and top <= low):
+                # A whole page of rows of one time - step over them
+                offset += len(page)
+            else:
+                low, offset = top, 0
+
+
+    def __commit(self, source, watermark, seen):
+        if watermark is None:
+            return
+        # Only the rows inside the next overlap window can come back
+        floor = format_timestamp(parse_timestamp(watermark) - self.overlap)
+        seen = dict((k, v) for (k, v) in seen.iteritems() if v >= floor)
+        self.store.commit(source.name, watermark, seen)
+        log.debug("Committed %s watermark %s" % (source.name, watermark))
+
+
+    def sync(self, name, commit=True):
+        """
+        Yield the rows of one source changed since its watermark
+
+        @param commit: Commit the final watermark once the rows are
+                       exhausted; otherwise it is committed by commit(name),
+                       once the caller has stored the last rows
+        @type commit: bool
+        """
+        source = [s for s in self.__sources if s.name == name][0]
+        watermark, seen = self.store.get(source.name)
+        start = self.__start(watermark)
+        log.info("Syncing %s since %s" % (source.name, start or "the beginning"))
+
+        count = 0
+        for obj in self.__rows(source, start):
+            fields = obj.to_dict()
+            id = str(fields.get(source.key))
+            stamp = fields.get(source.column)
+            if stamp is not None:
+                stamp = format_timestamp(parse_timestamp(stamp))
+                if seen.get(id) == stamp:
+                    continue
+                seen[id] = stamp
+                if watermark is None or stamp > watermark:
+                    watermark = stamp
+
+            yield obj
+
+            # The consumer asked for the next row - the previous one is done
+            count += 1
+            if count % self.checkpoint == 0:
+                self.__commit(source, watermark, seen)
+
+        if commit:
+            self.__commit(source, watermark, seen)
+        else:
+            self.__pending[source.name] = (source, watermark, seen)
+        log.info("Synced %d %s rows" % (count, source.name))
+
+
+    def commit(self, name):
+        """
+        Commit the final watermark of a sync run with commit=False
+        """
+        pending = self.__pending.pop(name, None)
+        if pending is not None:
+            self.__commit(*pending)
+
+
+    def run(self):
+        """
+        Sync every source in turn, yielding (source name, object) pairs
+        """
+        for source in self.__sources:
+            for obj in self.sync(source.name):
+                yield source.name, obj
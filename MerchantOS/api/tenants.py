@@ -0,0 +1,323 @@
+"""
+Tenants Module
+
+Runs the work of many accounts from one process.  The clients of all
+the accounts send through one shared ConnectionPool and their calls are
+run by one shared set of worker threads, while every account keeps its
+own rate limiter, as the API meters each account separately:
+
+    manager = TenantManager("api.merchantos.com", workers=32,
+                            account_cache=AccountCache("/var/cache/merchantos.json"))
+    for account in accounts:
+        manager.add(account.name, account.token, account.user_id, weight=account.weight)
+
+    counts = manager.map(lambda api: api.Item.get_count())
+    done = manager.each("acme", "Item", handle_item, query={"archived": "false"})
+
+Calls are queued per account, and workers take the next call from the
+accounts in smooth weighted round robin: an account of weight 3 gets
+three turns for every turn of an account of weight 1, interleaved rather
+than in bursts.  An account whose bucket is full is passed over until it
+has drained, so no worker sleeps on one account's limit while others
+have calls ready, and no account runs more than max_running calls at
+once, however many it has queued.
+
+Enumerations (each) run one batch per turn, so a large catalog takes
+its turns between the calls of the other accounts instead of holding a
+worker until it is done.
+"""
+import sys
+import time
+import logging
+import threading
+from collections import deque
+
+from MerchantOS.api import ApiClient
+from MerchantOS.api.lib.pool import ConnectionPool
+from MerchantOS.api.lib.workers import Future
+
+log = logging.getLogger("MerchantOS.tenants")
+
+# Longest a worker waits before looking at the accounts again
+IDLE_WAIT = 1.0
+
+
+class Tenant(object):
+    """
+    One account: its client, its queued calls and its scheduling state
+    """
+
+    def __init__(self, name, client, weight=1):
+        self.name = name
+        self.client = client
+        self.weight = weight
+        self.limiter = client._connection.rate_limiter
+        self.queue = deque()
+        self.running = 0
+        self.completed = 0
+        self.credit = 0         # smooth weighted round robin
+        self.held_until = 0.0   # passed over until its bucket has drained
+
+
+    def __repr__(self):
+        return "Tenant %s (weight %d, %d queued, %d running, %d completed)" % (
+            self.name, self.weight, len(self.queue), self.running, self.completed)
+
+
+
+class TenantManager(object):
+    """
+    Clients of many accounts sharing a connection pool and worker threads
+    """
+
+    def __init__(self, host, workers=16, pool_size=None, max_running=4, secure=True,
+                 transport=None, **kwargs):
+        """
+        Constructor
+
+        @param host: The API host, the same for every account
+        @type host: String
+        @param workers: Number of worker threads, shared by all the accounts
+        @type workers: int
+        @param pool_size: Keep-alive connections kept to the host, defaults
+                          to one per worker
+        @type pool_size: int
+        @param max_running: Most calls of one account running at once
+        @type max_running: int
+        @param transport: Shared by all the clients, defaults to a
+                          ConnectionPool to the host
+        @type transport: Transport
+        @param kwargs: Passed to every ApiClient (ie, account_cache, cache, codec, hooks)
+        """
+        self.host = host
+        self.max_running = max_running
+        self.transport = transport or ConnectionPool(host, maxsize=pool_size or workers, secure=secure)
+        self.__secure = secure
+        self.__kwargs = kwargs
+        self.__tenants = {}
+        self.__order = []
+        self.__cond = threading.Condition()
+        self.__closing = False
+        self.__accepting = True
+        self.__threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self.__run, name="MerchantOS-tenants-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+
+    def add(self, name, token, user_id, weight=1, **kwargs):
+        """
+        Add an account
+
+        @param name: Name the account's calls are submitted under
+        @type name: String
+        @param weight: Turns the account gets for every turn of an account of weight 1
+        @type weight: int
+        @param kwargs: Passed to the account's ApiClient, over the manager's
+        @return: The account's client
+        @rtype: ApiClient
+        """
+        if weight < 1:
+            raise ValueError("The weight of %s must be at least 1" % name)
+        options = dict(self.__kwargs)
+        options.update(kwargs)
+        client = ApiClient(self.host, token, user_id, secure=self.__secure,
+                           transport=self.transport, **options)
+        with self.__cond:
+            if name in self.__tenants:
+                raise ValueError("Account %s already added" % name)
+            tenant = self.__tenants[name] = Tenant(name, client, int(weight))
+            self.__order.append(tenant)
+        log.debug("Added %r" % tenant)
+        return client
+
+
+    def remove(self, name):
+        """
+        Remove an account, cancelling its queued calls
+        """
+        with self.__cond:
+            tenant = self.__tenants.pop(name)
+            self.__order.remove(tenant)
+            queued, tenant.queue = tenant.queue, deque()
+        for future, fn, args, kwargs in queued:
+            future.cancel()
+
+
+    def __getitem__(self, name):
+        """
+        The client of an account
+        """
+        return self.__tenants[name].client
+
+
+    def __contains__(self, name):
+        return name in self.__tenants
+
+
+    def tenants(self):
+        """
+        The accounts, in the order they were added
+        """
+        with self.__cond:
+            return list(self.__order)
+
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        Queue fn(client, *args, **kwargs) for an account and return its Future
+        """
+        future = Future()
+        with self.__cond:
+            if not self.__accepting:
+                raise RuntimeError("%r is closed" % self)
+            tenant = self.__tenants.get(name)
+            if tenant is None:
+                raise KeyError("Unknown account %s" % name)
+            tenant.queue.append((future, fn, args, kwargs))
+            self.__cond.notify()
+        return future
+
+
+    def map(self, fn, names=None):
+        """
+        Queue fn(client) for every account (or the named ones)
+
+        @return: The Future of each account's call
+        @rtype: dict
+        """
+        if names is None:
+            names = [tenant.name for tenant in self.tenants()]
+        return dict((name, self.submit(name, fn)) for name in names)
+
+
+    def each(self, name, resource, callback, batch_size=100, **kwargs):
+        """
+        Call callback(obj) for every object of an enumeration of the
+        account's resource, a batch of objects per turn.  The callback
+        runs on the workers.
+
+        @param kwargs: Passed to ResourceAccessor.enumerate
+        @return: Future of the number of objects handled
+        @rtype: Future
+        """
+        done = Future()
+        done.start()
+        state = {"iterator": None, "count": 0}
+
+        def pull(api):
+            if state["iterator"] is None:
+                state["iterator"] = getattr(api, resource).enumerate(**kwargs)
+            batch = 0
+            for obj in state["iterator"]:
+                callback(obj)
+                batch += 1
+                if batch >= batch_size:
+                    break
+            return batch
+
+        def handle(future):
+            try:
+                batch = future.result()
+                state["count"] += batch
+                if batch < batch_size:
+                    done.set_result(state["count"])
+                else:
+                    self.submit(name, pull).add_done_callback(handle)
+            except:
+                done.set_exception(sys.exc_info())
+
+        self.submit(name, pull).add_done_callback(handle)
+        return done
+
+
+    def __next(self, now):
+        """
+        The account whose call runs next, or None and the seconds to wait
+        """
+        while True:
+            ready = [tenant for tenant in self.__order
+                     if tenant.queue and tenant.running < self.max_running
+                     and tenant.held_until <= now]
+            if not ready:
+                held = [tenant.held_until - now for tenant in self.__order
+                        if tenant.queue and tenant.held_until > now]
+                return None, min(held + [IDLE_WAIT]) if held else None
+
+            best = max(ready, key=lambda tenant: tenant.credit + tenant.weight)
+            delay = best.limiter.delay()
+            if delay > 0:
+                best.held_until = now + delay
+                continue
+
+            for tenant in ready:
+                tenant.credit += tenant.weight
+            best.credit -= sum(tenant.weight for tenant in ready)
+            return best, None
+
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while True:
+                    tenant, wait = self.__next(time.time())
+                    if tenant is not None:
+                        break
+                    # Running calls may queue more (ie, the next batch of each)
+                    if self.__closing and not any(t.queue or t.running for t in self.__order):
+                        self.__cond.notify_all()
+                        return
+                    self.__cond.wait(wait)
+                future, fn, args, kwargs = tenant.queue.popleft()
+                tenant.running += 1
+
+            try:
+                if future.start():
+                    try:
+                        future.set_result(fn(tenant.client, *args, **kwargs))
+                    except:
+                        future.set_exception(sys.exc_info())
+            finally:
+                with self.__cond:
+                    tenant.running -= 1
+                    tenant.completed += 1
+                    self.__cond.notify()
+
+
+    def close(self, wait=True):
+        """
+        Stop the workers once the queued calls are done (or cancel them),
+        then close the shared connections
+        """
+        with self.__cond:
+            self.__closing = True
+            self.__accepting = wait
+            queued = []
+            if not wait:
+                for tenant in self.__order:
+                    queued.extend(tenant.queue)
+                    tenant.queue = deque()
+            self.__cond.notify_all()
+        for future, fn, args, kwargs in queued:
+            future.cancel()
+        if wait:
+            for thread in self.__threads:
+                thread.join()
+        with self.__cond:
+            self.__accepting = False
+        self.transport.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def __repr__(self):
+        return "TenantManager %s (%d accounts, %d workers)" % (self.host, len(self.__tenants),
+                                                              len(self.__threads))
@@ -0,0 +1,509 @@
+"""
+Fake MerchantOS Server
+
+A local stand-in for the MerchantOS REST API, for benchmarks: it serves
+generated Items (with ItemShops and Category relations), Shops and
+Categories under /API/Account/<id>/<Resource>.json, over plain HTTP.
+
+It mimics what the client depends on:
+    - offset/limit paging and the @attributes count
+    - a single record returned as an object instead of a list
+    - filters in the API syntax and orderby / orderby_desc
+    - load_relations ("all" or a JSON list of relations)
+    - PUT, POST and DELETE of single records
+    - optionally, the cost of deep offsets
+    - optionally, gzip / deflate encoded responses (Accept-Encoding),
+      gzip encoded request bodies and a bandwidth limit
+    - the leaky bucket: X-LS-API-Bucket-Level / X-LS-API-Drip-Rate
+      headers, and 503 with Retry-After once the bucket overflows
+
+    server = FakeServer(items=10000, latency=0.01)
+    server.start()
+    api = ApiClient(server.host, "token", "user", secure=False)
+"""
+import os
+import re
+import sys
+import math
+import time
+import bisect
+import random
+import zlib
+import socket
+import logging
+import threading
+import urlparse
+import simplejson
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MerchantOS.api.lib.query import CONTROL_PARAMS, TIME_FORMAT
+
+log = logging.getLogger("benchmarks.fakeserver")
+
+ACCOUNT_ID = "42"
+PATH = re.compile(r"^/API/Account/%s/(\w+)(?:/(\d+))?\.json$" % ACCOUNT_ID)
+
+# The server reads filters on its own rather than with the client's
+# parser, so a bug in that parser shows up as a wrong answer
+FILTER = re.compile(r"^(!=|>=|<=|><|>|<|=|IN|~),(.*)$", re.S)
+
+
+def _key(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _filter(value):
+    """
+    The operator and operands of a filter value, as the API reads them
+    """
+    match = FILTER.match(value)
+    if match is None:
+        return "=", [value]
+    op, rest = match.groups()
+    if op == "IN":
+        return op, [v.strip() for v in rest.strip().lstrip("[").rstrip("]").split(",")]
+    if op == "><":
+        return op, rest.split(",", 1)
+    return op, [rest]
+
+
+def _matches(field, value):
+    """
+    Test a stored value against a filter: = and IN compare strings, the
+    ranges compare numbers as numbers, ~ is a case insensitive LIKE
+    """
+    op, operands = _filter(value)
+    if field is None:
+        return op == "!="
+    if not isinstance(field, basestring):
+        field = simplejson.dumps(field) if isinstance(field, (dict, list)) else unicode(field)
+    if op == "=":
+        return field == operands[0]
+    if op == "!=":
+        return field != operands[0]
+    if op == "IN":
+        return field in operands
+    if op == "~":
+        pattern = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in operands[0])
+        return re.match("%s$" % pattern, field, re.I | re.S) is not None
+    if op == "><":
+        return _key(operands[0]) <= _key(field) <= _key(operands[1])
+    field, operand = _key(field), _key(operands[0])
+    return {">": field > operand, ">=": field >= operand,
+            "<": field < operand, "<=": field <= operand}[op]
+
+
+def id_field(resource):
+    return "%s%sID" % (resource[0].lower(), resource[1:])
+
+
+
+class FakeStore(object):
+    """
+    The records served, generated from a seed
+    """
+
+    def __init__(self, items=10000, shops=3, categories=50, seed=1):
+        rnd = random.Random(seed)
+        base = time.mktime((2013, 1, 1, 0, 0, 0, 0, 0, 0))
+        self.lock = threading.Lock()
+        self.tables = {"Shop": {}, "Category": {}, "Item": {}, "ItemShop": {}}
+
+        for i in xrange(1, shops + 1):
+            self.tables["Shop"][i] = {"shopID": str(i), "name": "Shop %d" % i}
+        for i in xrange(1, categories + 1):
+            self.tables["Category"][i] = {"categoryID": str(i), "name": "Category %d" % i,
+                                          "parentID": "0"}
+
+        self.item_shops = {}
+        item_shop = 1
+        for i in xrange(1, items + 1):
+            stamp = time.strftime(TIME_FORMAT, time.gmtime(base + i * 60))
+            self.tables["Item"][i] = {
+                "itemID": str(i),
+                "systemSku": "2100000%05d" % i,
+                "defaultCost": "%.2f" % (rnd.random() * 50),
+                "avgCost": "%.2f" % (rnd.random() * 50),
+                "tax": "true",
+                "archived": "false",
+                "itemType": "default",
+                "description": "Benchmark item %d %s" % (i, "x" * rnd.randint(10, 60)),
+                "upc": "0%011d" % (rnd.random() * 10 ** 11),
+                "customSku": "SKU-%d" % i,
+                "manufacturerSku": "M-%d" % rnd.randint(1, 10 ** 6),
+                "createTime": stamp,
+                "timeStamp": stamp,
+                "categoryID": str(rnd.randint(1, categories)),
+                "taxClassID": "1",
+                "manufacturerID": str(rnd.randint(1, 200)),
+                "Prices": {"ItemPrice": [{"amount": "%.2f" % (rnd.random() * 100),
+                                          "useTypeID": "1", "useType": "Default"},
+                                         {"amount": "%.2f" % (rnd.random() * 100),
+                                          "useTypeID": "2", "useType": "MSRP"}]}}
+            for shop in xrange(1, shops + 1):
+                self.tables["ItemShop"][item_shop] = {
+                    "itemShopID": str(item_shop), "itemID": str(i), "shopID": str(shop),
+                    "qoh": str(rnd.randint(0, 100)), "backorder": "0",
+                    "reorderPoint": "5", "reorderLevel": "20", "timeStamp": stamp}
+                self.item_shops.setdefault(str(i), []).append(item_shop)
+                item_shop += 1
+        self.__index = {}
+        self.next_id = dict((name, len(rows) + 1) for (name, rows) in self.tables.iteritems())
+
+
+    def relations(self, resource, record, names):
+        """
+        The record with the requested relations loaded
+        """
+        if resource != "Item" or not names:
+            return record
+        record = dict(record)
+        if names == "all" or "ItemShops" in names:
+            record["ItemShops"] = {"ItemShop": [self.tables["ItemShop"][i]
+                                                for i in self.item_shops.get(record["itemID"], [])
+                                                if i in self.tables["ItemShop"]]}
+        if names == "all" or "Category" in names:
+            category = self.tables["Category"].get(int(record["categoryID"]))
+            if category is not None:
+                record["Category"] = category
+        return record
+
+
+    def changed(self, resource):
+        self.__index.pop(resource, None)
+
+
+    def __ids(self, resource):
+        """
+        The sorted IDs of a table, kept like a database index
+        """
+        ids = self.__index.get(resource)
+        if ids is None:
+            ids = self.__index[resource] = sorted(self.tables[resource])
+        return ids
+
+
+    def select(self, resource, query):
+        table = self.tables[resource]
+        key = id_field(resource)
+        ids = self.__ids(resource)
+        filters = [(f, v) for (f, v) in query.iteritems() if f not in CONTROL_PARAMS]
+
+        # Look ID ranges up in the index
+        op, operands = _filter(query.get(key, ""))
+        if op in (">", ">=", "><"):
+            low = int(operands[0]) + (1 if op == ">" else 0)
+            high = int(operands[1]) if op == "><" else sys.maxint
+            ids = ids[bisect.bisect_left(ids, low):bisect.bisect_right(ids, high)]
+            filters = [(f, v) for (f, v) in filters if f != key]
+
+        rows = [table[i] for i in ids]
+        if filters:
+            rows = [r for r in rows if all(_matches(r.get(f), v) for (f, v) in filters)]
+        order = query.get("orderby", key)
+        descending = query.get("orderby_desc", "0") not in ("0", "")
+        if order != key:
+            rows.sort(key=lambda r: _key(r.get(order)), reverse=descending)
+        elif descending:
+            rows.reverse()
+        return rows
+
+
+
+class Bucket(object):
+    """
+    The server side leaky bucket of one set of credentials
+    """
+
+    def __init__(self, capacity, drip_rate):
+        self.capacity = capacity
+        self.drip_rate = drip_rate
+        self.level = 0.0
+        self.stamp = time.time()
+
+
+    def add(self, cost):
+        """
+        Add cost to the bucket, or return the seconds to wait if it would overflow
+        """
+        now = time.time()
+        self.level = max(0.0, self.level - (now - self.stamp) * self.drip_rate)
+        self.stamp = now
+        if self.level + cost > self.capacity:
+            return (self.level + cost - self.capacity) / self.drip_rate
+        self.level += cost
+        return 0
+
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer each response and send it without waiting on Nagle's
+    # algorithm, which stalls on delayed ACKs over loopback
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+    def __encode(self, data):
+        """
+        Compress the body in the first encoding the client accepts
+        """
+        if not self.server.compress or not data:
+            return data, None
+        accepted = [e.split(";")[0].strip() for e in self.headers.get("Accept-Encoding", "").split(",")]
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+                encoder = zlib.compressobj(6, zlib.DEFLATED, wbits)
+                return encoder.compress(data) + encoder.flush(), encoding
+        return data, None
+
+
+    def __reply(self, status, body=None, headers={}):
+        data = simplejson.dumps(body) if body is not None else ""
+        data, encoding = self.__encode(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(data)))
+        bucket = self.server.bucket(self.headers.get("Authorization"))
+        self.send_header("X-LS-API-Bucket-Level", "%g/%g" % (bucket.level, bucket.capacity))
+        self.send_header("X-LS-API-Drip-Rate", "%g" % bucket.drip_rate)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.server.bandwidth:
+            time.sleep(len(data) / float(self.server.bandwidth))
+        self.wfile.write(data)
+
+
+    def __admit(self):
+        """
+        Charge the request to the bucket, answering 503 if it overflows
+        """
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        cost = 1 if self.command == "GET" else 10
+        with server.lock:
+            server.requests += 1
+            wait = server.bucket(self.headers.get("Authorization")).add(cost)
+            if wait:
+                server.throttled += 1
+        if wait:
+            # Drain the rejected body so the keep-alive connection stays usable
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.__reply(503, {"message": "Rate limit exceeded"},
+                         {"Retry-After": str(int(math.ceil(wait)))})
+            return False
+        return True
+
+
+    def __body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        data = self.rfile.read(length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return simplejson.loads(data)
+
+
+    def __route(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == "/API/Account.json":
+            return "Account", None, query
+        match = PATH.match(url.path)
+        if match is None or match.group(1) not in self.server.store.tables:
+            return None, None, query
+        id = match.group(2)
+        return match.group(1), int(id) if id else None, query
+
+
+    def do_GET(self):
+        if not self.__admit():
+            return
+        resource, id, query = self.__route()
+        store = self.server.store
+        if resource == "Account":
+            return self.__reply(200, {"@attributes": {"count": "1"},
+                                      "Account": {"accountID": ACCOUNT_ID, "name": "Benchmarks"}})
+        if resource is None:
+            return self.__reply(404, {"message": "Not found"})
+
+        relations = query.get("load_relations")
+        if relations and relations != "all":
+            relations = simplejson.loads(relations)
+
+        with store.lock:
+            if id is not None:
+                record = store.tables[resource].get(id)
+                if record is None:
+                    return self.__reply(404, {"message": "Not found"})
+                return self.__reply(200, {"@attributes": {"count": "1"},
+                                          resource: store.relations(resource, record, relations)})
+            rows = store.select(resource, query)
+
+        offset = int(query.get("offset", 0))
+        limit = min(int(query.get("limit", 100)), 100)
+        if self.server.offset_cost:
+            # Skipping rows is not free on a real database
+            time.sleep(self.server.offset_cost * offset / 10000.0)
+        page = [store.relations(resource, r, relations) for r in rows[offset:offset + limit]]
+        body = {"@attributes": {"count": str(len(rows)), "offset": str(offset), "limit": str(limit)}}
+        if page:
+            body[resource] = page if len(page) > 1 else page[0]
+        self.__reply(200, body)
+
+
+    def do_PUT(self):
+        if not self.__admit():
+            return
+        resource, id, query = self.__route()
+        store = self.server.store
+        updates = self.__body()
+        with store.lock:
+            record = store.tables.get(resource, {}).get(id)
+            if record is None:
+                return self.__reply(404, {"message": "Not found"})
+            record.update(updates)
+            store.changed(resource)
+            record["timeStamp"] = time.strftime(TIME_FORMAT, time.gmtime())
+            record = dict(record)
+        self.__reply(200, {resource: record})
+
+
+    def do_POST(self):
+        if not self.__admit():
+            return
+        resource, id, query = self.__route()
+        store = self.server.store
+        if resource is None or resource == "Account" or id is not None:
+            return self.__reply(404, {"message": "Not found"})
+        record = self.__body()
+        with store.lock:
+            id = store.next_id[resource]
+            store.next_id[resource] += 1
+            record[id_field(resource)] = str(id)
+            record["timeStamp"] = time.strftime(TIME_FORMAT, time.gmtime())
+            store.tables[resource][id] = record
+            store.changed(resource)
+            record = dict(record)
+        self.__reply(200, {resource: record})
+
+
+    def do_DELETE(self):
+        if not self.__admit():
+            return
+        resource, id, query = self.__route()
+        store = self.server.store
+        with store.lock:
+            record = store.tables.get(resource, {}).pop(id, None)
+            store.changed(resource)
+        if record is None:
+            return self.__reply(404, {"message": "Not found"})
+        self.__reply(200, {resource: record})
+
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded fake API server on a free local port
+    """
+    daemon_threads = True
+
+    def __init__(self, items=10000, shops=3, capacity=60, drip_rate=1000, latency=0.0,
+                 offset_cost=0.0, compress=False, bandwidth=None, port=0):
+        """
+        Constructor
+
+        @param items: Number of Items generated
+        @type items: int
+        @param shops: Number of Shops, each Item has an ItemShop per Shop
+        @type shops: int
+        @param capacity: Size of the leaky bucket of each set of credentials
+        @type capacity: float
+        @param drip_rate: Units drained from the bucket per second - the
+                          real API drains 1 per second
+        @type drip_rate: float
+        @param latency: Seconds added to every request, to emulate the network
+        @type latency: float
+        @param offset_cost: Seconds added per 10000 rows skipped by the offset
+        @type offset_cost: float
+        @param compress: Encode responses as the client accepts (gzip or deflate)
+        @type compress: bool
+        @param bandwidth: Bytes per second each response is sent at, to
+                          emulate a slow link
+        @type bandwidth: int
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeHandler)
+        self.store = FakeStore(items=items, shops=shops)
+        self.capacity = capacity
+        self.drip_rate = drip_rate
+        self.latency = latency
+        self.offset_cost = offset_cost
+        self.compress = compress
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.__buckets = {}
+        self.__thread = None
+
+
+    @property
+    def host(self):
+        return "%s:%d" % self.server_address
+
+
+    def bucket(self, auth):
+        bucket = self.__buckets.get(auth)
+        if bucket is None:
+            bucket = self.__buckets.setdefault(auth, Bucket(self.capacity, self.drip_rate))
+        return bucket
+
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, name="fake-merchantos")
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--items", type="int", default=10000)
+    parser.add_option("--drip-rate", type="float", default=1000)
+    parser.add_option("--latency", type="float", default=0.0)
+    parser.add_option("--compress", action="store_true")
+    parser.add_option("--bandwidth", type="int", help="Bytes per second per response")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    server = FakeServer(items=options.items, drip_rate=options.drip_rate,
+                        latency=options.latency, compress=options.compress,
+                        bandwidth=options.bandwidth, port=options.port)
+    print "Fake MerchantOS API on http://%s" % server.host
+    server.serve_forever()
@@ -0,0 +1,406 @@
+"""
+Benchmarks
+
+Measures the client against the local fake server (see fakeserver), so
+results are reproducible offline and can be compared between changes:
+
+    python benchmarks/run.py --output before.json
+    ... change Connection / ResourceAccessor ...
+    python benchmarks/run.py --baseline before.json
+
+Cases:
+    enumerate   Items per second enumerated, for each enumerate mode and
+                sharded by QueryPlanner
+    get         Latency of single Item gets
+    memory      Bytes held by 10k enumerated objects, for each mode
+                (projection keeps 4 fields of Items and their ItemShops)
+    decode      Pages per second decoded by each JSON codec, from a
+                load_relations=all page
+    write       Updates per second through BulkWriter
+    throttle    Requests per second, and 503s received, against a server
+                draining its bucket at a fixed rate
+    compression Items per second and bytes received enumerating with
+                load_relations=all, with and without compressed
+                responses, against a server sending at a limited bandwidth
+    inventory   ItemShop rows per second rolled up (totals per item and per
+                shop, low stock and a snapshot diff) over 40 shops, with
+                and without NumPy
+    tenants     Requests per second through a TenantManager, one large
+                account and many small ones, and how long the small ones
+                take to finish
+
+With --baseline, every metric is compared to the baseline run and the
+exit status is 1 if any got worse by more than the threshold.
+"""
+import os
+import gc
+import sys
+import time
+import random
+import logging
+import optparse
+import simplejson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MerchantOS.api import ApiClient
+from MerchantOS.api.bulk import BulkWriter
+from MerchantOS.api.planner import QueryPlanner
+from MerchantOS.api.tenants import TenantManager
+from MerchantOS.api.inventory import InventoryTable, numpy
+from MerchantOS.api.lib.metrics import RequestStats
+from MerchantOS.api.lib.codec import JsonCodec, available_backends
+from MerchantOS.api.lib.pool import ConnectionPool
+from fakeserver import FakeServer
+
+log = logging.getLogger("benchmarks")
+
+# Whether a larger value of a metric is better
+HIGHER_IS_BETTER = {"items_per_s": True,
+                    "ops_per_s": True,
+                    "pages_per_s": True,
+                    "requests_per_s": True,
+                    "rows_per_s": True,
+                    "mean_ms": False,
+                    "p50_ms": False,
+                    "p95_ms": False,
+                    "bytes_per_10k": False,
+                    "throttled": False}
+
+ENUMERATE_MODES = {"default": {},
+                   "stream": {"stream": True},
+                   "workers": {"workers": 4},
+                   "raw": {"raw": True},
+                   "compact": {"compact": True},
+                   "keyset": {"keyset": True},
+                   "relations": {"query": {"load_relations": "all"}},
+                   "projection": {"fields": ["itemID", "upc", "ItemShops.ItemShop.shopID",
+                                             "ItemShops.ItemShop.qoh"],
+                                  "relations": ["ItemShops"]}}
+
+
+# Fields converted by the numeric decode case
+NUMERIC_FIELDS = ["qoh", "backorder", "reorderPoint", "reorderLevel", "amount",
+                  "defaultCost", "avgCost", "count"]
+
+
+def client(server, **kwargs):
+    # Distinct credentials per client, so no two share a rate limiter
+    client.count = getattr(client, "count", 0) + 1
+    return ApiClient(server.host, "token", "bench%d" % client.count, secure=False, **kwargs)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def deep_size(roots, exclude=()):
+    """
+    Bytes allocated for roots and everything they reference, except the
+    excluded objects and classes, modules and functions (shared by all)
+    """
+    seen = set(id(obj) for obj in exclude)
+    pending = list(roots)
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys), type(deep_size))):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+
+def bench_enumerate(server, options):
+    results = {}
+    for mode, kwargs in sorted(ENUMERATE_MODES.iteritems()):
+        api = client(server)
+        api._connection.resource_base_url  # account lookup and connection set up
+        best = None
+        for run in xrange(options.repeat):
+            start = time.time()
+            count = sum(1 for obj in api.Item.enumerate(**kwargs))
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results["enumerate.%s" % mode] = {"items": count,
+                                          "items_per_s": count / best}
+        api._connection.close()
+
+    api = client(server)
+    planner = QueryPlanner(api, workers=4)
+    best = None
+    for run in xrange(options.repeat):
+        start = time.time()
+        count = sum(1 for obj in planner.enumerate("Item"))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results["enumerate.sharded"] = {"items": count, "items_per_s": count / best}
+    api._connection.close()
+    return results
+
+
+def bench_get(server, options):
+    api = client(server)
+    api._connection.resource_base_url
+    rnd = random.Random(1)
+    ids = [rnd.randint(1, options.items) for i in xrange(options.gets)]
+    latencies = []
+    for id in ids:
+        start = time.time()
+        api.Item.get(id)
+        latencies.append((time.time() - start) * 1000)
+    api._connection.close()
+    return {"get": {"requests": len(ids),
+                    "mean_ms": sum(latencies) / len(latencies),
+                    "p50_ms": percentile(latencies, 50),
+                    "p95_ms": percentile(latencies, 95)}}
+
+
+def bench_memory(server, options):
+    results = {}
+    count = min(options.items, 10000)
+    for mode in ("default", "compact", "raw", "relations", "projection"):
+        api = client(server)
+        objects = list(api.Item.enumerate(limit=count, **ENUMERATE_MODES[mode]))
+        gc.collect()
+        size = deep_size(objects, exclude=[api._connection, api.Item])
+        results["memory.%s" % mode] = {"objects": len(objects),
+                                       "bytes_per_10k": size * 10000.0 / len(objects)}
+        del objects
+        api._connection.close()
+    return results
+
+
+def bench_decode(server, options):
+    pool = ConnectionPool(server.host, secure=False)
+    response, data = pool.request("GET", "/API/Account/42/Item.json?limit=100&load_relations=all")
+    pool.close()
+
+    results = {}
+    for backend in available_backends():
+        for numeric in (False, True):
+            codec = JsonCodec(backend, numeric_fields=NUMERIC_FIELDS if numeric else None)
+            start = time.time()
+            for i in xrange(options.decodes):
+                codec.loads(data)
+            elapsed = time.time() - start
+            results["decode.%s%s" % (backend, ".numeric" if numeric else "")] = {
+                "bytes": len(data), "pages_per_s": options.decodes / elapsed}
+    return results
+
+
+def bench_write(server, options):
+    results = {}
+    for workers in (1, 8):
+        api = client(server)
+        writer = BulkWriter(api, workers=workers)
+        for id in xrange(1, min(options.writes, options.items) + 1):
+            writer.update("Item/%d" % id, {"qoh": str(id % 50)})
+        start = time.time()
+        result = writer.run()
+        elapsed = time.time() - start
+        results["write.workers%d" % workers] = {"ops": len(result),
+                                                "failed": len(result.failed) + len(result.throttled),
+                                                "ops_per_s": len(result) / elapsed}
+        api._connection.close()
+    return results
+
+
+def bench_throttle(server, options):
+    """
+    Runs against its own server draining 200 units per second, so the
+    client limiter (not the server) is what paces the requests
+    """
+    throttled = FakeServer(items=1000, capacity=60, drip_rate=200).start()
+    try:
+        stats = RequestStats()
+        api = client(throttled, hooks=[stats])
+        start = time.time()
+        for offset in xrange(options.throttle_requests):
+            api.Item.enumerate(start=offset % 1000, limit=1).next()
+        elapsed = time.time() - start
+        api._connection.close()
+        return {"throttle": {"requests": options.throttle_requests,
+                             "throttled": throttled.throttled,
+                             "requests_per_s": options.throttle_requests / elapsed,
+                             "client": stats.totals()}}
+    finally:
+        throttled.stop()
+
+
+def bench_compression(server, options):
+    """
+    Runs against its own server, which compresses responses and sends
+    them at --bandwidth bytes per second
+    """
+    slow = FakeServer(items=min(options.items, 2000), capacity=options.capacity,
+                      compress=True, bandwidth=options.bandwidth).start()
+    results = {}
+    try:
+        for compress in (False, True):
+            stats = RequestStats()
+            api = client(slow, compress=compress, hooks=[stats])
+            start = time.time()
+            count = 0
+            for item in api.Item.enumerate(query={"load_relations": "all"}, raw=True):
+                count += 1
+            elapsed = time.time() - start
+            api._connection.close()
+            results["compression.%s" % ("on" if compress else "off")] = {
+                "items": count,
+                "items_per_s": count / elapsed,
+                "bytes_per_10k": stats.totals()["bytes_in"] * 10000 / max(count, 1)}
+    finally:
+        slow.stop()
+    return results
+
+
+def bench_inventory(server, options):
+    """
+    Runs on generated rows, without the server
+    """
+    rnd = random.Random(1)
+    rows = [(item, shop, rnd.randint(-5, 100), rnd.randint(0, 20), rnd.randint(0, 40))
+            for item in xrange(1, options.items + 1) for shop in xrange(1, 41)]
+    changed = [(item, shop, qoh + (1 if rnd.random() < 0.05 else 0), point, level)
+               for (item, shop, qoh, point, level) in rows]
+    results = {}
+    for vectorized in ([False, True] if numpy is not None else [False]):
+        before = InventoryTable.from_rows(rows, vectorized=vectorized)
+        after = InventoryTable.from_rows(changed, vectorized=vectorized)
+        start = time.time()
+        before.item_totals()
+        before.shop_totals()
+        before.low_stock()
+        delta = after.diff(before)
+        elapsed = time.time() - start
+        results["inventory.%s" % ("numpy" if vectorized else "python")] = {
+            "rows": len(rows),
+            "changes": len(delta),
+            "rows_per_s": len(rows) / elapsed}
+    return results
+
+
+def bench_tenants(server, options):
+    """
+    One account with many gets queued ahead of many small accounts; with
+    fair scheduling the small ones finish long before the large one
+    """
+    manager = TenantManager(server.host, workers=16, secure=False)
+    try:
+        small = ["small%d" % i for i in xrange(options.tenants)]
+        manager.add("large", "token", "large")
+        for name in small:
+            manager.add(name, "token", name)
+        get = lambda api, id: api.Item.get(id)
+
+        start = time.time()
+        futures = [manager.submit("large", get, id % options.items + 1)
+                   for id in xrange(options.tenant_requests * options.tenants)]
+        done = {}
+        for name in small:
+            calls = [manager.submit(name, get, id % options.items + 1)
+                     for id in xrange(options.tenant_requests)]
+            futures.extend(calls)
+            calls[-1].add_done_callback(lambda f, name=name: done.setdefault(name, time.time()))
+        for future in futures:
+            future.result()
+        elapsed = time.time() - start
+        finished = [(done[name] - start) * 1000 for name in small]
+        return {"tenants": {"requests": len(futures),
+                            "requests_per_s": len(futures) / elapsed,
+                            "p50_ms": percentile(finished, 50),
+                            "p95_ms": percentile(finished, 95),
+                            "total_ms": elapsed * 1000}}
+    finally:
+        manager.close()
+
+
+CASES = [("enumerate", bench_enumerate),
+         ("get", bench_get),
+         ("memory", bench_memory),
+         ("decode", bench_decode),
+         ("write", bench_write),
+         ("throttle", bench_throttle),
+         ("compression", bench_compression),
+         ("inventory", bench_inventory),
+         ("tenants", bench_tenants)]
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each metric against the baseline and return the regressions
+    """
+    regressions = []
+    for name in sorted(results):
+        for metric, value in sorted(results[name].iteritems()):
+            before = baseline.get(name, {}).get(metric)
+            if metric not in HIGHER_IS_BETTER or not before:
+                continue
+            change = (value - before) / float(before)
+            worse = -change if HIGHER_IS_BETTER[metric] else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append((name, metric))
+            print "%-22s %-15s %12.2f %12.2f %+7.1f%%%s" % (name, metric, before, value, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [case ...]")
+    parser.add_option("--items", type="int", default=10000, help="Items served")
+    parser.add_option("--latency", type="float", default=0.0, help="Seconds added to each request")
+    parser.add_option("--offset-cost", type="float", default=0.0,
+                      help="Seconds the server adds per 10000 rows skipped by an offset")
+    parser.add_option("--capacity", type="float", default=10000,
+                      help="Size of the server's bucket (the throttle case has its own server)")
+    parser.add_option("--repeat", type="int", default=3, help="Runs per enumerate mode (best is kept)")
+    parser.add_option("--gets", type="int", default=500, help="Number of gets timed")
+    parser.add_option("--decodes", type="int", default=200, help="Number of pages decoded per codec")
+    parser.add_option("--writes", type="int", default=500, help="Number of updates timed")
+    parser.add_option("--throttle-requests", type="int", default=300)
+    parser.add_option("--bandwidth", type="int", default=2 * 1024 * 1024,
+                      help="Bytes per second per response in the compression case")
+    parser.add_option("--tenants", type="int", default=50, help="Small accounts in the tenants case")
+    parser.add_option("--tenant-requests", type="int", default=20,
+                      help="Gets per small account (the large one has as many as all of them)")
+    parser.add_option("--output", help="Write the results to this JSON file")
+    parser.add_option("--baseline", help="Compare with the results in this JSON file")
+    parser.add_option("--threshold", type="float", default=0.1,
+                      help="Relative change counted as a regression")
+    parser.add_option("-v", "--verbose", action="store_true")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)-8s[%(name)s] %(message)s')
+
+    cases = [(name, bench) for (name, bench) in CASES if not args or name in args]
+    server = FakeServer(items=options.items, capacity=options.capacity,
+                        latency=options.latency, offset_cost=options.offset_cost).start()
+    results = {}
+    try:
+        for name, bench in cases:
+            print "Running %s..." % name
+            results.update(bench(server, options))
+    finally:
+        server.stop()
+
+    print simplejson.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fp:
+            simplejson.dump(results, fp, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as fp:
+            regressions = compare(results, simplejson.load(fp), options.threshold)
+        if regressions:
+            print "%d regressions" % len(regressions)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,7 @@ sys.path.append("..")
 import logging
 from pprint import pprint
 from MerchantOS.api import ApiClient
+from MerchantOS.api.inventory import InventoryTable
 from datetime import datetime, timedelta
 
 logging.basicConfig(level=logging.DEBUG, 
@@ -24,11 +25,16 @@ pos_log = logging.getLogger("pos")
 
 
 
+# Only what the products need - the other fields and relations are
+# neither sent nor kept
+PRODUCT_FIELDS = ["itemID", "description", "upc",
+                  "ItemShops.ItemShop.shopID", "ItemShops.ItemShop.qoh"]
+
+
 def get_product(api, id):
-    q = {"load_relations":"all"}
     prod = {}
     try:
-        product = api.Item.get(id, query=q)
+        product = api.Item.get(id, fields=PRODUCT_FIELDS, relations=["ItemShops"])
         pprint(product.to_dict())
         prod["name"] = product.description
         prod["sku"] = product.upc
@@ -82,10 +88,9 @@ def get_updated_products(api, since):
             prods[id] = {"counted": False, "sold": False, "updated": False, "received": False}
         prods[id]["sold"] = True
     
-    q3 = {"timeStamp": ">=,%s" % sinceStr,
-          "load_relations":"all"}
+    q3 = {"timeStamp": ">=,%s" % sinceStr}
     pos_log.info("Checking for Product Updates")
-    for line in api.Item.enumerate(query=q3):
+    for line in api.Item.enumerate(query=q3, fields=["itemID"], relations=[]):
         id = line.itemID
         if not prods.has_key(id):
             prods[id] = {"counted": False, "sold": False, "updated": False, "received": False}
@@ -94,13 +99,13 @@ def get_updated_products(api, since):
     
 def get_products(api, since):
         #api = self.driver
-        q = {"load_relations":"all"}
+        q = {}
         if since:
             sinceStr = since.strftime("%Y-%m-%dT%H:%M:%S+00:00")
             q.update({"timeStamp": ">=,%s" % sinceStr})
         
         
-        for product in api.Item.enumerate(query=q):
+        for product in api.Item.enumerate(query=q, fields=PRODUCT_FIELDS, relations=["ItemShops"]):
             prod = {}
             prod["name"] = product.description
             prod["sku"] = product.upc
@@ -121,6 +126,19 @@ def get_products(api, since):
                         prod["quantity"] += int(inv["qoh"])
                          
             yield(prod)
+
+
+def get_inventory(api):
+    """
+    Quantity on hand of every item, and the items to reorder at each shop
+    """
+    inventory = InventoryTable.load(api, query={"archived": "false"})
+    item_ids, qoh = inventory.item_totals()
+    low = inventory.low_stock()
+    reorder = {}
+    for item_id, shop_id in zip(low.item_id, low.shop_id):
+        reorder.setdefault(int(shop_id), []).append(int(item_id))
+    return dict(zip(item_ids, qoh)), reorder
         
     
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+"""
+Test Support
+
+The tests run against the fake server of the benchmarks (see
+benchmarks/fakeserver.py), started once per test case class:
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import logging
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fakeserver import FakeServer
+from MerchantOS.api import ApiClient
+
+# Errors logged on purpose by the tests are not printed
+logging.getLogger("MerchantOS").addHandler(logging.NullHandler())
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    A test case with a fake server, and clients of it
+    """
+    items = 300
+    server_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeServer(items=cls.items, capacity=10 ** 6, **cls.server_options).start()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+
+    def client(self, **kwargs):
+        """
+        A client of the fake server, closed when the test ends
+        """
+        kwargs.setdefault("secure", False)
+        api = ApiClient(self.server.host, "token", "user", **kwargs)
+        self.addCleanup(api._connection.close)
+        return api
@@ -0,0 +1,68 @@
+import unittest
+
+from support import ServerTestCase
+from MerchantOS.api.bulk import BulkWriter, SUCCEEDED, FAILED
+
+
+class BrokenConnection(object):
+    """
+    Wraps a Connection, failing the writes of some urls the way a bad
+    response body or a bug would
+    """
+
+    def __init__(self, connection, errors):
+        self.connection = connection
+        self.errors = errors
+
+
+    def create(self, url, properties):
+        if url in self.errors:
+            raise self.errors[url]
+        return self.connection.create(url, properties)
+
+
+    def update(self, url, updates):
+        if url in self.errors:
+            raise self.errors[url]
+        return self.connection.update(url, updates)
+
+
+    def delete(self, url):
+        return self.connection.delete(url)
+
+
+
+class BulkWriterTest(ServerTestCase):
+
+    def test_writes(self):
+        api = self.client()
+        writer = BulkWriter(api, workers=4, backoff=0)
+        for i in range(1, 11):
+            writer.update("Item/%d" % i, {"description": "bulk %d" % i})
+        created = writer.create("Item", {"description": "new"})
+        result = writer.run()
+        self.assertTrue(result.ok(), result)
+        self.assertEqual(len(result.succeeded), 11)
+        self.assertEqual(api.Item.get(3).description, "bulk 3")
+        self.assertEqual(created.result["description"], "new")
+
+
+    def test_unexpected_errors_fail_only_their_operation(self):
+        api = self.client()
+        connection = BrokenConnection(api._connection, {"Vendor": KeyError("Vendor"),
+                                                        "Item/2": ValueError("bad body")})
+        writer = BulkWriter(connection, workers=2, backoff=0)
+        ops = [writer.update("Item/%d" % i, {"description": "x"}) for i in range(1, 5)]
+        ops.append(writer.create("Vendor", {"name": "ACME"}))
+        result = writer.run()
+
+        self.assertEqual(len(result), 5)
+        self.assertEqual([op.status for op in ops],
+                         [SUCCEEDED, FAILED, SUCCEEDED, SUCCEEDED, FAILED])
+        self.assertTrue(isinstance(ops[1].error, ValueError))
+        self.assertEqual(ops[1].attempts, 1)
+        self.assertTrue(isinstance(ops[4].error, KeyError))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from support import ServerTestCase
+from MerchantOS.api.lib.cache import ResponseCache
+
+
+class CacheInvalidationTest(ServerTestCase):
+    items = 20
+
+    def setUp(self):
+        self.requests = []
+        self.api = self.client(cache=ResponseCache(ttls={"Item": 600}),
+                               hooks=[self.requests.append])
+
+
+    def gets(self):
+        return len([r for r in self.requests if r.method == "GET"])
+
+
+    def test_reads_are_cached(self):
+        self.api.Item.get(1)
+        gets = self.gets()
+        self.assertEqual(self.api.Item.get(1).itemID, "1")
+        self.assertEqual(self.gets(), gets)
+
+
+    def test_update(self):
+        item = self.api.Item.get(2)
+        item.description = "updated"
+        item.save()
+        gets = self.gets()
+        self.assertEqual(self.api.Item.get(2).description, "updated")
+        self.assertEqual(self.gets(), gets + 1)
+
+
+    def test_create_and_delete(self):
+        count = self.api.Item.get_count()
+        created = self.api.Item.create({"description": "new"})
+        self.assertEqual(self.api.Item.get_count(), count + 1)
+        created.delete()
+        self.assertEqual(self.api.Item.get_count(), count)
+        self.assertEqual(self.api.Item.get(created.itemID), None)
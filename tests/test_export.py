@@ -0,0 +1,53 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+from support import ServerTestCase
+from MerchantOS.api.export import Exporter
+
+
+class ExportTest(ServerTestCase):
+    items = 50
+
+    def setUp(self):
+        self.api = self.client()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+
+    def test_csv(self):
+        path = os.path.join(self.dir, "items.csv")
+        count = Exporter(self.api, "Item", columns=["itemID", "upc"], chunk_size=7).export(path)
+        rows = list(csv.reader(open(path)))
+        self.assertEqual(count, self.items)
+        self.assertEqual(rows[0], ["itemID", "upc"])
+        self.assertEqual([row[0] for row in rows[1:]], [str(i) for i in range(1, self.items + 1)])
+        self.assertEqual(os.listdir(self.dir), ["items.csv"])
+
+
+    def test_new_columns_leave_no_file(self):
+        # The first chunk has no ItemShops, the later ones do
+        class Items(Exporter):
+            def rows(self):
+                for row in Exporter.rows(self):
+                    if int(row["itemID"]) > 10:
+                        row["ItemShops"] = {"ItemShop": [{"qoh": "1"}]}
+                    yield row
+
+        path = os.path.join(self.dir, "items.csv")
+        with self.assertRaises(ValueError):
+            Items(self.api, "Item", chunk_size=10).export(path)
+        self.assertEqual(os.listdir(self.dir), [])
+
+        # An earlier export of the file is kept
+        open(path, "w").write("old")
+        with self.assertRaises(ValueError):
+            Items(self.api, "Item", chunk_size=10).export(path)
+        self.assertEqual(open(path).read(), "old")
+        self.assertEqual(os.listdir(self.dir), ["items.csv"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from support import ServerTestCase
+
+
+class KeysetTest(ServerTestCase):
+
+    def ids(self, query, **kwargs):
+        api = self.client()
+        return [int(r["itemID"]) for r in api.Item.enumerate(query=query, raw=True, **kwargs)]
+
+
+    def test_matches_offset_paging(self):
+        for query in [{}, {"itemID": "<=,10"}, {"itemID": "<,10"}, {"itemID": ">,290"},
+                      {"itemID": ">=,290"}, {"itemID": "><,5,17"}, {"itemID": "42"}]:
+            self.assertEqual(self.ids(query, keyset=True, max_per_call=7),
+                             self.ids(query, max_per_call=7), query)
+
+
+    def test_upper_bound_only(self):
+        self.assertEqual(self.ids({"itemID": "<=,10"}, keyset=True), range(1, 11))
+        self.assertEqual(self.ids({"itemID": "<=,10"}, keyset=True, max_per_call=3), range(1, 11))
+        self.assertEqual(self.ids({"itemID": "<,10"}, keyset=True, max_per_call=3), range(1, 10))
+
+
+    def test_both_bounds(self):
+        self.assertEqual(self.ids({"itemID": "><,5,17"}, keyset=True, max_per_call=4), range(5, 18))
+        self.assertEqual(self.ids({"itemID": "><,5,17"}, keyset=True, max_per_call=13), range(5, 18))
+        self.assertEqual(self.ids({"itemID": "><,5,17"}, keyset=True, start=3, limit=5), range(8, 13))
+
+
+    def test_lower_bound_only(self):
+        self.assertEqual(self.ids({"itemID": ">,290"}, keyset=True, max_per_call=4), range(291, 301))
+
+
+    def test_streamed(self):
+        self.assertEqual(self.ids({"itemID": "<=,25"}, keyset=True, stream=True, max_per_call=10),
+                         range(1, 26))
+
+
+    def test_other_orders_are_refused(self):
+        with self.assertRaises(ValueError):
+            self.ids({"orderby": "description"}, keyset=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from support import ServerTestCase
+from MerchantOS.api.lib.codec import JsonCodec
+from MerchantOS.api.mirror import LocalMirror
+
+
+class MirrorTest(ServerTestCase):
+    codec = None
+
+    def setUp(self):
+        self.api = self.client(codec=self.codec)
+        self.mirror = LocalMirror(self.api, resources={"Item": ["upc", "categoryID", "defaultCost"]})
+        self.addCleanup(self.mirror.close)
+        self.mirror.refresh(batch_size=70)
+        self.records = [r.to_dict() for r in self.client().Item.enumerate()]
+
+
+    def expected(self, test):
+        return sorted(int(r["itemID"]) for r in self.records if test(r))
+
+
+    def ids(self, query, **kwargs):
+        return [int(o.itemID) for o in self.mirror.Item.enumerate(query=query, **kwargs)]
+
+
+    def test_get(self):
+        self.assertEqual(int(self.mirror.Item.get(5).itemID), 5)
+        self.assertEqual(int(self.mirror.Item.get("5").itemID), 5)
+        self.assertEqual(self.mirror.Item.get(100000), None)
+
+
+    def test_equality_filters(self):
+        self.assertEqual(sorted(self.ids({"categoryID": "3"})),
+                         self.expected(lambda r: r["categoryID"] == "3"))
+        self.assertEqual(self.mirror.Item.get_count(query={"categoryID": "3"}),
+                         len(self.expected(lambda r: r["categoryID"] == "3")))
+        self.assertEqual(sorted(self.ids({"categoryID": "IN,[3,4]"})),
+                         self.expected(lambda r: r["categoryID"] in ("3", "4")))
+        self.assertEqual(sorted(self.ids({"categoryID": "!=,3"})),
+                         self.expected(lambda r: r["categoryID"] != "3"))
+
+
+    def test_upc_prefix_keeps_leading_zeros(self):
+        upc = self.records[11]["upc"]
+        self.assertTrue(upc.startswith("0"))
+        self.assertEqual(self.ids({"upc": "~,%s%%" % upc[:7]}),
+                         self.expected(lambda r: r["upc"].startswith(upc[:7])))
+        self.assertEqual(self.ids({"upc": upc}), [12])
+
+
+    def test_ranges_and_order(self):
+        self.assertEqual(self.ids({"itemID": "<,12", "orderby": "itemID", "orderby_desc": 1}),
+                         range(11, 0, -1))
+        self.assertEqual(self.ids({"itemID": "><,8,11"}), [8, 9, 10, 11])
+        costs = [float(o.defaultCost) for o in
+                 self.mirror.Item.enumerate(query={"defaultCost": ">,45", "orderby": "defaultCost"})]
+        self.assertEqual(costs, sorted(costs))
+        self.assertEqual(len(costs), len(self.expected(lambda r: float(r["defaultCost"]) > 45)))
+
+
+    def test_shapes(self):
+        query = {"itemID": "<=,3"}
+        self.assertEqual([unicode(r["itemID"]) for r in self.mirror.Item.enumerate(query=query, raw=True)],
+                         [r["itemID"] for r in self.records[:3]])
+        self.assertEqual([(unicode(i), upc) for (i, upc) in
+                          self.mirror.Item.enumerate(query=query, columns=["itemID", "upc"])],
+                         [(r["itemID"], r["upc"]) for r in self.records[:3]])
+        compact = list(self.mirror.Item.enumerate(query=query, compact=True))
+        self.assertFalse(hasattr(compact[0], "__dict__"))
+        self.assertEqual(compact[0].upc, self.records[0]["upc"])
+        pruned = list(self.mirror.Item.enumerate(query=query, raw=True, fields=["upc"]))
+        self.assertEqual(sorted(pruned[0]), ["itemID", "upc"])
+        self.assertEqual(self.ids(query, keyset=True, stream=True, max_per_call=2), [1, 2, 3])
+
+
+    def test_unsupported_options(self):
+        with self.assertRaises(TypeError):
+            list(self.mirror.Item.enumerate(relations=["ItemShops"]))
+        with self.assertRaises(TypeError):
+            list(self.mirror.Item.enumerate(shards=4))
+        with self.assertRaises(ValueError):
+            list(self.mirror.Item.enumerate(query={"orderby": "upc"}, keyset=True))
+
+
+
+class NumericCodecMirrorTest(MirrorTest):
+    codec = JsonCodec(numeric_fields=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import time
+import socket
+import threading
+import unittest
+from httplib import HTTPException
+
+from support import ServerTestCase
+from MerchantOS.api.lib.pool import ConnectionPool, PoolTimeout
+
+
+class ClosingServer(object):
+    """
+    Answers each request, then drops the connection without saying so, the
+    way a server times out idle keep-alive connections
+    """
+
+    def __init__(self):
+        self.methods = []
+        self.__socket = socket.socket()
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind(("127.0.0.1", 0))
+        self.__socket.listen(5)
+        self.host = "127.0.0.1:%d" % self.__socket.getsockname()[1]
+        thread = threading.Thread(target=self.__serve)
+        thread.daemon = True
+        thread.start()
+
+
+    def __serve(self):
+        while True:
+            try:
+                conn, address = self.__socket.accept()
+            except socket.error:
+                return
+            self.methods.append(conn.recv(65536).split(" ")[0])
+            conn.sendall("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            time.sleep(0.05)
+            conn.close()
+
+
+    def close(self):
+        self.__socket.close()
+
+
+
+class CheckoutTest(ServerTestCase):
+    items = 10
+
+    def test_timeout_while_a_stream_is_open(self):
+        pool = ConnectionPool(self.server.host, maxsize=1, secure=False, checkout_timeout=0.2)
+        self.addCleanup(pool.close)
+        stream = pool.open("GET", "/API/Account.json")
+        start = time.time()
+        self.assertRaises(PoolTimeout, pool.request, "GET", "/API/Account.json")
+        self.assertTrue(0.2 <= time.time() - start < 2)
+
+        stream.read()
+        stream.close()
+        response, data = pool.request("GET", "/API/Account.json")
+        self.assertEqual(response.status, 200)
+
+
+
+class StaleConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ClosingServer()
+        self.addCleanup(self.server.close)
+        self.pool = ConnectionPool(self.server.host, secure=False, compress=False)
+        self.addCleanup(self.pool.close)
+        self.assertEqual(self.pool.request("GET", "/")[1], "ok")
+        time.sleep(0.2)
+
+
+    def test_idempotent_requests_are_resent(self):
+        self.assertEqual(self.pool.request("GET", "/")[1], "ok")
+        time.sleep(0.2)
+        self.assertEqual(self.pool.request("PUT", "/", "x")[1], "ok")
+        self.assertEqual(self.server.methods, ["GET", "GET", "PUT"])
+
+
+    def test_posts_are_not_resent(self):
+        self.assertRaises((socket.error, HTTPException), self.pool.request, "POST", "/", "x")
+        time.sleep(0.2)
+        self.assertEqual(self.server.methods, ["GET"])
@@ -0,0 +1,54 @@
+import unittest
+
+from support import ServerTestCase
+from MerchantOS.api.resources import ResourceObject, CompactResourceObject
+
+
+class Item(ResourceObject):
+    sub_resources = {"ItemShops": {}}
+
+
+
+class ItemShop(ResourceObject):
+
+    def stocked(self):
+        return int(self.qoh) > 0
+
+
+
+class PrefetchTest(ServerTestCase):
+    items = 20
+
+    def client(self, **kwargs):
+        return ServerTestCase.client(self, resources={"Item": Item, "ItemShop": ItemShop},
+                                     **kwargs)
+
+
+    def test_registered_classes(self):
+        api = self.client()
+        items = api.Item.inflate(api.Item.enumerate(), "ItemShops")
+        self.assertEqual(len(items), 20)
+        for item in items:
+            self.assertEqual(len(item.ItemShops), 3)
+            for shop in item.ItemShops:
+                self.assertTrue(isinstance(shop, ItemShop))
+                self.assertEqual(shop.itemID, item.itemID)
+                shop.stocked()
+
+
+    def test_compact_types(self):
+        api = self.client()
+        items = api.Item.inflate(api.Item.enumerate(compact=True), "ItemShops")
+        for item in items:
+            self.assertTrue(isinstance(item, CompactResourceObject))
+            for shop in item.ItemShops:
+                self.assertTrue(isinstance(shop, CompactResourceObject))
+                self.assertEqual(type(shop).__name__, "CompactItemShop")
+                shop.stocked()
+
+
+    def test_undeclared_relations(self):
+        api = ServerTestCase.client(self)
+        items = api.Item.inflate(api.Item.enumerate(), "ItemShops")
+        for item in items:
+            self.assertEqual(len(item.ItemShops["ItemShop"]), 3)
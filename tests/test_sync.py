@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+import urlparse
+
+from support import ServerTestCase
+from MerchantOS.api.sync import SyncEngine, WatermarkStore
+
+
+class SyncTest(ServerTestCase):
+    items = 1000
+
+    def setUp(self):
+        self.records = []
+        self.api = self.client(hooks=[self.records.append])
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "sync.json")
+
+
+    def queries(self):
+        return [dict(urlparse.parse_qsl(urlparse.urlparse(r.url).query))
+                for r in self.records if r.resource == "Item"]
+
+
+    def test_enumerate_stops_at_the_limit(self):
+        rows = list(self.api.Item.enumerate(limit=150, raw=True))
+        self.assertEqual([int(r["itemID"]) for r in rows], range(1, 151))
+        self.assertEqual([int(q["limit"]) for q in self.queries()], [100, 50])
+
+
+    def test_pages_are_bounded(self):
+        engine = SyncEngine(self.api, WatermarkStore(self.path), page_size=150).add("Item")
+        ids = set(obj.itemID for (name, obj) in engine.run())
+        self.assertEqual(len(ids), self.items)
+        limits = [int(q["limit"]) for q in self.queries()]
+        self.assertTrue(max(limits) <= 100, limits)
+        # Each page starts at the time the one before ended
+        self.assertTrue(len(set(q.get("timeStamp") for q in self.queries())) >= self.items // 150)
+
+
+
+    def test_resume_after_changes(self):
+        engine = SyncEngine(self.api, WatermarkStore(self.path)).add("Item")
+        self.assertEqual(len(list(engine.run())), self.items)
+        for id in (5, 7):
+            self.api._connection.update("Item/%d" % id, {"description": "changed"})
+
+        # A new engine reads the watermark back from the file
+        engine = SyncEngine(self.api, WatermarkStore(self.path)).add("Item")
+        changed = [obj for (name, obj) in engine.run()]
+        self.assertEqual(sorted(obj.itemID for obj in changed), ["5", "7"])
+        self.assertEqual([obj.description for obj in changed], ["changed", "changed"])
+        self.assertEqual(list(engine.run()), [])
+
+
+    def test_resume_after_a_crash(self):
+        engine = SyncEngine(self.api, WatermarkStore(self.path), checkpoint=100).add("Item")
+        rows = engine.run()
+        before = [rows.next()[1].itemID for i in range(250)]
+        rows.close()
+
+        # Resumes from the last checkpoint, skipping the rows handed out up to it
+        engine = SyncEngine(self.api, WatermarkStore(self.path)).add("Item")
+        after = [obj.itemID for (name, obj) in engine.run()]
+        self.assertEqual(set(before) | set(after), set(str(i) for i in range(1, self.items + 1)))
+        self.assertEqual(len(before) + len(after), self.items + 50)
+
+
+if __name__ == "__main__":
+    unittest.main()